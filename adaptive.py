@@ -0,0 +1,80 @@
+""" Adaptive per-query polling intervals.
+
+Each query is polled about as often as it gets new posts: the interval of a
+query follows a smoothed average of the time between its posts, bounded by
+a minimum and a maximum interval. Polls that find nothing new back the query
+off towards the maximum interval.
+
+"""
+from time import monotonic
+
+
+class AdaptiveSchedule(object):
+
+    """ Tracks the post rate of each query and when it is next due.
+
+    Params:
+        min_interval (float): Shortest polling interval, in seconds.
+        max_interval (float): Longest polling interval, in seconds.
+        smoothing (float): Weight of the newest gap between posts in the
+            moving average, between 0 and 1.
+
+    """
+
+    def __init__(self, min_interval, max_interval, smoothing=0.3):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self._smoothing = smoothing
+        self._gaps = {}
+        self._newest = {}
+        self._intervals = {}
+        self._due = {}
+
+    def due(self, query, now=None):
+        """ Whether `query` should be polled now. """
+        now = monotonic() if now is None else now
+        return self._due.get(query, 0) <= now
+
+    def interval(self, query):
+        """ The current polling interval of `query`, in seconds. """
+        return self._intervals.get(query, self.min_interval)
+
+    def observe(self, query, epochs, now=None):
+        """ Record the outcome of polling `query`.
+
+        Args:
+            query (str): The query that was polled.
+            epochs (list(int)): Creation times of the fresh posts found, as
+                unix timestamps. Empty if nothing new was found.
+            now (float): Monotonic time the polling cycle started at,
+                defaults to now. The query is next due an interval after it,
+                so that it is due again on the matching later cycle.
+
+        """
+        now = monotonic() if now is None else now
+        if epochs:
+            points = sorted(epochs)
+            if query in self._newest:
+                points.insert(0, self._newest[query])
+            self._newest[query] = max(points)
+            for older, newer in zip(points, points[1:]):
+                self._add_gap(query, max(newer - older, 0))
+            interval = self._gaps.get(query, self.min_interval)
+        else:
+            interval = self.interval(query) * 2
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        self._intervals[query] = interval
+        self._due[query] = now + interval
+
+    def forget(self, query):
+        """ Drop everything known about `query`. """
+        for state in (self._gaps, self._newest, self._intervals, self._due):
+            state.pop(query, None)
+
+    def _add_gap(self, query, gap):
+        average = self._gaps.get(query)
+        if average is None:
+            self._gaps[query] = gap
+        else:
+            self._gaps[query] = \
+                self._smoothing * gap + (1 - self._smoothing) * average
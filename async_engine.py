@@ -0,0 +1,179 @@
+""" An asyncio polling engine for the FacebookFeed block.
+
+Instead of tying up a thread per in-flight request, every query of the
+block, its paging requests and its retries run as coroutines on a single
+event loop, sharing one pooled aiohttp client session.
+
+"""
+import asyncio
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from time import monotonic
+
+from nio.util.threading import spawn
+
+from .graph_batch import GraphResponse
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# Seconds given to in-flight requests to be cancelled and to the client
+# session to close when the engine stops.
+STOP_TIMEOUT = 5
+
+
+class AsyncPollingEngine(object):
+
+    """ Polls every query of a FacebookFeed block on an asyncio event loop.
+
+    Responses are handed to the block's own per-query processing, so the
+    engine behaves like the concurrent poll mode.
+
+    Params:
+        block (FacebookFeed): The block to poll for.
+        max_requests (int): Maximum number of requests in flight at once.
+        timeout (tuple(float)): (connect, read) timeouts, in seconds.
+
+    """
+
+    def __init__(self, block, max_requests=10, timeout=(5, 30)):
+        if aiohttp is None:
+            raise RuntimeError("The async poll mode requires aiohttp")
+        self._block = block
+        self._max_requests = max_requests
+        self._timeout = timeout
+        self._loop = asyncio.new_event_loop()
+        self._thread = None
+        self._session = None
+        self._cycle = None
+
+    def start(self):
+        self._thread = spawn(self._run)
+
+    def stop(self):
+        """ Cancel the requests in flight and stop the event loop. """
+        if self._thread is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(
+                self._close(), self._loop).result(timeout=STOP_TIMEOUT)
+        except FutureTimeoutError:
+            self._block.logger.warning(
+                "Timed out closing the async polling session")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(STOP_TIMEOUT)
+        self._thread = None
+
+    def poll(self):
+        """ Start a polling cycle of every query.
+
+        Safe to call from any thread. A cycle that is still running when the
+        next one is due causes the new one to be skipped.
+
+        Returns:
+            cycle (Future): Completes when every query has been polled, or
+                None if the cycle was skipped.
+
+        """
+        if self._cycle is not None and not self._cycle.done():
+            self._block.logger.warning(
+                "Previous polling cycle still in progress, skipping")
+            return None
+        self._block._apply_query_changes()
+        self._cycle = asyncio.run_coroutine_threadsafe(
+            self._poll_all(), self._loop)
+        return self._cycle
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+        self._loop.close()
+
+    async def _close(self):
+        tasks = [task for task in asyncio.all_tasks()
+                 if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _poll_all(self):
+        if self._session is None:
+            connect, read = self._timeout
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._max_requests),
+                timeout=aiohttp.ClientTimeout(sock_connect=connect,
+                                              sock_read=read))
+        blk = self._block
+        due = blk._due_queries()
+        results = await asyncio.gather(
+            *[self._poll_query(idx) for idx in due], return_exceptions=True)
+        for idx, result in zip(due, results):
+            # one query failing leaves the others alone, but is not lost
+            if isinstance(result, Exception):
+                blk.logger.error(
+                    "Polling of {} failed".format(blk._queries[idx]),
+                    exc_info=result)
+
+    async def _poll_query(self, idx):
+        """ Poll a single query, following paging requests as needed.
+
+        Failed requests are retried up to `retry_limit` times, waiting
+        `retry_interval` in between, unless the feed is to be skipped.
+
+        """
+        blk = self._block
+        query = blk._queries[idx]
+        since = blk._freshest[idx]
+        url = blk._query_url(query, since)
+        retries = 0
+        page = 1
+        while url is not None:
+            delay = blk._reserve()
+            if delay is None:
+                # left to a later cycle, rather than holding this one up
+                return
+            if delay > 0:
+                await asyncio.sleep(delay)
+            started = monotonic()
+            try:
+                resp = await self._get(
+                    url, blk._conditional_headers(query, url)
+                    if page == 1 else {})
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                blk.logger.exception(
+                    "Polling request of {} failed".format(url))
+                blk._record_error(query)
+                resp = None
+            blk._record_request(query, started)
+            if resp is not None and resp.status_code in (200, 304):
+                retries = 0
+                signals, url = blk._process_query_response(
+                    idx, resp, since, url, page)
+                blk._notify_query_signals(query, signals)
+                page += 1
+                continue
+            if resp is not None:
+                # failure handling may re-authenticate, which blocks
+                skipped = await self._loop.run_in_executor(
+                    None, blk._failed, query, resp, url)
+                if skipped:
+                    return
+            if retries >= blk.retry_limit():
+                return
+            retries += 1
+            if blk._metrics is not None:
+                blk._metrics.retry(query)
+            await asyncio.sleep(blk.retry_interval().total_seconds())
+            if page == 1:
+                # with the access token the failure may have replaced
+                url = blk._query_url(query, since)
+
+    async def _get(self, url, extra_headers):
+        headers = dict(extra_headers, **{"Content-Type": "application/json"})
+        async with self._session.get(url, headers=headers) as resp:
+            body = await resp.text()
+            return GraphResponse(resp.status, dict(resp.headers), body)
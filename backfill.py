@@ -0,0 +1,245 @@
+""" Parallel backfill of the lookback window of a FacebookFeed block.
+
+Instead of paging through the whole lookback window one request after
+another on the polling thread, the window is split into time slices that
+are fetched concurrently on threads of their own, so live polling carries
+on while a long backfill runs. Slices are notified oldest first, each one
+sorted by `created_time` and deduplicated, as soon as every older slice has
+been notified. The block is told how far each query got once its posts of a
+slice are notified, so it can checkpoint the progress of the backfill.
+
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from time import monotonic
+
+from nio.properties import (PropertyHolder, BoolProperty, IntProperty,
+                            TimeDeltaProperty)
+from nio.util.threading import spawn
+
+from .facebook_signal import FacebookSignal
+from .graph_json import decode
+
+
+class Backfill(PropertyHolder):
+
+    """ Property holder for the backfill of the lookback window.
+
+    """
+    enabled = BoolProperty(title='Enabled', default=False)
+    slice_size = TimeDeltaProperty(title='Slice Size', default={"hours": 6})
+    max_workers = IntProperty(title='Max Concurrent Requests', default=4)
+
+
+def time_slices(since, until, size):
+    """ Split the (since, until] window into consecutive slices.
+
+    Args:
+        since (int): Epoch the window starts after.
+        until (int): Epoch the window ends at.
+        size (int): Length of each slice in seconds, the last one may be
+            shorter.
+
+    Returns:
+        slices (list(tuple)): (since, until) of each slice, oldest first.
+
+    """
+    size = max(1, int(size))
+    slices = []
+    start = since
+    while start < until:
+        end = min(start + size, until)
+        slices.append((start, end))
+        start = end
+    return slices
+
+
+class BackfillEngine(object):
+
+    """ Fetches the posts of time windows of a FacebookFeed block's queries.
+
+    Requests go through the block's session and rate limit governor, and
+    each slice is paged with `until` on its own. Queries share slice
+    boundaries, so the posts of every query in a slice are merged before
+    they are notified.
+
+    Params:
+        block (FacebookFeed): The block to backfill.
+        windows (dict): (since, until) epochs of the window to backfill, by
+            query.
+        slice_size (int): Length of each slice in seconds.
+        max_requests (int): Maximum number of requests in flight at once.
+
+    """
+
+    def __init__(self, block, windows, slice_size, max_requests=4):
+        self._block = block
+        self._windows = windows
+        self._slice_size = slice_size
+        self._max_requests = max_requests
+        self._executor = None
+        self._thread = None
+        self._stopped = Event()
+        self.posts = 0
+
+    def start(self):
+        self._executor = ThreadPoolExecutor(max_workers=self._max_requests)
+        self._thread = spawn(self._run)
+
+    def stop(self):
+        """ Stop the backfill, leaving requests in flight to time out. """
+        self._stopped.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def join(self, timeout=None):
+        """ Wait for the backfill to end.
+
+        Returns:
+            done (bool): Whether it ended within `timeout`.
+
+        """
+        if self._thread is None:
+            return True
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def _run(self):
+        blk = self._block
+        if not self._windows:
+            return
+        started = monotonic()
+        since = min(window[0] for window in self._windows.values())
+        until = max(window[1] for window in self._windows.values())
+        slices = deque()
+        for start, end in time_slices(since, until, self._slice_size):
+            tasks = [(query, max(start, q_since), min(end, q_until))
+                     for query, (q_since, q_until) in self._windows.items()
+                     if max(start, q_since) < min(end, q_until)]
+            if tasks:
+                slices.append(tasks)
+        n_slices = len(slices)
+        blk.logger.info("Backfilling {} queries in {} slices".format(
+            len(self._windows), n_slices))
+        # only a couple of requests per worker are queued ahead, so that
+        # results of later slices don't pile up behind a slow one
+        in_flight = deque()
+        queued = 0
+        while (slices or in_flight) and not self._stopped.is_set():
+            while slices and (not in_flight or
+                              queued < 2 * self._max_requests):
+                tasks = slices.popleft()
+                futures = [self._executor.submit(self._fetch, *task)
+                           for task in tasks]
+                in_flight.append((tasks, futures))
+                queued += len(futures)
+            tasks, futures = in_flight.popleft()
+            queued -= len(futures)
+            results = []
+            for (query, _, _), future in zip(tasks, futures):
+                try:
+                    results.append(future.result())
+                except Exception:
+                    # the slice of the query is skipped, not the backfill
+                    blk.logger.exception(
+                        "Backfill of {} failed".format(query))
+                    results.append((query, []))
+            if not self._stopped.is_set():
+                try:
+                    self._notify(results)
+                except Exception:
+                    blk.logger.exception("Notifying a backfill slice failed")
+                for query, _, until in tasks:
+                    blk._backfilled(query, until)
+        if self._stopped.is_set():
+            blk.logger.info("Backfill stopped with {} of {} slices left"
+                            .format(len(slices) + len(in_flight), n_slices))
+        else:
+            blk.logger.info("Backfilled {} posts in {:.1f}s".format(
+                self.posts, monotonic() - started))
+
+    def _fetch(self, query, since, until):
+        """ Fetch the posts of a query within (since, until].
+
+        Failed requests, and responses that can't be read, are retried up
+        to `retry_limit` times, waiting `retry_interval` in between, unless
+        the feed is to be skipped.
+
+        Returns:
+            query (str): The query.
+            posts (list(dict)): Its posts within the window, newest first.
+
+        """
+        blk = self._block
+        posts = []
+        # until is exclusive, paging requests go on from the stalest post
+        page_until = until + 1
+        retries = 0
+        while page_until is not None and not self._stopped.is_set():
+            url = "%s&until=%d" % (blk._query_url(query, since), page_until)
+            try:
+                resp = blk._graph_get(query, url)
+            except Exception:
+                blk.logger.exception(
+                    "Backfill request of {} failed".format(url))
+                blk._record_error(query)
+                resp = None
+            else:
+                if resp is None:
+                    # the app is paused, not the request failing
+                    self._stopped.wait(blk.retry_interval().total_seconds())
+                    continue
+            if resp is not None and resp.status_code == 200:
+                blk._governor.observe(resp.headers)
+                try:
+                    page = decode(resp)['data']
+                    page_posts = [p for p in page
+                                  if since < blk.created_epoch(p) <= until]
+                    stalest = blk.created_epoch(page[-1]) \
+                        if len(page) == blk.limit() else None
+                except Exception:
+                    blk.logger.exception(
+                        "Backfill response of {} could not be read".format(
+                            url))
+                    blk._record_error(query)
+                    resp = None
+                else:
+                    retries = 0
+                    posts.extend(page_posts)
+                    page_until = None
+                    if stalest is not None and since < stalest <= until:
+                        page_until = stalest
+                    continue
+            if resp is not None and blk._failed(query, resp, url):
+                break
+            if retries >= blk.retry_limit():
+                blk.logger.warning(
+                    "Backfill of {} between {} and {} is incomplete".format(
+                        query, since, until))
+                break
+            retries += 1
+            if blk._metrics is not None:
+                blk._metrics.retry(query)
+            self._stopped.wait(blk.retry_interval().total_seconds())
+        return query, posts
+
+    def _notify(self, results):
+        """ Notify the posts of a slice, oldest first. """
+        blk = self._block
+        posts = sorted(((blk.created_epoch(post), query, post)
+                        for query, query_posts in results
+                        for post in query_posts), key=lambda p: p[0])
+        fields = blk.signal_fields()
+        signals = []
+        for _, query, post in posts:
+            if not blk._drop_duplicates([post]):
+                continue
+            blk._track_posts(query, [post])
+            signal = FacebookSignal(post, fields)
+            if blk.include_query():
+                setattr(signal, blk.include_query(), query)
+            signals.append(signal)
+        self.posts += len(signals)
+        if signals:
+            blk.notify_signals(signals)
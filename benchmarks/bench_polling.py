@@ -0,0 +1,227 @@
+""" Throughput, latency and memory benchmarks of the Facebook blocks.
+
+Each scenario polls a local Graph API simulator with a block configured for
+10, 1k and 10k queries, and reports posts per second, the p50 and p99
+latency of its requests, the mean duration of a polling cycle and how much
+the RSS of the process grew over the scenario. Run them with
+
+    python -m pytest benchmarks/bench_polling.py -s
+
+and tune them with environment variables:
+
+- FB_BENCH_QUERIES: comma separated query counts, default "10,1000,10000"
+- FB_BENCH_CYCLES: polling cycles per scenario, default 5
+- FB_BENCH_PAYLOAD: message length of each post, default 200
+- FB_BENCH_OUTPUT: file to which results are appended as JSON lines
+
+"""
+import gc
+import json
+import os
+import resource
+import time
+from datetime import datetime
+from threading import Event, Thread
+
+from nio.testing.block_test_case import NIOBlockTestCase
+
+from ..async_engine import aiohttp
+from ..facebook_block import FacebookBlock
+from ..facebook_feed_block import FacebookFeed
+from ..tests.graph_simulator import GraphSimulator
+from ..token_cache import token_cache
+
+QUERY_COUNTS = [int(n) for n in
+                os.environ.get("FB_BENCH_QUERIES", "10,1000,10000").split(',')]
+CYCLES = int(os.environ.get("FB_BENCH_CYCLES", 5))
+PAYLOAD_SIZE = int(os.environ.get("FB_BENCH_PAYLOAD", 200))
+OUTPUT = os.environ.get("FB_BENCH_OUTPUT")
+
+# every feed has a post every 30s, so a 10 minute lookback finds 20 of them
+POST_RATE = 1 / 30
+LOOKBACK = {"minutes": 10}
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def current_rss():
+    """ Resident set size of the process in bytes, None without /proc. """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class RSSSampler(object):
+
+    """ Samples the RSS of the process while a scenario runs.
+
+    The peak RSS of the process as a whole stays at the peak of the largest
+    scenario so far, so each scenario reports its own peak over the RSS it
+    started from instead.
+
+    """
+
+    def __init__(self, interval=0.01):
+        self._interval = interval
+        self._stopped = Event()
+        self._thread = None
+        self.start_rss = self.peak_rss = None
+
+    def start(self):
+        self.start_rss = self.peak_rss = current_rss()
+        if self.start_rss is not None:
+            self._thread = Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._update()
+
+    def growth_mb(self):
+        if self.start_rss is None:
+            return None
+        return round((self.peak_rss - self.start_rss) / 2 ** 20, 1)
+
+    def _sample(self):
+        while not self._stopped.wait(self._interval):
+            self._update()
+
+    def _update(self):
+        rss = current_rss()
+        if rss is not None and rss > self.peak_rss:
+            self.peak_rss = rss
+
+
+class BenchmarkPolling(NIOBlockTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.signals = 0
+        self.sim = GraphSimulator(post_rate=POST_RATE,
+                                  payload_size=PAYLOAD_SIZE).start()
+        token_cache.clear()
+
+    def tearDown(self):
+        self.sim.stop()
+        super().tearDown()
+
+    def signals_notified(self, block, signals, output_id):
+        # only count signals, keeping them would skew the memory figures
+        self.signals += len(signals)
+
+    def test_feed_round_robin(self):
+        self._bench_feed("round_robin")
+
+    def test_feed_concurrent(self):
+        self._bench_feed("concurrent")
+
+    def test_feed_batch(self):
+        self._bench_feed("batch")
+
+    def test_feed_async(self):
+        if aiohttp is None:
+            self.skipTest("aiohttp is not installed")
+        self._bench_feed("async")
+
+    def test_search_block(self):
+        for n_queries in QUERY_COUNTS:
+            blk = FacebookBlock()
+            blk.GRAPH_URL = self.sim.url
+            blk.TOKEN_URL_FORMAT = self._token_url()
+            self.configure_block(blk, self._config("search", n_queries))
+            lookback = blk._freshest[0]
+
+            def cycle():
+                blk._freshest = [lookback] * n_queries
+                for _ in range(n_queries):
+                    blk.poll()
+            self._run("search", n_queries, blk, cycle)
+            blk.stop()
+
+    def _bench_feed(self, mode):
+        for n_queries in QUERY_COUNTS:
+            blk = FacebookFeed()
+            blk.GRAPH_URL = self.sim.url
+            blk.TOKEN_URL_FORMAT = self._token_url()
+            config = self._config(mode, n_queries)
+            config.update({"poll_mode": mode, "max_workers": 20})
+            self.configure_block(blk, config)
+            if blk._engine is not None:
+                blk._engine.start()
+            lookback = blk._freshest[0]
+
+            def cycle():
+                # every cycle fetches the whole lookback window again
+                blk._freshest = [lookback] * n_queries
+                if mode == "round_robin":
+                    for _ in range(n_queries):
+                        blk.poll()
+                elif mode == "async":
+                    blk._engine.poll().result()
+                else:
+                    blk.poll()
+            self._run("feed_" + mode, n_queries, blk, cycle)
+            blk.stop()
+
+    def _config(self, scenario, n_queries):
+        return {
+            "queries": ["page{}".format(i) for i in range(n_queries)],
+            "lookback": LOOKBACK,
+            "limit": 25,
+            "polling_interval": {"seconds": 0},
+            "dedup_size": 0,
+            # a governor of its own, that never holds the benchmark back
+            "rate_limit": 10 ** 9,
+            "creds": {"consumer_key": "bench-{}-{}".format(
+                scenario, n_queries), "app_secret": "secret"},
+        }
+
+    def _token_url(self):
+        return self.sim.url + "oauth/access_token?client_id={0}" \
+            "&client_secret={1}&grant_type=client_credentials"
+
+    def _run(self, scenario, n_queries, blk, cycle):
+        self.signals = 0
+        latencies = []
+
+        def record_request(query, started):
+            # every mode records each of its requests through the block
+            latencies.append(time.monotonic() - started)
+        blk._record_request = record_request
+        gc.collect()
+        rss = RSSSampler().start()
+        started = time.monotonic()
+        for _ in range(CYCLES):
+            cycle()
+        elapsed = time.monotonic() - started
+        rss.stop()
+        result = {
+            "scenario": scenario,
+            "queries": n_queries,
+            "cycles": CYCLES,
+            "requests": len(latencies),
+            "posts": self.signals,
+            "posts_per_sec": round(self.signals / elapsed, 1),
+            "p50_request_ms": round(1000 * percentile(latencies, 50), 2)
+            if latencies else None,
+            "p99_request_ms": round(1000 * percentile(latencies, 99), 2)
+            if latencies else None,
+            "mean_cycle_ms": round(1000 * elapsed / CYCLES, 1),
+            "rss_growth_mb": rss.growth_mb(),
+            "time": datetime.utcnow().isoformat(),
+        }
+        print("{scenario:>18} {queries:>6} queries {posts:>8} posts "
+              "{posts_per_sec:>10} posts/s request p50 {p50_request_ms:>7} "
+              "p99 {p99_request_ms:>7} ms cycle {mean_cycle_ms:>9} ms "
+              "rss +{rss_growth_mb} MB".format(**result))
+        if OUTPUT:
+            with open(OUTPUT, 'a') as f:
+                f.write(json.dumps(result) + '\n')
@@ -0,0 +1,198 @@
+""" Persistent per-query freshness checkpoints.
+
+Checkpoints are appended as JSON lines to a local file, one record per
+query and feed type, and the latest record of each wins when the file is
+loaded. Records are keyed on the query rather than on the block, so several
+blocks, in one process or in several, can share a file and a query's
+checkpoint follows it from block to block.
+
+"""
+import json
+import os
+from contextlib import contextmanager
+from threading import Lock
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# The file is compacted once it holds more than this many lines per query
+COMPACT_RATIO = 2
+# Feed type of the records written before they recorded one
+DEFAULT_FEED_TYPE = 'feed'
+
+
+class CheckpointStore(object):
+
+    """ Buffers checkpoint records in memory and appends them to a file.
+
+    Updates only touch memory; `flush` writes every record updated since the
+    previous flush in a single append, keeping file writes off the polling
+    path. Superseded records are dropped by compacting the file once they
+    outnumber the live ones.
+
+    Processes sharing the file take turns writing to it through a lock file
+    next to it, where `fcntl` is available. Compaction merges in whatever
+    the other processes appended before rewriting the file, and `reload`
+    picks up their records.
+
+    Params:
+        path (str): The checkpoint file.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._records = {}
+        self._dirty = set()
+        self._lines = 0
+        self._lock = Lock()
+        self._write_lock = Lock()
+        with self._file_lock():
+            self._load()
+
+    def get(self, query, feed_type):
+        """ The latest checkpoint record of `query`'s feed, or None. """
+        with self._lock:
+            return self._records.get((query, feed_type))
+
+    def update(self, query, feed_type, record):
+        """ Record the state of `query`, to be written on the next flush.
+
+        Args:
+            query (str): The query the record belongs to.
+            feed_type (str): The feed of the query that was polled.
+            record (dict): JSON serializable state, with at least a
+                `freshest` epoch.
+
+        """
+        with self._lock:
+            self._records[(query, feed_type)] = record
+            self._dirty.add((query, feed_type))
+
+    def flush(self):
+        """ Append the records updated since the last flush to the file.
+
+        The file is rewritten with only the latest record of each query
+        instead, once appending would take it past `COMPACT_RATIO` lines
+        per query.
+
+        """
+        with self._file_lock():
+            with self._lock:
+                lines = [self._dumps(key, self._records[key])
+                         for key in self._dirty]
+                self._dirty.clear()
+                n_records = len(self._records)
+            if not lines:
+                return
+            if self._lines + len(lines) > COMPACT_RATIO * n_records:
+                self._load(compact=True)
+                return
+            with open(self.path, 'a') as f:
+                f.write('\n'.join(lines) + '\n')
+            self._lines += len(lines)
+
+    def reload(self):
+        """ Merge in the records other processes wrote to the file. """
+        with self._file_lock():
+            self._load()
+
+    def _load(self, compact=False):
+        """ Read the file, keeping the freshest record of each query.
+
+        The file is compacted to a single record per query when it holds
+        many superseded records, or a partial record left behind by an
+        interrupted write. Must be called holding the file lock.
+
+        Args:
+            compact (bool): Whether to compact the file in any case.
+
+        """
+        records = {}
+        lines = 0
+        partial = False
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        key = (record.pop('query'),
+                               record.pop('feed_type', DEFAULT_FEED_TYPE))
+                    except (ValueError, KeyError):
+                        partial = True
+                        continue
+                    lines += 1
+                    current = records.get(key)
+                    if current is None or \
+                            record['freshest'] >= current['freshest']:
+                        records[key] = record
+        with self._lock:
+            # records updated in memory since stay, unless the file has
+            # fresher ones
+            for key, record in records.items():
+                current = self._records.get(key)
+                if current is None or \
+                        record['freshest'] > current['freshest']:
+                    self._records[key] = record
+            self._lines = lines
+            if compact or partial or lines > COMPACT_RATIO * len(
+                    self._records):
+                records = dict(self._records)
+            else:
+                records = None
+        if records is not None:
+            self._compact(records)
+
+    def _compact(self, records):
+        """ Replace the file with a single record per query. """
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, 'w') as f:
+            for key, record in records.items():
+                f.write(self._dumps(key, record) + '\n')
+        os.replace(tmp_path, self.path)
+        self._lines = len(records)
+
+    @contextmanager
+    def _file_lock(self):
+        """ Hold the lock on writing the file, within and across processes.
+
+        """
+        with self._write_lock:
+            if fcntl is None:
+                yield
+                return
+            with open("{}.lock".format(self.path), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _dumps(key, record):
+        query, feed_type = key
+        return json.dumps(dict(record, query=query, feed_type=feed_type))
+
+
+_stores = {}
+_stores_lock = Lock()
+
+
+def checkpoint_store(path):
+    """ The store of the checkpoint file at `path`, shared in the process.
+
+    A store that was already open is reloaded, so that blocks configured
+    later, e.g. the new owner of a shard, resume from what blocks of other
+    processes wrote in the meantime.
+
+    """
+    path = os.path.abspath(path)
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = CheckpointStore(path)
+            return store
+    store.reload()
+    return store
@@ -0,0 +1,166 @@
+""" A process wide layer that coalesces Graph API polling requests.
+
+Blocks polling the same feed at around the same time share their requests:
+while a request is in flight, identical requests of other blocks wait for
+its response instead of being sent, and successful responses are served
+from a short lived cache afterwards. Requests of a feed are made with the
+largest limit any block asked for, and each block still filters the shared
+posts against its own freshness and limit.
+
+"""
+import re
+from concurrent.futures import Future
+from threading import Lock
+from time import monotonic
+
+from nio.properties import PropertyHolder, BoolProperty, TimeDeltaProperty
+
+_ACCESS_TOKEN = re.compile(r'access_token=[^&]*&?')
+_LIMIT = re.compile(r'([?&])limit=\d+')
+
+
+class Coalescing(PropertyHolder):
+
+    """ Property holder for sharing requests with other blocks.
+
+    """
+    enabled = BoolProperty(title='Enabled', default=False)
+    ttl = TimeDeltaProperty(title='Cache TTL', default={"seconds": 5})
+    window = TimeDeltaProperty(title='Window', default={"seconds": 60})
+
+
+def coalesce_key(url, app_id=None):
+    """ The key of a request url, leaving out the access token.
+
+    Blocks authenticate with tokens of their own, which don't change what
+    the Graph API answers for public feeds, but requests count towards the
+    rate limit of their app, so only requests of the same app are shared.
+
+    """
+    return app_id, _ACCESS_TOKEN.sub('', url).rstrip('&?')
+
+
+def with_limit(url, limit):
+    """ The url with its `limit` parameter set to `limit`. """
+    return _LIMIT.sub(r'\g<1>limit={}'.format(limit), url, count=1)
+
+
+def window_start(since, window):
+    """ Round `since` down to the start of its window.
+
+    Polling from the start of the window rather than from a block's own
+    freshest post makes requests of blocks at different points of the same
+    window identical. The response then holds a few posts the block has
+    already seen, which it filters out like any other stale post.
+
+    Args:
+        since (int): Epoch of the block's freshest post.
+        window (int): Length of the windows in seconds, 0 leaves `since`
+            alone.
+
+    """
+    if window <= 0:
+        return since
+    return since - since % int(window)
+
+
+class RequestCoalescer(object):
+
+    """ Shares in-flight requests and caches their responses, by key.
+
+    Responses must be fully read, e.g. `GraphResponse` objects, since every
+    caller reads them.
+
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._in_flight = {}
+        self._cache = {}
+        self._limits = {}
+        self._next_sweep = 0
+        self.requests = 0
+        self.shared = 0
+
+    def get(self, key, fetch, ttl=0):
+        """ Get the response for `key`, fetching it only if necessary.
+
+        Args:
+            key (hashable): Identifies the request, see `coalesce_key`.
+            fetch (callable): Makes the request and returns the response,
+                or None if it skipped the request.
+            ttl (float): Seconds a successful response is cached for.
+
+        Returns:
+            resp (GraphResponse): The response, or None.
+            shared (bool): Whether it was the response to another caller's
+                request.
+
+        Raises:
+            Exception: Whatever the request raised, for the caller that made
+                it and for every caller that waited on it.
+
+        """
+        now = monotonic()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[0] > now:
+                self.shared += 1
+                return entry[1], True
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self._in_flight[key] = Future()
+                self.requests += 1
+            else:
+                self.shared += 1
+        if not owner:
+            return future.result(), True
+        try:
+            resp = fetch()
+        except Exception as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._in_flight[key]
+            if ttl > 0 and resp is not None and resp.status_code == 200:
+                self._cache[key] = (monotonic() + ttl, resp)
+            self._sweep(now)
+        future.set_result(resp)
+        return resp, False
+
+    def limit(self, feed, limit):
+        """ The limit to request a feed with, so that requests for it are
+        identical whatever the limit of the block making them.
+
+        Args:
+            feed (hashable): Identifies the feed, e.g. (app id, query).
+            limit (int): The limit of the block requesting the feed.
+
+        Returns:
+            limit (int): The largest limit asked for the feed so far.
+
+        """
+        with self._lock:
+            limit = self._limits[feed] = max(limit,
+                                             self._limits.get(feed, 0))
+            return limit
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._limits.clear()
+
+    def _sweep(self, now):
+        """ Drop expired responses, at most once a second. """
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + 1
+        for key in [k for k, (expires_at, _) in self._cache.items()
+                    if expires_at <= now]:
+            del self._cache[key]
+
+
+request_coalescer = RequestCoalescer()
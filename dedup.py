@@ -0,0 +1,60 @@
+""" A memory bounded index of recently seen post ids.
+
+"""
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class PostIndex(object):
+
+    """ Remembers post ids for a while, to recognize repeated posts.
+
+    Ids are kept in least recently seen order. The index never holds more
+    than `max_size` ids, and ids that haven't been seen for `ttl` seconds
+    are forgotten, so memory stays bounded however long the block runs.
+
+    Params:
+        max_size (int): Maximum number of ids remembered.
+        ttl (float): Seconds an id is remembered after it was last seen.
+
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._ids = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def seen(self, post_id):
+        """ Whether `post_id` was seen already. Records it either way. """
+        with self._lock:
+            now = monotonic()
+            self._expire(now)
+            seen = post_id in self._ids
+            if seen:
+                self.hits += 1
+                self._ids.move_to_end(post_id)
+            else:
+                self.misses += 1
+            self._ids[post_id] = now
+            if len(self._ids) > self.max_size:
+                self._ids.popitem(last=False)
+                self.evictions += 1
+            return seen
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._ids), "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+    def _expire(self, now):
+        while self._ids:
+            post_id, last_seen = next(iter(self._ids.items()))
+            if now - last_seen < self.ttl:
+                break
+            del self._ids[post_id]
+            self.evictions += 1
@@ -0,0 +1,57 @@
+""" Buffering of outgoing signals into fewer, larger notifications. """
+from threading import Lock
+
+from nio.modules.scheduler import Job
+
+
+class EmissionBuffer(object):
+
+    """ Groups signals and hands them over in batches.
+
+    Signals are flushed once `max_size` of them are buffered, or when the
+    oldest of them has waited `max_latency`, whichever comes first. Signals
+    are flushed in the order they were added, so posts of a query keep
+    their order across pages and polls.
+
+    Params:
+        notify (callable): Called with each batch of signals.
+        max_size (int): Number of buffered signals that triggers a flush.
+        max_latency (timedelta): Longest time a signal stays buffered.
+
+    """
+
+    def __init__(self, notify, max_size, max_latency):
+        self._notify = notify
+        self._max_size = max_size
+        self._max_latency = max_latency
+        self._signals = []
+        self._job = None
+        self._lock = Lock()
+        # held from taking a batch until it is notified, so that batches
+        # taken by the size check and by the timer cannot swap places
+        self._flush_lock = Lock()
+
+    def add(self, signals):
+        """ Buffer `signals`, flushing if the buffer is full. """
+        with self._lock:
+            self._signals.extend(signals)
+            full = len(self._signals) >= self._max_size
+            if not full and self._job is None and self._signals:
+                self._job = Job(self.flush, self._max_latency, False)
+        if full:
+            self.flush()
+
+    def flush(self):
+        """ Notify every buffered signal now. """
+        with self._flush_lock:
+            with self._lock:
+                signals, self._signals = self._signals, []
+                if self._job is not None:
+                    self._job.cancel()
+                    self._job = None
+            if signals:
+                self._notify(signals)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._signals)
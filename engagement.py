@@ -0,0 +1,171 @@
+""" Tracking of the engagement counts of posts after they were notified.
+
+Posts are only notified once, when they are fresh. To follow how their
+like, comment and share counts change afterwards, recent posts are kept in
+a bounded index with their last known counts, and refreshed in bulk with
+multi-id lookups, see
+https://developers.facebook.com/docs/graph-api/using-graph-api
+#multiple-ids-lookup
+
+"""
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+from nio.properties import (PropertyHolder, BoolProperty, IntProperty,
+                            ListProperty, TimeDeltaProperty)
+from nio.types import StringType
+
+# The Graph API accepts at most this many ids per lookup
+IDS_LIMIT = 50
+
+
+class Engagement(PropertyHolder):
+
+    """ Property holder for tracking the engagement of notified posts.
+
+    """
+    enabled = BoolProperty(title='Enabled', default=False)
+    edges = ListProperty(StringType, title='Summary Edges',
+                         default=['likes', 'comments'])
+    max_posts = IntProperty(title='Max Tracked Posts', default=1000)
+    min_interval = TimeDeltaProperty(title='Min Refresh Interval',
+                                     default={"minutes": 1})
+    max_interval = TimeDeltaProperty(title='Max Refresh Interval',
+                                     default={"hours": 1})
+    track_for = TimeDeltaProperty(title='Track For', default={"days": 1})
+
+
+def engagement_counts(post, edges):
+    """ The engagement counts of a post.
+
+    Args:
+        post (dict): The post, as returned by the Graph API.
+        edges (list(str)): Edges whose summary total count is tracked. The
+            share count is always tracked.
+
+    Returns:
+        counts (dict): The count of each edge and of shares, or None if the
+            post does not have the summary of every edge.
+
+    """
+    counts = {}
+    for edge in edges:
+        summary = (post.get(edge) or {}).get('summary')
+        if summary is None:
+            return None
+        counts[edge] = summary.get('total_count', 0)
+    # posts that were never shared have no shares field at all
+    counts['shares'] = (post.get('shares') or {}).get('count', 0)
+    return counts
+
+
+class _Tracked(object):
+
+    __slots__ = ('query', 'created', 'counts', 'interval', 'due')
+
+    def __init__(self, query, created, counts, interval, due):
+        self.query = query
+        self.created = created
+        self.counts = counts
+        self.interval = interval
+        self.due = due
+
+
+class EngagementTracker(object):
+
+    """ The last known counts of recent posts, and when to refresh them.
+
+    Each post is refreshed on a schedule of its own that decays while its
+    counts stay put: the interval doubles after every refresh that found no
+    change, up to `max_interval`, and goes back to `min_interval` as soon as
+    one did. Posts are dropped once they are older than `track_for`, and the
+    oldest tracked post makes room when `max_posts` are tracked.
+
+    Params:
+        max_posts (int): Maximum number of posts tracked.
+        min_interval (float): Shortest refresh interval, in seconds.
+        max_interval (float): Longest refresh interval, in seconds.
+        track_for (float): Seconds after its creation a post is tracked for.
+
+    """
+
+    def __init__(self, max_posts, min_interval, max_interval, track_for):
+        self.max_posts = max_posts
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.track_for = track_for
+        self._posts = OrderedDict()
+        self._lock = Lock()
+
+    def track(self, post_id, query, created, counts, now=None):
+        """ Start tracking a post.
+
+        Args:
+            post_id (str): Id of the post.
+            query (str): The query the post was found by.
+            created (int): Creation time of the post, as a unix timestamp.
+            counts (dict): Its current counts, or None if they are unknown,
+                in which case the first refresh only records them.
+            now (float): Current unix time, defaults to now.
+
+        """
+        now = time() if now is None else now
+        if created + self.track_for <= now:
+            return
+        with self._lock:
+            if post_id in self._posts:
+                return
+            self._posts[post_id] = _Tracked(
+                query, created, counts, self.min_interval,
+                now + self.min_interval)
+            if len(self._posts) > self.max_posts:
+                self._posts.popitem(last=False)
+
+    def due(self, now=None):
+        """ Ids of the posts due for a refresh, dropping expired posts. """
+        now = time() if now is None else now
+        with self._lock:
+            for post_id in [post_id for post_id, tracked in self._posts.items()
+                            if tracked.created + self.track_for <= now]:
+                del self._posts[post_id]
+            return [post_id for post_id, tracked in self._posts.items()
+                    if tracked.due <= now]
+
+    def update(self, post_id, counts, now=None):
+        """ Record the refreshed counts of a post.
+
+        Returns:
+            query (str): The query the post was found by.
+            deltas (dict): The change of every count that changed since the
+                last refresh. Empty if none did, or if the counts were not
+                known before.
+
+        """
+        now = time() if now is None else now
+        with self._lock:
+            tracked = self._posts.get(post_id)
+            if tracked is None:
+                return None, {}
+            deltas = {}
+            if tracked.counts is not None and counts is not None:
+                deltas = {k: v - tracked.counts.get(k, 0)
+                          for k, v in counts.items()
+                          if v != tracked.counts.get(k, 0)}
+            if deltas:
+                tracked.interval = self.min_interval
+            else:
+                tracked.interval = min(tracked.interval * 2,
+                                       self.max_interval)
+            if counts is not None:
+                tracked.counts = counts
+            tracked.due = now + tracked.interval
+            return tracked.query, deltas
+
+    def forget(self, post_id):
+        with self._lock:
+            self._posts.pop(post_id, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._posts)
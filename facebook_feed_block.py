@@ -1,14 +1,44 @@
-import requests
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from enum import Enum
 from datetime import datetime
+from threading import Lock
+from time import monotonic, sleep
 
+from nio.block.terminals import output
+from nio.command import command
+from nio.modules.scheduler import Job
 from nio.util.discovery import discoverable
+from nio.signal.base import Signal
 from nio.properties import (StringProperty, ObjectProperty, PropertyHolder,
+                            Property,
                             SelectProperty, TimeDeltaProperty, IntProperty,
-                            VersionProperty)
-from nio.signal.base import Signal
-
-from .rest_polling.rest_block import RESTPolling
+                            BoolProperty, VersionProperty)
+
+from .adaptive import AdaptiveSchedule
+from .async_engine import AsyncPollingEngine
+from .backfill import Backfill, BackfillEngine
+from .checkpoint import checkpoint_store
+from .coalesce import (Coalescing, coalesce_key, request_coalescer,
+                       window_start, with_limit)
+from .graph_batch import (BATCH_LIMIT, GraphResponse, batch_payload,
+                          split_batch_response)
+from .engagement import (IDS_LIMIT, Engagement, EngagementTracker,
+                         engagement_counts)
+from .facebook_signal import FacebookSignal
+from .graph_fields import fields_param
+from .graph_core import GraphCore, PagingMode
+from .graph_json import decode
+from .sharding import shard_of, shard_queries
+from .stream_json import iter_response
+from .webhook import Webhook, WebhookServer
+
+
+# Number of post ids remembered per query to recognize already seen posts
+RECENT_IDS = 100
+# Size of the chunks in which response bodies are decoded when streaming
+STREAM_CHUNK_SIZE = 16 * 1024
 
 
 class FeedType(Enum):
@@ -18,28 +48,35 @@ class FeedType(Enum):
     PROMOTABLE_POSTS = 'promotable_posts'
 
 
-class Creds(PropertyHolder):
+class PollMode(Enum):
+    ROUND_ROBIN = 'round_robin'
+    CONCURRENT = 'concurrent'
+    BATCH = 'batch'
+    ASYNC = 'async'
 
-    """ Property holder for Facebook credentials.
 
-    """
-    consumer_key = StringProperty(title='App ID',
-                                  default='[[FACEBOOK_APP_ID]]')
-    app_secret = StringProperty(
-        title='App Secret',
-        default='[[FACEBOOK_APP_SECRET]]')
+class QueryControl(PropertyHolder):
 
+    """ Property holder for adding and removing queries with signals.
 
-class FacebookSignal(Signal):
-
-    def __init__(self, data):
-        super().__init__()
-        for k in data:
-            setattr(self, k, data[k])
-
+    Both expressions may evaluate to a single query or a list of them.
 
+    """
+    enabled = BoolProperty(title='Enabled', default=False)
+    add = Property(title='Queries to Add', default='{{ $add_queries }}',
+                   allow_none=True)
+    remove = Property(title='Queries to Remove',
+                      default='{{ $remove_queries }}', allow_none=True)
+
+
+@output('engagement', label='Engagement')
+@output('stats', label='Stats')
+@output('default', default=True, label='Default')
+@command('stats')
+@command('connection_stats')
+@command('dedup_stats')
 @discoverable
-class FacebookFeed(RESTPolling):
+class FacebookFeed(GraphCore):
 
     """ This block polls the Facebook Graph API, using the feed endpoint
 
@@ -51,159 +88,805 @@ class FacebookFeed(RESTPolling):
             very first request.
 
     """
-    URL_FORMAT = ("https://graph.facebook.com/v2.2/"
-                  "{}/{}?since={}&limit={}")
-    TOKEN_URL_FORMAT = ("https://graph.facebook.com/oauth"
-                        "/access_token?client_id={0}&client_secret={1}"
-                        "&grant_type=client_credentials")
-
-    creds = ObjectProperty(Creds, title='Credentials', default=Creds())
-    lookback = TimeDeltaProperty(title='Lookback', default={"seconds": 0})
-    limit = IntProperty(title='Limit (per poll)', default=10)
+    RELATIVE_URL_FORMAT = "{}/{}?since={}&limit={}"
+
+    webhook = ObjectProperty(Webhook, title='Webhook', default=Webhook())
+    query_control = ObjectProperty(QueryControl, title='Query Control',
+                                   default=QueryControl())
+    backfill = ObjectProperty(Backfill, title='Backfill', default=Backfill())
+    coalescing = ObjectProperty(Coalescing, title='Request Coalescing',
+                                default=Coalescing())
+    engagement = ObjectProperty(Engagement, title='Engagement Tracking',
+                                default=Engagement())
     feed_type = SelectProperty(FeedType, default=FeedType.FEED,
                                title='Feed Type')
-    version = VersionProperty("1.0.2")
+    poll_mode = SelectProperty(PollMode, default=PollMode.ROUND_ROBIN,
+                               title='Poll Mode')
+    max_workers = IntProperty(title='Max Concurrent Requests', default=10)
+    stream_decode = BoolProperty(title='Streaming Decode', default=False)
+    adaptive_polling = BoolProperty(title='Adaptive Polling', default=False)
+    max_polling_interval = TimeDeltaProperty(title='Max Polling Interval',
+                                             default={"seconds": 3600})
+    checkpoint_file = StringProperty(title='Checkpoint File', default='',
+                                     allow_none=True)
+    checkpoint_interval = TimeDeltaProperty(title='Checkpoint Interval',
+                                            default={"seconds": 10})
+    shard_index = IntProperty(title='Shard Index', default=0)
+    shard_count = IntProperty(title='Shard Count', default=1)
+    version = VersionProperty("1.1.0")
 
     def __init__(self):
         super().__init__()
-        self._url = None
-        self._paging_field = "paging"
-        self._created_field = "created_time"
-        self._access_token = None
+        self._queries = []
+        self._executor = None
+        self._engine = None
+        self._schedule = None
+        self._cycle_started = None
+        self._checkpoints = None
+        self._checkpoint_job = None
+        self._seen = {}
+        self._cycle_lock = Lock()
+        self._webhook = None
+        self._backfill = None
+        self._backfilling = {}
+        self._coalesce = False
+        self._tracker = None
+        self._engagement_job = None
+        self._engagement_lock = Lock()
+        self._query_changes = []
+        self._query_lock = Lock()
 
     def configure(self, context):
         super().configure(context)
+        self._queries = shard_queries(
+            self.queries(), self.shard_index(), self.shard_count())
+        if self.shard_count() > 1:
+            self.logger.info("Shard {} of {} polls {} of {} queries".format(
+                self.shard_index(), self.shard_count(), len(self._queries),
+                len(self.queries())))
+        self._n_queries = len(self._queries)
+        for attr in ('_etags', '_modifieds', '_freshest', '_prev_freshest',
+                     '_prev_stalest'):
+            setattr(self, attr, [None] * self._n_queries)
         lb = self._unix_time(datetime.utcnow() - self.lookback())
         self._freshest = [lb] * self._n_queries
-
-    def _authenticate(self):
+        if self.webhook().enabled():
+            webhook = self.webhook()
+            self._webhook = WebhookServer(
+                webhook.host(), webhook.port(), webhook.path(),
+                webhook.verify_token(), self.creds().app_secret(),
+                self._on_webhook_posts, self.logger)
+        if self.checkpoint_file():
+            self._checkpoints = checkpoint_store(self.checkpoint_file())
+            self._restore_checkpoints()
+        if self.backfill().enabled():
+            self._backfill = self._backfill_engine()
+        if self.engagement().enabled():
+            engagement = self.engagement()
+            if engagement.min_interval().total_seconds() <= 0:
+                raise ValueError(
+                    "The engagement refresh interval must be positive")
+            self._tracker = EngagementTracker(
+                engagement.max_posts(),
+                engagement.min_interval().total_seconds(),
+                engagement.max_interval().total_seconds(),
+                engagement.track_for().total_seconds())
+        if self.poll_mode() in (PollMode.CONCURRENT, PollMode.BATCH):
+            # threads are only spawned by the executor once work is submitted
+            self._executor = ThreadPoolExecutor(
+                max_workers=max(1, self.max_workers()))
+        elif self.poll_mode() is PollMode.ASYNC:
+            connection = self.connection()
+            self._engine = AsyncPollingEngine(
+                self, max_requests=max(1, self.max_workers()),
+                timeout=(connection.connect_timeout().total_seconds(),
+                         connection.read_timeout().total_seconds()))
+        if self.adaptive_polling():
+            if self.poll_mode() is PollMode.ROUND_ROBIN:
+                self.logger.warning(
+                    "Adaptive polling is not available in round robin mode")
+            else:
+                self._schedule = AdaptiveSchedule(
+                    self.polling_interval().total_seconds(),
+                    self.max_polling_interval().total_seconds())
+        if self.coalescing().enabled():
+            if self.poll_mode() is PollMode.CONCURRENT:
+                self._coalesce = True
+            else:
+                self.logger.warning(
+                    "Request coalescing is only available in concurrent mode")
+
+    def start(self):
+        if self._engine is not None:
+            self._engine.start()
+        if self._webhook is not None:
+            self._webhook.start()
+            self.logger.info("Receiving webhook notifications on port {}"
+                             .format(self._webhook.port))
+        if self._backfill is not None:
+            self._backfill.start()
+        if self._tracker is not None:
+            self._engagement_job = Job(self._refresh_engagement,
+                                       self.engagement().min_interval(), True)
+        if self._checkpoints is not None:
+            self._checkpoint_job = Job(self._checkpoints.flush,
+                                       self.checkpoint_interval(), True)
+        super().start()
+
+    def _shutdown(self):
+        """ Overridden from GraphCore, to stop the block's workers. """
+        if self._checkpoint_job is not None:
+            self._checkpoint_job.cancel()
+        if self._engagement_job is not None:
+            self._engagement_job.cancel()
+        if self._webhook is not None:
+            self._webhook.stop()
+        if self._backfill is not None:
+            self._backfill.stop()
+        if self._checkpoints is not None:
+            self._checkpoints.flush()
+        if self._engine is not None:
+            self._engine.stop()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def poll(self, paging=False, *args, **kwargs):
         """ Overridden from the RESTPolling block.
 
-        Generates and records the access token for pending requests.
+        In round robin mode each call polls the current query only. In
+        concurrent mode each call polls every query at once, paging
+        included, over a bounded pool of workers. Batch mode does the same
+        but packs up to `BATCH_LIMIT` queries into each request, and async
+        mode does it with coroutines on the `AsyncPollingEngine` loop.
 
         """
-        if self.creds().consumer_key() is None or \
-                self.creds().app_secret() is None:
-            self.logger.error("You need a consumer key and app secret, yo")
+        if paging or self.poll_mode() is PollMode.ROUND_ROBIN:
+            if not paging:
+                self._apply_query_changes()
+            super().poll(paging, *args, **kwargs)
+            return
+        self._authenticate()
+        if self.poll_mode() is PollMode.BATCH:
+            self._poll_batch()
+        elif self.poll_mode() is PollMode.ASYNC:
+            self._engine.poll()
         else:
-            self._access_token = self._request_access_token()
+            self._poll_all()
+
+    def _poll_all(self):
+        """ Poll every configured query concurrently.
+
+        A polling cycle that is still running when the next one is due causes
+        the new one to be skipped, rather than piling up requests.
+
+        """
+        if not self._cycle_lock.acquire(blocking=False):
+            self.logger.warning(
+                "Previous polling cycle still in progress, skipping")
+            return
+        try:
+            self._apply_query_changes()
+            futures = {self._executor.submit(self._poll_query, idx): idx
+                       for idx in self._due_queries()}
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    self.logger.error(
+                        "Polling of {} failed".format(
+                            self._queries[futures[future]]),
+                        exc_info=future.exception())
+        finally:
+            self._cycle_lock.release()
+
+    def _poll_query(self, idx):
+        """ Poll a single query, following paging requests as needed.
 
-    def _process_response(self, resp):
-        """ Extract fresh posts from the Facebook graph api response object.
+        Freshness is tracked on `self._freshest[idx]` and paging state is
+        local to the call, so queries never share state with each other.
+        Failed requests are retried up to `retry_limit` times, waiting
+        `retry_interval` in between, unless the feed is to be skipped.
 
         Args:
-            resp (Response)
+            idx (int): Index of the query in the `queries` list.
 
-        Returns:
-            signals (list(Signal)): The list of signals to notify, each of
-                which corresponds to a fresh FB post.
-            paging (bool): Denotes whether or not paging requests are
-                necessary.
+        """
+        query = self._queries[idx]
+        since = self._freshest[idx]
+        url = self._first_page_url(query, since)
+        headers = {"Content-Type": "application/json"}
+        page = 1
+        retries = 0
+        while url is not None:
+            request_headers = headers
+            if page == 1:
+                request_headers = dict(
+                    self._conditional_headers(query, url), **headers)
+            try:
+                resp = self._get(query, url, request_headers)
+            except Exception:
+                self.logger.exception(
+                    "Polling request of {} failed".format(url))
+                self._record_error(query)
+            else:
+                if resp is None:
+                    return
+                if resp.status_code in (200, 304):
+                    try:
+                        signals, url = self._process_query_response(
+                            idx, resp, since, url, page)
+                    finally:
+                        # streamed responses may be left partially read
+                        resp.close()
+                    self._notify_query_signals(query, signals)
+                    retries = 0
+                    page += 1
+                    continue
+                if self._failed(query, resp, url):
+                    return
+            if retries >= self.retry_limit():
+                return
+            retries += 1
+            if self._metrics is not None:
+                self._metrics.retry(query)
+            sleep(self.retry_interval().total_seconds())
+            if page == 1:
+                # with the access token the failure may have replaced
+                url = self._first_page_url(query, since)
+
+    def _first_page_url(self, query, since):
+        """ The url of the first page of a query in `_poll_query`. """
+        if self._coalesce:
+            return self._query_url(query, window_start(
+                since, self.coalescing().window().total_seconds()))
+        return self._query_url(query, since)
+
+    def _get(self, query, url, headers):
+        """ Make a polling request of `_poll_query`.
+
+        With coalescing enabled, the request is shared with every block of
+        the process making the same request, and responses that were shared
+        neither count towards the rate limit nor are recorded as requests.
+        The request is made with the largest limit of the blocks polling
+        the feed, and the posts beyond the block's own limit are cut off,
+        unless paging by cursor, which only points past the whole page.
+        Returns None if the rate governor skipped the request.
 
         """
-        signals = []
-        resp = resp.json()
-        fresh_posts = posts = resp['data']
-        paging = resp.get(self._paging_field) is not None
-        self.logger.debug("Facebook response contains %d posts" % len(posts))
+        if not self._coalesce:
+            return self._graph_get(query, url, headers, self.stream_decode())
+        app_id = self.creds().consumer_key()
+        limit = request_coalescer.limit(
+            (app_id, query, self.feed_type().value), self.limit())
+        url = with_limit(url, limit)
+
+        def fetch():
+            resp = self._graph_get(query, url, headers)
+            if resp is None:
+                return None
+            return GraphResponse(resp.status_code, dict(resp.headers),
+                                 resp.text)
+        resp, shared = request_coalescer.get(
+            coalesce_key(url, app_id), fetch,
+            self.coalescing().ttl().total_seconds())
+        if shared and self._metrics is not None:
+            self._metrics.coalesced(query)
+        if resp is not None and resp.status_code == 200 and \
+                limit > self.limit() and \
+                self.paging_mode() is PagingMode.UNTIL:
+            body = decode(resp)
+            if len(body.get('data', [])) > self.limit():
+                body['data'] = body['data'][:self.limit()]
+                resp = GraphResponse(resp.status_code, resp.headers,
+                                     json.dumps(body))
+        return resp
+
+    def _poll_batch(self):
+        """ Poll every configured query through Graph API batch requests.
+
+        Queries are packed `BATCH_LIMIT` at a time into batch requests that
+        are sent concurrently. Paging requests are collected and sent as
+        further batches until no query needs another page. Failed queries
+        are left to the next polling cycle rather than retried.
 
-        # we shouldn't see empty responses, but we'll protect our necks.
-        if len(posts) > 0:
-            self.update_freshness(posts)
-            fresh_posts = self.find_fresh_posts(posts)
-            paging = len(fresh_posts) == self.limit()
+        """
+        if not self._cycle_lock.acquire(blocking=False):
+            self.logger.warning(
+                "Previous polling cycle still in progress, skipping")
+            return
+        try:
+            self._apply_query_changes()
+            pending = [(idx, self._freshest[idx],
+                        self._relative_url(self._queries[idx],
+                                           self._freshest[idx]), 1)
+                       for idx in self._due_queries()]
+            while pending:
+                futures = {
+                    self._executor.submit(self._poll_batch_chunk,
+                                          pending[i:i + BATCH_LIMIT]):
+                    pending[i:i + BATCH_LIMIT]
+                    for i in range(0, len(pending), BATCH_LIMIT)}
+                pending = []
+                for future in as_completed(futures):
+                    # a chunk that failed leaves the other chunks paging
+                    if future.exception() is not None:
+                        self.logger.error(
+                            "Batch polling of {} failed".format(
+                                [self._queries[idx]
+                                 for idx, _, _, _ in futures[future]]),
+                            exc_info=future.exception())
+                        continue
+                    pending.extend(future.result())
+        finally:
+            self._cycle_lock.release()
+
+    def _poll_batch_chunk(self, chunk):
+        """ Send a single batch request and process each of its results.
 
-            # store the timestamp of the oldest fresh post for use in url
-            # preparation later.
-            if len(fresh_posts) > 0:
-                self.prev_stalest = self.created_epoch(fresh_posts[-1])
+        Args:
+            chunk (list(tuple)): (idx, since, relative_url, page) of each
+                query in the batch, where `since` is the epoch of the query's
+                freshest post at the start of the cycle and `page` counts the
+                requests made for the query during the cycle.
 
-        signals = [FacebookSignal(p) for p in fresh_posts]
-        self.logger.debug("Found %d fresh posts" % len(signals))
+        Returns:
+            paging (list(tuple)): The chunk entries for queries that need
+                another page.
 
-        return signals, paging
+        """
+        paging = []
+        payload = batch_payload(
+            [url for _, _, url, _ in chunk], self._access_token,
+            [self._conditional_headers(self._queries[idx], url)
+             if page == 1 else None for idx, _, url, page in chunk])
+        # every request of a batch counts towards the rate limit, and every
+        # query of the batch waits for the whole batch
+        try:
+            resp = self._graph_request(
+                'post', [self._queries[idx] for idx, _, _, _ in chunk],
+                self._graph_url, data=payload)
+        except Exception:
+            self.logger.exception("Batch request failed")
+            return paging
+        if resp is None:
+            return paging
+        if resp.status_code != 200:
+            self._failed("batch", resp, self._graph_url)
+            return paging
+        self._governor.observe(resp.headers)
+        items = split_batch_response(resp)
+        for (idx, since, url, page), item in zip(chunk, items):
+            query = self._queries[idx]
+            if item is None:
+                self.logger.warning(
+                    "Batched request of {} did not complete".format(url))
+                continue
+            if item.status_code not in (200, 304):
+                self._failed(query, item, url)
+                continue
+            signals, paging_url = self._process_query_response(
+                idx, item, since, url, page)
+            self._notify_query_signals(query, signals)
+            if paging_url is not None:
+                if paging_url.startswith(self._graph_url):
+                    # cursors come back as absolute urls
+                    paging_url = paging_url[len(self._graph_url):]
+                paging.append((idx, since, paging_url, page + 1))
+        return paging
+
+    def _backfill_engine(self):
+        """ Hand the window up to now of every query over to a backfill.
+
+        Live polling starts from now, and the backfill fetches what came
+        before, from the lookback window or the query's checkpoint, on its
+        own threads. Until a query's backfill is complete, its checkpoint
+        stays at what the backfill has fetched so far.
 
-    def _request_access_token(self):
-        """ Request an access token directly from facebook.
+        """
+        now = self._unix_time(datetime.utcnow())
+        windows = {}
+        for idx, query in enumerate(self._queries):
+            if self._freshest[idx] < now:
+                windows[query] = (self._freshest[idx], now)
+                self._backfilling[query] = windows[query]
+                self._freshest[idx] = now
+        backfill = self.backfill()
+        return BackfillEngine(self, windows,
+                              backfill.slice_size().total_seconds(),
+                              max(1, backfill.max_workers()))
+
+    def _due_queries(self):
+        """ Indexes of the queries to poll in this polling cycle.
+
+        Every query is polled on every cycle, unless adaptive polling is
+        enabled, in which case only queries whose own interval has elapsed
+        are. Records the start of the cycle, which the intervals of the
+        queries polled in it count from.
 
-        Args:
-            None
+        """
+        if self._schedule is None:
+            return list(range(self._n_queries))
+        self._cycle_started = monotonic()
+        return [idx for idx, query in enumerate(self._queries)
+                if self._schedule.due(query, self._cycle_started)]
+
+    def _restore_checkpoints(self, queries=None):
+        """ Resume each query from its checkpoint, if it has one. """
+        for idx, query in enumerate(self._queries):
+            if queries is not None and query not in queries:
+                continue
+            record = self._checkpoints.get(query, self.feed_type().value)
+            if record is not None:
+                self._freshest[idx] = record['freshest']
+                self._seen[query] = deque(record.get('seen', []),
+                                          maxlen=RECENT_IDS)
+                if self._index is not None:
+                    for post_id in self._seen[query]:
+                        self._index.seen(post_id)
+                self.logger.debug("Resuming {} from {}".format(
+                    query, record['freshest']))
+
+    def _checkpoint(self, idx, fresh_posts):
+        """ Record the state of a query after a poll found `fresh_posts`.
+
+        Posts that were already seen, e.g. before a restart, are dropped.
 
         Returns:
-            token (str): The access token, which goes on the end of a request.
-
-        """
-        resp = requests.get(self.TOKEN_URL_FORMAT.format(
-            self.creds().consumer_key(), self.creds().app_secret())
-        )
-        status = resp.status_code
-
-        # If the token request fails, try to use the configured app id
-        # and secret. This probably won't work, but the docs say that it
-        # should. for more info, see:
-        # https://developers.facebook.com/docs/facebook-login/access-tokens
-        token = "%s|%s" % (self.creds().consumer_key(),
-                           self.creds().app_secret())
-        if status == 200:
-            token = resp.text.split('access_token=')[1]
+            fresh_posts (list(dict)): The posts that were not seen yet.
+
+        """
+        if self._checkpoints is None:
+            return fresh_posts
+        query = self._queries[idx]
+        seen = self._seen.setdefault(query, deque(maxlen=RECENT_IDS))
+        fresh_posts = [p for p in fresh_posts if p.get('id') not in seen]
+        seen.extend(p['id'] for p in fresh_posts if 'id' in p)
+        self._update_checkpoint(idx)
+        return fresh_posts
+
+    def _update_checkpoint(self, idx):
+        """ Record the freshness and seen posts of a query. """
+        query = self._queries[idx]
+        freshest = self._freshest[idx]
+        window = self._backfilling.get(query)
+        if window is not None:
+            # posts older than that may not have been backfilled yet
+            freshest = min(freshest, window[0])
+        self._checkpoints.update(query, self.feed_type().value,
+                                 {"freshest": freshest,
+                                  "seen": list(self._seen.get(query, []))})
+
+    def _backfilled(self, query, until):
+        """ Called by the backfill once the posts of `query` up to `until`
+        were notified.
+
+        """
+        window = self._backfilling.get(query)
+        if window is None:
+            return
+        if until >= window[1]:
+            del self._backfilling[query]
         else:
-            self.logger.error(
-                "Facebook token request failed with status %d" % status
-            )
-        return token
+            self._backfilling[query] = (until, window[1])
+        if self._checkpoints is not None and query in self._queries:
+            self._update_checkpoint(self._queries.index(query))
+
+    def _new_posts(self, idx, posts):
+        """ Overridden from GraphCore, to checkpoint and track posts. """
+        posts = self._checkpoint(idx, posts)
+        posts = super()._new_posts(idx, posts)
+        self._track_posts(self._queries[idx], posts)
+        return posts
+
+    def process_signals(self, signals):
+        """ Overridden from the RESTPolling block.
 
-    def _prepare_url(self, paging=False):
-        """ Overridden from RESTPolling block.
+        With query control enabled, incoming signals add and remove queries
+        instead of triggering a poll. Changes are queued and applied at the
+        start of the next polling cycle, so they never disturb one that is
+        in progress.
 
-        Appends the access token to the format string and builds the headers
-        dictionary. If paging, we do some string interpolation to get our
-        arguments into the request url. Otherwise, we append the until
-        parameter to the end.
+        """
+        control = self.query_control()
+        if not control.enabled():
+            super().process_signals(signals)
+            return
+        changes = []
+        for signal in signals:
+            for op, expr in (('add', control.add), ('remove', control.remove)):
+                try:
+                    value = expr(signal)
+                except AttributeError:
+                    # signals usually only add or only remove queries
+                    self.logger.debug("No queries to {} in {}".format(
+                        op, signal))
+                    continue
+                except Exception:
+                    self.logger.warning(
+                        "Unable to read queries to {} from {}".format(
+                            op, signal), exc_info=True)
+                    continue
+                if value is None:
+                    continue
+                if not isinstance(value, (list, tuple)):
+                    value = [value]
+                changes.extend((op, str(q)) for q in value if q)
+        with self._query_lock:
+            self._query_changes.extend(changes)
+
+    def _apply_query_changes(self):
+        """ Apply the queued query changes.
+
+        Queries that remain keep their freshness and other state. Added
+        queries start from their checkpoint if they have one, and from the
+        lookback window otherwise. Must only be called between polling
+        cycles.
+
+        """
+        with self._query_lock:
+            changes, self._query_changes = self._query_changes, []
+        queries = list(self._queries)
+        for op, query in changes:
+            if op == 'remove':
+                if query in queries:
+                    queries.remove(query)
+            elif query not in queries and (
+                    self.shard_count() <= 1 or
+                    shard_of(query, self.shard_count()) == self.shard_index()):
+                queries.append(query)
+        if queries == self._queries:
+            return
+        current = self.current_query if self._queries else None
+        added = [q for q in queries if q not in self._queries]
+        removed = [q for q in self._queries if q not in queries]
+        old = {query: idx for idx, query in enumerate(self._queries)}
+        lb = self._unix_time(datetime.utcnow() - self.lookback())
+        for attr, default in (('_freshest', lb), ('_etags', None),
+                              ('_modifieds', None), ('_prev_freshest', None),
+                              ('_prev_stalest', None)):
+            values = getattr(self, attr)
+            setattr(self, attr, [values[old[q]] if q in old else default
+                                 for q in queries])
+        for query in removed:
+            self._seen.pop(query, None)
+            self._validators.pop(query, None)
+            if self._schedule is not None:
+                self._schedule.forget(query)
+        self._queries = queries
+        self._n_queries = len(queries)
+        # round robin carries on from the query it was at
+        if current in queries:
+            self._idx = queries.index(current)
+        else:
+            self._idx = self._idx % self._n_queries if queries else 0
+        if self._checkpoints is not None and added:
+            # other blocks may have polled them since the file was read
+            self._checkpoints.reload()
+            self._restore_checkpoints(added)
+        self.logger.info("Added queries {}, removed queries {}".format(
+            added, removed))
+
+    def _on_webhook_posts(self, posts):
+        """ Notify the posts pushed by a webhook notification.
+
+        Pushed posts leave the freshness of queries alone, so polling still
+        sweeps up any post a notification missed. The dedup index keeps the
+        sweep from notifying pushed posts again. Posts of pages that are not
+        queries of the block are dropped, since an app's subscription covers
+        every page it was added to.
 
         Args:
-            paging (bool): Are we paging?
+            posts (list(tuple)): (page_id, post) of each pushed post.
+
+        """
+        queries = set(self._queries)
+        for page_id, post in posts:
+            if page_id not in queries:
+                continue
+            fresh = self._drop_duplicates([post])
+            self._track_posts(page_id, fresh)
+            if fresh:
+                self._notify_query_signals(
+                    page_id, [FacebookSignal(fresh[0], self.signal_fields())])
+
+    def _notify_query_signals(self, query, signals):
+        """ Notify the signals found for a query. """
+        if self.include_query():
+            for signal in signals:
+                setattr(signal, self.include_query(), query)
+        if signals:
+            self.notify_signals(signals)
+
+    def _track_posts(self, query, posts):
+        """ Track the engagement of notified posts, when enabled. """
+        if self._tracker is None:
+            return
+        edges = self.engagement().edges()
+        for post in posts:
+            if 'id' in post:
+                self._tracker.track(post['id'], query,
+                                    self.created_epoch(post),
+                                    engagement_counts(post, edges))
+
+    def _refresh_engagement(self):
+        """ Refresh the counts of the tracked posts that are due.
+
+        Posts are looked up `IDS_LIMIT` at a time, and a signal is notified
+        on the engagement output for each post whose counts changed, with
+        its current `counts` and the `deltas` since the last refresh.
+
+        """
+        if not self._engagement_lock.acquire(blocking=False):
+            return
+        try:
+            edges = self.engagement().edges()
+            fields = fields_param(['shares'], edges)
+            due = self._tracker.due()
+            signals = []
+            for i in range(0, len(due), IDS_LIMIT):
+                chunk = due[i:i + IDS_LIMIT]
+                posts = self._lookup_posts(chunk, fields)
+                for post_id in chunk:
+                    if posts is None:
+                        # back off, like posts that did not change
+                        self._tracker.update(post_id, None)
+                        continue
+                    if post_id not in posts:
+                        self._tracker.forget(post_id)
+                        continue
+                    counts = engagement_counts(posts[post_id], edges)
+                    query, deltas = self._tracker.update(post_id, counts)
+                    if not deltas:
+                        continue
+                    signal = Signal({"id": post_id, "counts": counts,
+                                     "deltas": deltas})
+                    if self.include_query():
+                        setattr(signal, self.include_query(), query)
+                    signals.append(signal)
+            if signals:
+                self.notify_signals(signals, 'engagement')
+        finally:
+            self._engagement_lock.release()
+
+    def _lookup_posts(self, post_ids, fields):
+        """ Look up several posts with a single multi-id request.
 
         Returns:
-            headers (dict): Contains the (case sensitive) http headers.
+            posts (dict): The posts found, by id, or None if the request
+                failed.
 
         """
-        headers = {"Content-Type": "application/json"}
-        fmt = "%s&access_token=%s" % (self.URL_FORMAT, self._access_token)
-        if not paging:
-            self.paging_url = None
-            feed_type = self.feed_type().value
-            self.url = fmt.format(self.current_query,
-                                  feed_type,
-                                  self.freshest - 2,
-                                  self.limit())
+        url = "%s?ids=%s%s&access_token=%s" % (
+            self._graph_url, ",".join(post_ids), fields, self._access_token)
+        try:
+            resp = self._graph_get("engagement", url)
+        except Exception:
+            self.logger.exception("Engagement request failed")
+            self._record_error("engagement")
+            return None
+        if resp is None:
+            return None
+        if resp.status_code != 200:
+            self._failed("engagement", resp, url)
+            return None
+        self._governor.observe(resp.headers)
+        return decode(resp)
+
+    def _process_query_response(self, idx, resp, since, url, page=1):
+        """ Extract fresh posts from the response to a single query.
+
+        Args:
+            idx (int): Index of the query in the `queries` list.
+            resp (Response): The response to the polling request.
+            since (int): Epoch of the freshest post at the start of the cycle.
+            url (str): The url that was requested.
+            page (int): Number of requests made for the query in this cycle,
+                this one included.
+
+        Returns:
+            signals (list(Signal)): One signal per fresh FB post.
+            paging_url (str): The url of the next page, or None when no
+                paging request is necessary.
+
+        """
+        self._governor.observe(resp.headers)
+        if page == 1 and self._unchanged(self._queries[idx], resp, url,
+                                         not self.stream_decode()):
+            if self._schedule is not None:
+                self._schedule.observe(self._queries[idx], [],
+                                       self._cycle_started)
+            return [], None
+        started = monotonic()
+        if self.stream_decode():
+            # only responses of _get streamed from the network save memory,
+            # others are read in full and only save decoding stale posts
+            posts, resp, nbytes = self._stream_posts(resp, since)
         else:
-            self.paging_url = "%s&until=%d" % (self.url, self.prev_stalest)
+            nbytes = len(resp.content or '') if self._metrics else 0
+            resp = decode(resp)
+            posts = resp['data']
+        self.logger.debug("Facebook response for {} contains {} posts".format(
+            self._queries[idx], len(posts)))
+        fresh_posts = [p for p in posts if self.created_epoch(p) > since]
+        if self._metrics is not None:
+            self._metrics.response(self._queries[idx], nbytes, len(posts),
+                                   len(fresh_posts), page,
+                                   monotonic() - started)
+        if self._schedule is not None and (fresh_posts or page == 1):
+            self._schedule.observe(
+                self._queries[idx],
+                [self.created_epoch(p) for p in fresh_posts],
+                self._cycle_started)
+        paging_url = None
+        if len(fresh_posts) > 0:
+            self._freshest[idx] = max(self._freshest[idx],
+                                      self.created_epoch(fresh_posts[0]))
+            if self.paging_mode() is PagingMode.CURSOR:
+                if len(fresh_posts) == len(posts):
+                    paging_url = self._next_page_url(resp)
+            elif len(fresh_posts) == self.limit():
+                stalest = self.created_epoch(fresh_posts[-1])
+                paging_url = "%s&until=%d" % (url.split('&until=')[0],
+                                              stalest)
+        if paging_url is not None and self._page_limit_reached(page):
+            paging_url = None
+        fresh_posts = self._new_posts(idx, fresh_posts)
+        fields = self.signal_fields()
+        return [FacebookSignal(p, fields) for p in fresh_posts], paging_url
+
+    def _stream_posts(self, resp, since):
+        """ Decode the posts of a response as its body is read.
+
+        Reading stops at the first post that is not fresher than `since`,
+        since posts come newest first and anything after it is stale too.
 
-        return headers
+        Returns:
+            posts (list(dict)): The fresh posts, followed by the first stale
+                one if any.
+            body (dict): The other members of the response that were read,
+                such as `paging` when every post was fresh.
+            nbytes (int): Size of the part of the body that was read.
 
-    def _on_failure(self, resp, paging, url):
-        execute_retry = True
-        try:
-            status_code = resp.status_code
-            resp = resp.json()
-            err_code = resp.get('error', {}).get('code')
-            if (status_code == 404 and err_code in [803, 2500] or
-                    status_code == 500 and err_code == 2):
-                # Page feed requests require only an access token [1] but user
-                # feed requsts require a user access token with read_stream
-                # permission [2].
-                # [1]: https://developers.facebook.com/docs/graph-api/
-                # reference/v2.2/page/feed
-                # [2]: https://developers.facebook.com/docs/graph-api/
-                # reference/v2.2/user/feed
-                self.logger.warning(
-                    "Skipping feed: {}".format(self.current_query))
-                execute_retry = False
-                self._increment_idx()
-        finally:
-            self.logger.error(
-                "Polling request of {} returned status {}: {}".format(
-                    url, status_code, resp)
-            )
-            if execute_retry:
-                self._retry(paging)
+        """
+        posts = []
+        body = {}
+        nbytes = [0]
+
+        def chunks():
+            for chunk in resp.iter_content(STREAM_CHUNK_SIZE):
+                nbytes[0] += len(chunk)
+                yield chunk
+        for key, value in iter_response(chunks(), 'data'):
+            if key != 'data':
+                body[key] = value
+                continue
+            posts.append(value)
+            if self.created_epoch(value) <= since:
+                break
+        return posts, body, nbytes[0]
+
+    def _conditional_headers(self, query, url):
+        """ Overridden from GraphCore, since shared requests are never
+        conditional.
+
+        """
+        if self._coalesce:
+            # a 304 only means something to the block that sent the request
+            return {}
+        return super()._conditional_headers(query, url)
+
+    def _relative_url(self, query, since):
+        """ Build the feed url of a query, relative to the API version.
+
+        Used on its own for the sub-requests of a batch request, which share
+        the access token of the batch.
+
+        """
+        return self.RELATIVE_URL_FORMAT.format(
+            query, self.feed_type().value, since - 2,
+            self.limit()) + self._fields
+
+    @property
+    def current_query(self):
+        """ Overridden from the RESTPolling block, to poll the block's shard.
+
+        """
+        return self._queries[self._idx]
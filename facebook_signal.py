@@ -0,0 +1,43 @@
+from nio.signal.base import Signal
+
+
+class FacebookSignal(Signal):
+
+    """ A signal for a single Facebook post.
+
+    The decoded post is kept as is, and its fields only become attributes
+    of the signal when they are first accessed. Large nested fields that are
+    never looked at downstream are never copied onto the signal.
+
+    Params:
+        data (dict): The decoded post.
+        fields (list(str)): If given, only these fields of the post are kept.
+
+    """
+
+    def __init__(self, data, fields=None):
+        super().__init__()
+        if fields:
+            data = {k: data[k] for k in fields if k in data}
+        self._post = data
+
+    def __getattr__(self, name):
+        # only called for attributes that were not materialized yet
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            value = self._post[name]
+        except KeyError:
+            raise AttributeError(name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        # to_dict lists attributes with dir(), so every field of the post
+        # shows up in it while the raw post itself stays out of it. Keys
+        # starting with an underscore are bookkeeping, like the cached epoch
+        names = set(super().__dir__())
+        names.discard('_post')
+        names.update(k for k in self._post
+                     if k and isinstance(k, str) and not k.startswith('_'))
+        return sorted(names)
@@ -0,0 +1,181 @@
+""" Rate limiting of Graph API requests, shared by every block of an app.
+
+Facebook reports how close an app is to its rate limit in the `X-App-Usage`
+and `X-Page-Usage` response headers, as percentages of the limit. Once an
+app hits the limit every request fails with a throttling error, and the app
+can stay locked out for up to an hour. The governor slows requests down as
+the reported usage grows, and backs off exponentially on throttling errors,
+so that the blocks of an app stay under the limit.
+
+"""
+import json
+import random
+from threading import Lock
+from time import monotonic, sleep
+
+# Error codes of throttled requests, see
+# https://developers.facebook.com/docs/graph-api/using-graph-api/error-handling
+THROTTLING_CODES = (4, 17, 32, 613)
+USAGE_HEADERS = ('x-app-usage', 'x-page-usage')
+# Longest wait for the governor, in seconds, before requests are skipped
+MAX_WAIT = 60
+
+
+def parse_usage(headers):
+    """ The highest usage reported in the headers of a response.
+
+    Args:
+        headers (dict): The response headers.
+
+    Returns:
+        usage (float): Percentage of the rate limit used, or None if the
+            response does not report any usage.
+
+    """
+    headers = {k.lower(): v for k, v in headers.items()}
+    usage = None
+    for name in USAGE_HEADERS:
+        try:
+            values = json.loads(headers[name])
+        except (KeyError, TypeError, ValueError):
+            continue
+        for value in values.values():
+            if isinstance(value, (int, float)):
+                usage = max(usage or 0, value)
+    return usage
+
+
+class RateGovernor(object):
+
+    """ A token bucket limiting the request rate of one app.
+
+    The bucket refills at `rate` requests per second. Past `slowdown_at`
+    percent of reported usage, the refill rate drops in proportion to the
+    remaining headroom, and reaching the limit pauses requests altogether.
+    Throttling errors pause requests for an exponentially growing, jittered
+    delay.
+
+    Params:
+        rate (float): Requests allowed per second, 0 or less for no limit
+            other than the pauses after throttling errors.
+        slowdown_at (float): Reported usage, in percent, past which requests
+            are slowed down.
+        backoff (float): First delay after a throttling error, in seconds.
+        max_backoff (float): Longest delay after throttling errors.
+
+    """
+
+    def __init__(self, rate, slowdown_at=75, backoff=30, max_backoff=3600):
+        self.rate = rate
+        self.slowdown_at = slowdown_at
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._capacity = max(1, rate)
+        self._tokens = self._capacity
+        self._updated = monotonic()
+        self._usage = 0
+        self._paused_until = 0
+        self._throttled = 0
+        self._lock = Lock()
+
+    def reserve(self, count=1, max_wait=None):
+        """ Take `count` requests from the bucket.
+
+        Args:
+            max_wait (float): If given, the requests are only taken if they
+                may be made within that many seconds.
+
+        Returns:
+            delay (float): Seconds to wait before making the requests, or
+                None if they were not taken.
+
+        """
+        with self._lock:
+            now = monotonic()
+            tokens = 0
+            delay = self._paused_until - now
+            if self.rate > 0:
+                rate = self._rate()
+                tokens = min(self._capacity, self._tokens +
+                             (now - self._updated) * rate) - count
+                if tokens < 0:
+                    delay = max(delay, -tokens / rate)
+            delay = max(delay, 0)
+            if max_wait is not None and delay > max_wait:
+                return None
+            if self.rate > 0:
+                self._tokens = tokens
+                self._updated = now
+            return delay
+
+    def acquire(self, count=1, max_wait=None):
+        """ Block until `count` requests may be made.
+
+        Args:
+            max_wait (float): If given, return right away instead of waiting
+                any longer than that many seconds.
+
+        Returns:
+            acquired (bool): Whether the requests may be made.
+
+        """
+        delay = self.reserve(count, max_wait)
+        if delay is None:
+            return False
+        if delay > 0:
+            sleep(delay)
+        return True
+
+    def observe(self, headers, error_code=None):
+        """ Take a response into account.
+
+        Args:
+            headers (dict): The response headers.
+            error_code (int): The Graph API error code of the response, if
+                it is an error response.
+
+        """
+        usage = parse_usage(headers)
+        with self._lock:
+            now = monotonic()
+            if usage is not None:
+                self._usage = usage
+                if usage >= 100:
+                    self._pause(now, self.backoff)
+            if error_code in THROTTLING_CODES:
+                self._throttled += 1
+                delay = min(self.max_backoff,
+                            self.backoff * 2 ** (self._throttled - 1))
+                self._pause(now, delay * random.uniform(0.5, 1))
+            elif error_code is None:
+                self._throttled = 0
+
+    def stats(self):
+        with self._lock:
+            return {"usage": self._usage,
+                    "paused_for": max(0, self._paused_until - monotonic())}
+
+    def _rate(self):
+        if self._usage <= self.slowdown_at:
+            return self.rate
+        headroom = max(100 - self._usage, 1) / (100 - self.slowdown_at)
+        return self.rate * headroom
+
+    def _pause(self, now, delay):
+        self._paused_until = max(self._paused_until, now + delay)
+
+
+_governors = {}
+_governors_lock = Lock()
+
+
+def governor_for(app_id, rate):
+    """ The governor shared by every block of the app `app_id`.
+
+    The rate of the first block to ask for a governor applies.
+
+    """
+    with _governors_lock:
+        if app_id not in _governors:
+            _governors[app_id] = RateGovernor(rate)
+        return _governors[app_id]
@@ -0,0 +1,86 @@
+""" Helpers for packing Graph API requests into a single batch request.
+
+See https://developers.facebook.com/docs/graph-api/making-multiple-requests
+
+"""
+import json
+
+from .graph_json import decode, loads
+
+# The Graph API accepts at most this many sub-requests per batch
+BATCH_LIMIT = 50
+
+
+class GraphResponse(object):
+
+    """ A response-like view of a single item of a batch response.
+
+    Exposes the subset of the `requests.Response` interface that the
+    Facebook blocks rely on, so batched results can be processed exactly
+    like the responses to individual requests.
+
+    """
+
+    def __init__(self, status_code, headers, body):
+        self.status_code = status_code
+        self.headers = headers
+        self.text = body or ''
+
+    @property
+    def content(self):
+        return self.text
+
+    def json(self):
+        return loads(self.text)
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        for start in range(0, len(self.text), chunk_size):
+            yield self.text[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+def batch_payload(relative_urls, access_token, headers=None):
+    """ Build the form payload of a batch request.
+
+    Args:
+        relative_urls (list(str)): Urls of the sub-requests, relative to the
+            versioned Graph API root.
+        access_token (str): Access token used for every sub-request.
+        headers (list(dict)): Extra http headers of each sub-request, if
+            any.
+
+    Returns:
+        payload (dict): The form fields to POST to the Graph API root.
+
+    """
+    batch = [{"method": "GET", "relative_url": url} for url in relative_urls]
+    for request, extra in zip(batch, headers or []):
+        if extra:
+            request["headers"] = ["{}: {}".format(name, value)
+                                  for name, value in extra.items()]
+    return {"access_token": access_token, "batch": json.dumps(batch)}
+
+
+def split_batch_response(resp):
+    """ Split a batch response into the responses to its sub-requests.
+
+    Args:
+        resp (Response): The response to the batch request.
+
+    Returns:
+        responses (list(GraphResponse)): One response per sub-request, in
+            request order. Sub-requests that did not complete before the
+            batch timed out are None.
+
+    """
+    responses = []
+    for item in decode(resp):
+        if item is None:
+            responses.append(None)
+            continue
+        headers = {h['name']: h['value'] for h in item.get('headers') or []}
+        responses.append(
+            GraphResponse(item.get('code'), headers, item.get('body')))
+    return responses
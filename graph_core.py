@@ -0,0 +1,673 @@
+""" The Graph API client core shared by the Facebook blocks.
+
+`GraphCore` polls a Graph API endpoint for posts: it authenticates through
+the shared token cache, makes its requests over a pooled keep-alive session
+under the app's rate governor, decodes and filters responses, follows
+paging, and handles dedup, emission batching and metrics. The blocks are
+adapters on top of it that build the url of their endpoint, so every edge
+they poll goes through the same fast path.
+
+"""
+import hashlib
+from datetime import datetime
+from enum import Enum
+from time import monotonic, sleep
+
+from nio.modules.scheduler import Job
+from nio.signal.base import Signal
+from nio.properties import (StringProperty, ObjectProperty, PropertyHolder,
+                            SelectProperty, TimeDeltaProperty, IntProperty,
+                            BoolProperty, ListProperty)
+from nio.types import StringType
+
+from .dedup import PostIndex
+from .emission import EmissionBuffer
+from .facebook_signal import FacebookSignal
+from .governor import MAX_WAIT, governor_for
+from .graph_fields import fields_param
+from .graph_json import decode, post_epoch
+from .graph_session import Connection, GraphSession
+from .metrics import QueryMetrics
+from .rest_polling.rest_block import RESTPolling
+from .token_cache import parse_token_response, token_cache
+
+
+class PagingMode(Enum):
+    UNTIL = 'until'
+    CURSOR = 'cursor'
+
+
+class Creds(PropertyHolder):
+
+    """ Property holder for Facebook credentials.
+
+    """
+    consumer_key = StringProperty(title='App ID',
+                                  default='[[FACEBOOK_APP_ID]]')
+    app_secret = StringProperty(
+        title='App Secret',
+        default='[[FACEBOOK_APP_SECRET]]')
+
+
+class GraphCore(RESTPolling):
+
+    """ Base of the blocks polling the Facebook Graph API for posts.
+
+    Subclasses implement `_relative_url` for their endpoint. Every other
+    request goes to `GRAPH_URL`, under the configured API version.
+
+    """
+    GRAPH_URL = "https://graph.facebook.com/"
+    RELATIVE_URL_FORMAT = None
+    TOKEN_URL_FORMAT = ("https://graph.facebook.com/oauth"
+                        "/access_token?client_id={0}&client_secret={1}"
+                        "&grant_type=client_credentials")
+
+    creds = ObjectProperty(Creds, title='Credentials', default=Creds())
+    connection = ObjectProperty(Connection, title='Connection',
+                                default=Connection())
+    api_version = StringProperty(title='API Version', default='v2.2',
+                                 allow_none=True)
+    lookback = TimeDeltaProperty(title='Lookback', default={"seconds": 0})
+    limit = IntProperty(title='Limit (per poll)', default=10)
+    paging_mode = SelectProperty(PagingMode, default=PagingMode.UNTIL,
+                                 title='Paging Mode')
+    max_pages = IntProperty(title='Max Pages (per poll)', default=0)
+    conditional_requests = BoolProperty(title='Conditional Requests',
+                                        default=False)
+    rate_limit = IntProperty(title='Rate Limit (requests per minute)',
+                             default=600)
+    dedup_size = IntProperty(title='Dedup Index Size', default=10000)
+    signal_fields = ListProperty(StringType, title='Signal Fields',
+                                 default=[])
+    fields = ListProperty(StringType, title='Fields', default=[])
+    summary_edges = ListProperty(StringType, title='Summary Edges',
+                                 default=[])
+    dedup_ttl = TimeDeltaProperty(title='Dedup Window', default={"days": 1})
+    emit_size = IntProperty(title='Emission Batch Size', default=0)
+    emit_latency = TimeDeltaProperty(title='Emission Max Latency',
+                                     default={"seconds": 1})
+    collect_metrics = BoolProperty(title='Collect Metrics', default=False)
+    stats_interval = TimeDeltaProperty(title='Stats Interval',
+                                       default={"seconds": 0})
+
+    def __init__(self):
+        super().__init__()
+        self._url = None
+        self._graph_url = self.GRAPH_URL
+        self._paging_field = "paging"
+        self._created_field = "created_time"
+        self._access_token = None
+        self._session = None
+        self._next_page = None
+        self._pages = 0
+        self._governor = None
+        self._index = None
+        self._fields = ''
+        self._emission = None
+        self._metrics = None
+        self._stats_job = None
+        self._validators = {}
+
+    def configure(self, context):
+        super().configure(context)
+        if self.api_version():
+            self._graph_url = "{}{}/".format(self.GRAPH_URL,
+                                             self.api_version().strip('/'))
+        else:
+            self._graph_url = self.GRAPH_URL
+        lb = self._unix_time(datetime.utcnow() - self.lookback())
+        self._freshest = [lb] * self._n_queries
+        self._governor = governor_for(self.creds().consumer_key(),
+                                      self.rate_limit() / 60)
+        self._fields = fields_param(self.fields(), self.summary_edges())
+        if self.dedup_size() > 0:
+            self._index = PostIndex(self.dedup_size(),
+                                    self.dedup_ttl().total_seconds())
+        if self.emit_size() > 1:
+            self._emission = EmissionBuffer(self._emit, self.emit_size(),
+                                            self.emit_latency())
+        if self.collect_metrics():
+            self._metrics = QueryMetrics()
+
+    def start(self):
+        if self._metrics is not None and \
+                self.stats_interval().total_seconds() > 0:
+            self._stats_job = Job(self._notify_stats, self.stats_interval(),
+                                  True)
+        super().start()
+
+    def stop(self):
+        super().stop()
+        if self._stats_job is not None:
+            self._stats_job.cancel()
+        self._shutdown()
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+        if self._emission is not None:
+            self._emission.flush()
+
+    def _shutdown(self):
+        """ Stop whatever else a block runs, once polling has stopped.
+
+        Called before the session is closed and buffered signals are
+        flushed.
+
+        """
+        pass
+
+    @property
+    def URL_FORMAT(self):
+        """ Format of the polling urls, under the configured API version. """
+        return self._graph_url + self.RELATIVE_URL_FORMAT
+
+    def _relative_url(self, query, since):
+        """ Build the polling url of a query, relative to the API version.
+
+        Args:
+            query (str): The query to poll.
+            since (int): Epoch of the freshest post seen so far.
+
+        """
+        raise NotImplementedError
+
+    def _query_url(self, query, since):
+        """ Build the polling url for a query.
+
+        Args:
+            query (str): The query to poll.
+            since (int): Epoch of the freshest post seen so far.
+
+        Returns:
+            url (str): The request url, access token included.
+
+        """
+        return "%s%s&access_token=%s" % (
+            self._graph_url, self._relative_url(query, since),
+            self._access_token)
+
+    def _authenticate(self):
+        """ Overridden from the RESTPolling block.
+
+        Generates and records the access token for pending requests. Called
+        at the start of every polling cycle, so that tokens refreshed or
+        dropped by the shared cache reach the block; that read is cheap
+        while the cached token is valid, and also sets off its background
+        refresh once it is close to expiring.
+
+        """
+        if self.creds().consumer_key() is None or \
+                self.creds().app_secret() is None:
+            self.logger.error("You need a consumer key and app secret, yo")
+        else:
+            self._access_token = self._request_access_token()
+
+    def created_epoch(self, post):
+        """ Overridden from the RESTPolling block.
+
+        The timestamp of each post is parsed once and cached on the post, so
+        freshness updates, filtering and paging all reuse it.
+
+        """
+        return post_epoch(post, self._created_field)
+
+    def poll(self, paging=False, *args, **kwargs):
+        """ Overridden from the RESTPolling block.
+
+        Makes the polling request over the block's keep-alive session, with
+        its pooled connections and timeouts. Each polling cycle starts with
+        the access token currently in the shared cache.
+
+        """
+        if self._n_queries == 0:
+            return
+        if not paging:
+            self._authenticate()
+            self.prev_freshest = self.freshest
+        headers = self._prepare_url(paging)
+        url = self.paging_url or self.url
+        try:
+            resp = self._graph_get(self.current_query, url, headers)
+        except Exception:
+            self.logger.exception("Polling request of {} failed".format(url))
+            self._record_error(self.current_query)
+            self._retry(paging)
+            return
+        if resp is None:
+            return
+        if resp.status_code in (200, 304):
+            self._on_success(resp, paging)
+        else:
+            self._on_failure(resp, paging, url)
+
+    def _prepare_url(self, paging=False):
+        """ Overridden from RESTPolling block.
+
+        Appends the access token to the format string and builds the headers
+        dictionary. If paging, we do some string interpolation to get our
+        arguments into the request url. Otherwise, we append the until
+        parameter to the end. In cursor paging mode, paging requests follow
+        the `paging.next` url of the previous response instead.
+
+        Args:
+            paging (bool): Are we paging?
+
+        Returns:
+            headers (dict): Contains the (case sensitive) http headers.
+
+        """
+        headers = {"Content-Type": "application/json"}
+        if not paging:
+            self._pages = 1
+            self.paging_url = None
+            self._next_page = None
+            self.url = self._query_url(self.current_query, self.freshest)
+            headers.update(self._conditional_headers(self.current_query,
+                                                     self.url))
+        elif self.paging_mode() is PagingMode.CURSOR:
+            self._pages += 1
+            self.paging_url = self._next_page
+        else:
+            self._pages += 1
+            self.paging_url = "%s&until=%d" % (self.url, self.prev_stalest)
+
+        return headers
+
+    def _process_response(self, resp):
+        """ Extract fresh posts from the Facebook graph api response object.
+
+        Args:
+            resp (Response)
+
+        Returns:
+            signals (list(Signal)): The list of signals to notify, each of
+                which corresponds to a fresh FB post.
+            paging (bool): Denotes whether or not paging requests are
+                necessary.
+
+        """
+        signals = []
+        query = self.current_query
+        self._governor.observe(resp.headers)
+        if self._pages == 1 and self._unchanged(query, resp, self.url):
+            return signals, False
+        started = monotonic()
+        nbytes = len(resp.content or '') if self._metrics else 0
+        resp = decode(resp)
+        decode_time = monotonic() - started
+        fresh_posts = posts = resp['data']
+        paging = resp.get(self._paging_field) is not None
+        self.logger.debug("Facebook response contains %d posts" % len(posts))
+        if self.paging_mode() is PagingMode.CURSOR:
+            # only a page of posts leads on to another one
+            self._next_page = None
+            paging = False
+
+        # we shouldn't see empty responses, but we'll protect our necks.
+        if len(posts) > 0:
+            self.update_freshness(posts)
+            fresh_posts = self.find_fresh_posts(posts)
+            if self.paging_mode() is PagingMode.CURSOR:
+                # stop as soon as a page reaches posts we have already seen
+                self._next_page = self._next_page_url(resp)
+                paging = self._next_page is not None and \
+                    len(fresh_posts) == len(posts)
+            else:
+                paging = len(fresh_posts) == self.limit()
+            if paging and self._page_limit_reached(self._pages):
+                paging = False
+
+            # store the timestamp of the oldest fresh post for use in url
+            # preparation later.
+            if len(fresh_posts) > 0:
+                self.prev_stalest = self.created_epoch(fresh_posts[-1])
+            fresh_posts = self._new_posts(self._idx, fresh_posts)
+
+        if self._metrics is not None:
+            # posts already seen are not counted as fresh
+            self._metrics.response(query, nbytes, len(posts),
+                                   len(fresh_posts), self._pages, decode_time)
+        fields = self.signal_fields()
+        signals = [FacebookSignal(p, fields) for p in fresh_posts]
+        self.logger.debug("Found %d fresh posts" % len(signals))
+
+        return signals, paging
+
+    def _new_posts(self, idx, posts):
+        """ The fresh posts of a query that were not notified yet.
+
+        Args:
+            idx (int): Index of the query.
+            posts (list(dict)): Its fresh posts.
+
+        """
+        return self._drop_duplicates(posts)
+
+    def _drop_duplicates(self, posts):
+        """ Drop the posts whose id was seen recently, by any query. """
+        if self._index is None:
+            return posts
+        return [p for p in posts
+                if 'id' not in p or not self._index.seen(p['id'])]
+
+    def _conditional_headers(self, query, url):
+        """ Headers that make a request conditional on the last ETag. """
+        if not self.conditional_requests():
+            return {}
+        validator = self._validators.get(query)
+        if validator is None or validator[0] != url or validator[1] is None:
+            return {}
+        return {"If-None-Match": validator[1]}
+
+    def _unchanged(self, query, resp, url, digest=True):
+        """ Whether the first page of a query is the same as on its last poll.
+
+        A 304 answer to a conditional request is unchanged. Without an ETag,
+        the body is compared to the last one by digest, which is much cheaper
+        than decoding it. The ETag or digest of the response is remembered
+        for the next poll.
+
+        Args:
+            digest (bool): Whether the body may be read to digest it, which
+                streamed responses can't afford.
+
+        """
+        if not self.conditional_requests():
+            return False
+        if resp.status_code == 304:
+            unchanged = True
+        else:
+            etag = resp.headers.get('ETag')
+            body_digest = None
+            if etag is None and digest:
+                content = resp.content
+                if isinstance(content, str):
+                    content = content.encode()
+                body_digest = hashlib.sha1(content).hexdigest()
+            # the ETag of a full response is only the same as the last one
+            # if the request was unconditional, e.g. a shared one
+            unchanged = (etag or body_digest) is not None and \
+                self._validators.get(query) == (url, etag, body_digest)
+            self._validators[query] = (url, etag, body_digest)
+        if unchanged and self._metrics is not None:
+            self._metrics.unchanged(query)
+        return unchanged
+
+    def _next_page_url(self, resp):
+        """ The `paging.next` cursor url of a decoded response, if any. """
+        return (resp.get(self._paging_field) or {}).get('next')
+
+    def _page_limit_reached(self, page):
+        if 0 < self.max_pages() <= page:
+            self.logger.debug(
+                "Reached the limit of {} pages per poll".format(page))
+            return True
+        return False
+
+    def notify_signals(self, signals, output_id=None):
+        """ Overridden from Block, to buffer signals when batching emission.
+
+        """
+        if self._emission is None or output_id is not None:
+            super().notify_signals(signals, output_id)
+        else:
+            self._emission.add(signals)
+
+    def _emit(self, signals):
+        super().notify_signals(signals)
+
+    def stats(self):
+        """ Latency, throughput and error metrics of each query. """
+        if self._metrics is None:
+            return {}
+        return self._metrics.snapshot()
+
+    def _notify_stats(self):
+        signals = [Signal(dict(stats, query=query))
+                   for query, stats in self.stats().items()]
+        if signals:
+            self.notify_signals(signals, 'stats')
+
+    def _record_request(self, query, started):
+        if self._metrics is not None and started is not None:
+            self._metrics.request(query, monotonic() - started)
+
+    def _record_error(self, query, skipped=False):
+        if self._metrics is not None:
+            self._metrics.error(query, skipped)
+
+    def _retry(self, paging):
+        """ Overridden from the RESTPolling block, to count retries. """
+        if self._metrics is not None:
+            self._metrics.retry(self.current_query)
+        super()._retry(paging)
+
+    def connection_stats(self):
+        """ Connection reuse counters of the block's HTTP session. """
+        if self._session is None:
+            return {"connections": 0, "requests": 0, "reused": 0}
+        return self._session.stats()
+
+    def dedup_stats(self):
+        """ Hit and miss counters of the post id dedup index. """
+        if self._index is None:
+            return {}
+        return self._index.stats()
+
+    def _acquire(self, count=1):
+        """ Wait for the rate governor to allow `count` requests.
+
+        Returns:
+            allowed (bool): Whether the requests may be made.
+
+        """
+        delay = self._reserve(count)
+        if delay is None:
+            return False
+        if delay > 0:
+            sleep(delay)
+        return True
+
+    def _reserve(self, count=1):
+        """ Take `count` requests from the rate governor, without waiting.
+
+        The wait is capped at the polling interval and at `MAX_WAIT`, so
+        that an app paused after throttling errors doesn't tie up polling
+        threads or coroutines. Requests that would wait longer are skipped,
+        and left to a later polling cycle.
+
+        Returns:
+            delay (float): Seconds to wait before making the requests, or
+                None if they are skipped.
+
+        """
+        interval = self.polling_interval().total_seconds()
+        max_wait = min(interval, MAX_WAIT) if interval > 0 else MAX_WAIT
+        delay = self._governor.reserve(count, max_wait)
+        if delay is None:
+            self.logger.warning(
+                "Rate limit reached, skipping {} request(s)".format(count))
+        return delay
+
+    def _graph_get(self, query, url, headers=None, stream=False):
+        """ Make a GET request of the Graph API for `query`.
+
+        Returns:
+            resp (Response): The response, or None if the rate governor
+                skipped the request.
+
+        """
+        if headers is None:
+            headers = {"Content-Type": "application/json"}
+        return self._graph_request('get', [query], url, headers=headers,
+                                   stream=stream)
+
+    def _graph_request(self, method, queries, url, **kwargs):
+        """ Make a request of the Graph API over the block's session.
+
+        The request waits for the rate governor, and its time is recorded
+        for each of `queries`, which all count towards the rate limit.
+        Exceptions raised by the session are left to the caller.
+
+        Args:
+            method (str): The session method, e.g. 'get' or 'post'.
+            queries (list(str)): The queries the request is made for.
+            url (str): The request url.
+            kwargs: Passed on to the session method.
+
+        Returns:
+            resp (Response): The response, or None if the rate governor
+                skipped the request.
+
+        """
+        if not self._acquire(len(queries)):
+            return None
+        started = monotonic()
+        try:
+            return getattr(self._graph_session(), method)(url, **kwargs)
+        finally:
+            for query in queries:
+                self._record_request(query, started)
+
+    def _graph_session(self):
+        """ The keep-alive session used for every request of the block.
+
+        Created on first use, since the block authenticates while it is
+        being configured.
+
+        """
+        if self._session is None:
+            self._session = GraphSession.from_connection(self.connection())
+        return self._session
+
+    def _request_access_token(self):
+        """ Get an access token, from the shared cache if possible.
+
+        Args:
+            None
+
+        Returns:
+            token (str): The access token, which goes on the end of a request.
+
+        """
+        token = token_cache.get(self._creds_key(), self._fetch_access_token)
+        if token is None:
+            # If the token request fails, try to use the configured app id
+            # and secret. This probably won't work, but the docs say that it
+            # should. for more info, see:
+            # https://developers.facebook.com/docs/facebook-login/access-tokens
+            token = "%s|%s" % self._creds_key()
+        return token
+
+    def _fetch_access_token(self):
+        """ Request an access token directly from facebook.
+
+        Returns:
+            token (tuple): The access token and the number of seconds until
+                it expires (None if it doesn't), or None if the request
+                failed.
+
+        """
+        resp = self._graph_session().get(self.TOKEN_URL_FORMAT.format(
+            *self._creds_key()))
+        status = resp.status_code
+        if status != 200:
+            self.logger.error(
+                "Facebook token request failed with status %d" % status
+            )
+            return None
+        try:
+            return parse_token_response(resp.text)
+        except ValueError:
+            self.logger.exception("Unable to parse Facebook token response")
+            return None
+
+    def _creds_key(self):
+        return self.creds().consumer_key(), self.creds().app_secret()
+
+    def _on_failure(self, resp, paging, url):
+        """ Overridden from the RESTPolling block.
+
+        Failed requests are retried, unless the feed cannot be polled at
+        all, in which case it is skipped.
+
+        """
+        if self._failed(self.current_query, resp, url):
+            self._increment_idx()
+        else:
+            self._retry(paging)
+
+    def _failed(self, query, resp, url):
+        """ Handle a failed request made for `query`.
+
+        Reports throttling errors to the rate governor, and drops rejected
+        access tokens and authenticates again. Retrying is left to the
+        caller.
+
+        Returns:
+            skipped (bool): Whether the feed cannot be polled at all.
+
+        """
+        status_code = resp.status_code
+        headers = resp.headers
+        try:
+            resp = resp.json()
+        except ValueError:
+            resp = {}
+        self._governor.observe(headers, self._error_code(resp))
+        if self._invalidate_token(resp):
+            self._authenticate()
+        skipped = self._skip_feed(status_code, resp)
+        self._record_error(query, skipped)
+        if skipped:
+            self.logger.warning("Skipping feed: {}".format(query))
+        self.logger.error(
+            "Polling request of {} returned status {}: {}".format(
+                url, status_code, resp)
+        )
+        return skipped
+
+    def _invalidate_token(self, resp):
+        """ Drop the cached access token if Facebook rejected it.
+
+        Args:
+            resp (dict): The decoded body of an error response.
+
+        Returns:
+            invalidated (bool): Whether the token was dropped.
+
+        """
+        if self._error_code(resp) != 190:
+            return False
+        token_cache.invalidate(self._creds_key(), self._access_token)
+        return True
+
+    @staticmethod
+    def _error_code(resp):
+        """ The Graph API error code of a decoded error response.
+
+        Returns 0 for error responses that don't carry a code.
+
+        """
+        return resp.get('error', {}).get('code', 0)
+
+    @staticmethod
+    def _skip_feed(status_code, resp):
+        """ Whether an error response means the feed cannot be polled.
+
+        Page feed requests require only an access token [1] but user feed
+        requsts require a user access token with read_stream permission [2].
+        [1]: https://developers.facebook.com/docs/graph-api/reference/v2.2/
+        page/feed
+        [2]: https://developers.facebook.com/docs/graph-api/reference/v2.2/
+        user/feed
+
+        Args:
+            status_code (int): Status code of the response.
+            resp (dict): The decoded response body.
+
+        """
+        err_code = GraphCore._error_code(resp)
+        return (status_code == 404 and err_code in [803, 2500] or
+                status_code == 500 and err_code == 2)
@@ -0,0 +1,34 @@
+""" Building the `fields` parameter of Graph API requests.
+
+See https://developers.facebook.com/docs/graph-api/using-graph-api
+#fieldexpansion
+
+"""
+from urllib.parse import quote
+
+# Fields every post needs for freshness tracking and deduplication
+REQUIRED_FIELDS = ('id', 'created_time')
+
+
+def fields_param(fields, summary_edges=()):
+    """ Build the `fields` query parameter of a request.
+
+    Args:
+        fields (list(str)): Fields to request, in Graph API syntax, so
+            nested fields can be expanded, e.g. `from{name}`.
+        summary_edges (list(str)): Edges, such as `likes` or `comments`, for
+            which only the summary (total count) is requested.
+
+    Returns:
+        param (str): The parameter, with a leading `&`, or an empty string
+            if no fields were given, in which case Facebook returns its
+            default fields.
+
+    """
+    if not fields and not summary_edges:
+        return ''
+    requested = list(fields)
+    requested.extend("{}.summary(true).limit(0)".format(edge)
+                     for edge in summary_edges)
+    requested.extend(f for f in REQUIRED_FIELDS if f not in requested)
+    return "&fields={}".format(quote(",".join(requested), safe=",{}()."))
@@ -0,0 +1,75 @@
+""" Fast paths for decoding Graph API responses.
+
+Responses are decoded with orjson or ujson when one of them is installed,
+and with the standard library otherwise. Post timestamps are parsed once and
+the resulting epoch is cached on the post itself.
+
+"""
+import json
+from calendar import timegm
+from datetime import datetime
+
+try:
+    import orjson as _json
+except ImportError:
+    try:
+        import ujson as _json
+    except ImportError:
+        _json = None
+
+# Key under which a post's epoch is cached. It starts with an underscore so
+# that it is hidden from the signal built from the post.
+EPOCH_KEY = '_created_epoch'
+
+
+def loads(text):
+    """ Decode a JSON document, with the fastest parser available. """
+    if _json is None:
+        return json.loads(text)
+    return _json.loads(text)
+
+
+def decode(resp):
+    """ Decode the JSON body of a response.
+
+    Args:
+        resp (Response): The response, or anything with `json()` and
+            `content` like a batch sub-response.
+
+    Returns:
+        body: The decoded document.
+
+    """
+    if _json is None:
+        return resp.json()
+    content = resp.content
+    if not content or not isinstance(content, (bytes, str)):
+        # let the response report an empty or unreadable body itself
+        return resp.json()
+    return _json.loads(content)
+
+
+def parse_time(value):
+    """ The unix epoch of a Graph API timestamp.
+
+    Timestamps in UTC, like '2014-10-16T21:05:43+0000', are parsed without
+    going through `strptime`.
+
+    Raises:
+        ValueError: If the timestamp is not in ISO 8601 format.
+
+    """
+    if len(value) == 24 and value.endswith('+0000'):
+        return timegm((int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                       int(value[11:13]), int(value[14:16]),
+                       int(value[17:19])))
+    return int(datetime.strptime(value, "%Y-%m-%dT%H:%M:%S%z").timestamp())
+
+
+def post_epoch(post, field='created_time'):
+    """ The epoch of a post's timestamp, parsed at most once per post. """
+    try:
+        return post[EPOCH_KEY]
+    except KeyError:
+        epoch = post[EPOCH_KEY] = parse_time(post[field])
+        return epoch
@@ -0,0 +1,89 @@
+""" A pooled, keep-alive HTTP session for talking to the Graph API.
+
+"""
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from nio.properties import PropertyHolder, IntProperty, TimeDeltaProperty
+
+
+class Connection(PropertyHolder):
+
+    """ Property holder for the HTTP connection settings.
+
+    """
+    pool_size = IntProperty(title='Connection Pool Size', default=10)
+    max_retries = IntProperty(title='Max Retries', default=2)
+    connect_timeout = TimeDeltaProperty(title='Connect Timeout',
+                                        default={"seconds": 5})
+    read_timeout = TimeDeltaProperty(title='Read Timeout',
+                                     default={"seconds": 30})
+
+
+class GraphSession(object):
+
+    """ Wraps a `requests.Session` that keeps connections alive.
+
+    Every request made through the session reuses a pooled connection to the
+    Graph API when one is available, so the TLS handshake is only paid once
+    per pooled connection. Connection errors and gateway errors are retried
+    with backoff by the transport adapter.
+
+    Params:
+        pool_size (int): Maximum number of connections kept per host.
+        max_retries (int): Number of retries on connection and gateway
+            errors.
+        timeout (tuple(float)): (connect, read) timeouts, in seconds.
+
+    """
+
+    def __init__(self, pool_size=10, max_retries=2, timeout=(5, 30)):
+        self._timeout = timeout
+        self._session = requests.Session()
+        retry = Retry(total=max_retries, backoff_factor=0.5,
+                      status_forcelist=(502, 503, 504),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size, max_retries=retry)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+    @classmethod
+    def from_connection(cls, connection):
+        """ Create a session from a `Connection` property holder. """
+        return cls(pool_size=max(1, connection.pool_size()),
+                   max_retries=connection.max_retries(),
+                   timeout=(connection.connect_timeout().total_seconds(),
+                            connection.read_timeout().total_seconds()))
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self._timeout)
+        return self._session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        kwargs.setdefault('timeout', self._timeout)
+        return self._session.post(url, **kwargs)
+
+    def close(self):
+        self._session.close()
+
+    def stats(self):
+        """ Connection reuse counters of the pools currently held.
+
+        Returns:
+            stats (dict): The number of `connections` opened, the number of
+                `requests` made over them and how many requests `reused` an
+                already open connection.
+
+        """
+        connections = requests_made = 0
+        for adapter in set(self._session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                connections += pool.num_connections
+                requests_made += pool.num_requests
+        return {"connections": connections,
+                "requests": requests_made,
+                "reused": requests_made - connections}
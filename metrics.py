@@ -0,0 +1,121 @@
+""" Per-query instrumentation of the Facebook blocks. """
+from bisect import bisect_left
+from collections import defaultdict
+from threading import Lock
+
+# Upper bounds, in milliseconds, of the request latency histogram buckets
+LATENCY_BUCKETS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class _QueryStats(object):
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.skipped = 0
+        self.unchanged = 0
+        self.coalesced = 0
+        self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_total = 0.0
+        self.bytes = 0
+        self.decode_time = 0.0
+        self.responses = 0
+        self.posts = 0
+        self.fresh_posts = 0
+        self.max_pages = 0
+
+    def to_dict(self):
+        bounds = [str(b) for b in LATENCY_BUCKETS] + ['inf']
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "retries": self.retries,
+            "skipped": self.skipped,
+            "unchanged": self.unchanged,
+            "coalesced": self.coalesced,
+            "latency_ms": dict(zip(bounds, self.latency)),
+            "mean_latency_ms": round(
+                1000 * self.latency_total / self.requests, 3)
+            if self.requests else 0,
+            "bytes": self.bytes,
+            "decode_time": round(self.decode_time, 6),
+            "posts_per_response": round(self.posts / self.responses, 3)
+            if self.responses else 0,
+            "fresh_ratio": round(self.fresh_posts / self.posts, 3)
+            if self.posts else 0,
+            "max_paging_depth": self.max_pages,
+        }
+
+
+class QueryMetrics(object):
+
+    """ Thread safe counters of the requests made for each query.
+
+    Blocks only create one when metrics are enabled, so that instrumentation
+    costs nothing otherwise.
+
+    """
+
+    def __init__(self):
+        self._stats = defaultdict(_QueryStats)
+        self._lock = Lock()
+
+    def request(self, query, latency):
+        """ Record a request that completed after `latency` seconds. """
+        bucket = bisect_left(LATENCY_BUCKETS, 1000 * latency)
+        with self._lock:
+            stats = self._stats[query]
+            stats.requests += 1
+            stats.latency[bucket] += 1
+            stats.latency_total += latency
+
+    def response(self, query, nbytes, posts, fresh_posts, page,
+                 decode_time):
+        """ Record a successful response and what was found in it.
+
+        Args:
+            query (str): The query the response belongs to.
+            nbytes (int): Size of the body that was read.
+            posts (int): Number of posts decoded from the response.
+            fresh_posts (int): How many of them were fresh.
+            page (int): Number of requests made for the query in the polling
+                cycle, this one included.
+            decode_time (float): Seconds spent decoding the body.
+
+        """
+        with self._lock:
+            stats = self._stats[query]
+            stats.bytes += nbytes
+            stats.responses += 1
+            stats.posts += posts
+            stats.fresh_posts += fresh_posts
+            stats.max_pages = max(stats.max_pages, page)
+            stats.decode_time += decode_time
+
+    def error(self, query, skipped=False):
+        with self._lock:
+            self._stats[query].errors += 1
+            if skipped:
+                self._stats[query].skipped += 1
+
+    def unchanged(self, query):
+        """ Record a response that was the same as on the previous poll. """
+        with self._lock:
+            self._stats[query].unchanged += 1
+
+    def coalesced(self, query):
+        """ Record a response that was shared by another block's request.
+        """
+        with self._lock:
+            self._stats[query].coalesced += 1
+
+    def retry(self, query):
+        with self._lock:
+            self._stats[query].retries += 1
+
+    def snapshot(self):
+        """ The metrics of every query, by query. """
+        with self._lock:
+            return {query: stats.to_dict()
+                    for query, stats in self._stats.items()}
@@ -0,0 +1,40 @@
+""" Assignment of queries to the shards of a sharded deployment.
+
+Queries are assigned with rendezvous (highest random weight) hashing: each
+query goes to the shard that gives the pair the highest hash. Growing a
+deployment from n to n + 1 shards only moves the queries won by the new
+shard, about 1 / (n + 1) of them, and every other query stays put.
+
+"""
+import hashlib
+
+
+def _weight(query, shard):
+    # stable across processes and hosts, unlike the builtin hash
+    digest = hashlib.md5("{}:{}".format(shard, query).encode()).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+def shard_of(query, shard_count):
+    """ The index of the shard that owns `query`. """
+    return max(range(shard_count), key=lambda shard: _weight(query, shard))
+
+
+def shard_queries(queries, shard_index, shard_count):
+    """ The queries owned by a shard, in their original order.
+
+    Args:
+        queries (list(str)): Every query of the deployment.
+        shard_index (int): Index of the shard, from 0 to `shard_count` - 1.
+        shard_count (int): Number of shards in the deployment.
+
+    Raises:
+        ValueError: If `shard_index` is not a valid index.
+
+    """
+    if shard_count <= 1:
+        return list(queries)
+    if not 0 <= shard_index < shard_count:
+        raise ValueError("Shard index {} is out of range for {} shards".format(
+            shard_index, shard_count))
+    return [q for q in queries if shard_of(q, shard_count) == shard_index]
@@ -0,0 +1,108 @@
+""" Incremental decoding of Graph API list responses.
+
+`iter_response` decodes a response body as its chunks arrive and yields the
+items of its `data` array one at a time, so a caller can stop reading as
+soon as it has the items it needs, without ever holding the whole document
+or its object tree in memory.
+
+"""
+import codecs
+import json
+import re
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'\s*')
+
+
+class _Buffer(object):
+
+    """ The undecoded part of a body that arrives in chunks. """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.text = ''
+        self.pos = 0
+
+    def more(self):
+        """ Read the next chunk, returns False at the end of the body. """
+        for chunk in self._chunks:
+            if isinstance(chunk, bytes):
+                chunk = self._utf8.decode(chunk)
+            if chunk:
+                self.text = self.text[self.pos:] + chunk
+                self.pos = 0
+                return True
+        return False
+
+    def peek(self):
+        """ The next character that is not whitespace. """
+        while True:
+            self.pos = _whitespace.match(self.text, self.pos).end()
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.more():
+                raise ValueError("Unexpected end of JSON document")
+
+    def take(self, *expected):
+        char = self.peek()
+        if char not in expected:
+            raise ValueError("Expected one of {} at {!r}".format(
+                expected, self.text[self.pos:self.pos + 20]))
+        self.pos += 1
+        return char
+
+    def value(self):
+        """ Decode the next complete JSON value. """
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+            except ValueError:
+                if not self.more():
+                    raise
+                continue
+            # a number at the end of the buffer may go on in the next chunk
+            if end == len(self.text) and self.more():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_response(chunks, array='data'):
+    """ Decode a JSON object incrementally.
+
+    Args:
+        chunks (iterable): The body of the response, in chunks of bytes or
+            str, e.g. `Response.iter_content(chunk_size)`.
+        array (str): The key of the array whose items are yielded one by
+            one.
+
+    Yields:
+        (key, value): For each item of `array`, the key `array` and the
+            item. For every other member of the object, its key and value.
+
+    Raises:
+        ValueError: If the body is not a valid JSON object.
+
+    """
+    buf = _Buffer(chunks)
+    buf.take('{')
+    if buf.peek() == '}':
+        return
+    while True:
+        key = buf.value()
+        buf.take(':')
+        if key == array and buf.peek() == '[':
+            buf.take('[')
+            if buf.peek() == ']':
+                buf.take(']')
+            else:
+                while True:
+                    yield key, buf.value()
+                    if buf.take(',', ']') == ']':
+                        break
+        else:
+            yield key, buf.value()
+        if buf.take(',', '}') == '}':
+            return
@@ -0,0 +1,237 @@
+""" A local stand-in for the Facebook Graph API.
+
+Serves the parts of the Graph API that the Facebook blocks use, from posts
+generated on the fly, so the blocks can be exercised end to end and at scale
+without network access:
+
+- `GET /oauth/access_token`
+- `GET /{id}/{feed_type}` and `GET /search?q={id}`, with `since`, `until`,
+  `limit` and `paging` urls
+- `POST /` batch requests
+- throttling errors and `X-App-Usage` headers
+- `ETag` headers and `If-None-Match` conditional requests
+
+Every id is a feed, except for the configured missing ones. Each feed gets a
+post every `1 / post_rate` seconds, starting at `start`, up to the current
+time.
+
+"""
+import hashlib
+import json
+import time
+from calendar import timegm
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import parse_qs, urlencode, urlparse
+from zlib import crc32
+
+THROTTLE_ERROR = {"error": {
+    "message": "(#4) Application request limit reached",
+    "type": "OAuthException", "code": 4}}
+MISSING_ERROR = {"error": {
+    "message": "(#803) Some of the aliases you requested do not exist",
+    "type": "OAuthException", "code": 803}}
+
+
+class GraphSimulator(object):
+
+    """ Serves generated Graph API responses on a local port.
+
+    Params:
+        post_rate (float): Posts published per second on each feed.
+        payload_size (int): Length of the message of each post.
+        start (int): Epoch of the oldest posts, defaults to a day ago.
+        throttle_every (int): Answer every n-th request with a throttling
+            error, 0 never does.
+        app_usage (int): Percentage reported in the `X-App-Usage` header of
+            every response, None leaves the header out.
+        latency (float): Seconds each request waits before it is answered.
+        missing (iterable(str)): Ids that are not feeds.
+        etags (bool): Whether feed responses carry an ETag, and conditional
+            requests are answered with 304 when it still matches.
+
+    """
+
+    def __init__(self, post_rate=0.1, payload_size=100, start=None,
+                 throttle_every=0, app_usage=None, latency=0,
+                 missing=(), etags=False):
+        self.post_rate = post_rate
+        self.payload_size = payload_size
+        self.start_epoch = int(time.time()) - 86400 if start is None \
+            else start
+        self.throttle_every = throttle_every
+        self.app_usage = app_usage
+        self.latency = latency
+        self.missing = set(missing)
+        self.etags = etags
+        self.not_modified = 0
+        self.requests = 0
+        self.batches = 0
+        self.throttled = 0
+        self._lock = Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        """ Root url of the simulator, to be used as a block's GRAPH_URL. """
+        return "http://127.0.0.1:{}/".format(self._server.server_port)
+
+    def start(self):
+        handler = type('Handler', (_Handler,), {'simulator': self})
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self._server.daemon_threads = True
+        Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def posts(self, feed, since=0, until=None, limit=25):
+        """ The posts of `feed` published within (since, until), newest first.
+        """
+        interval = 1 / self.post_rate
+        # feeds publish out of step with each other
+        first = self.start_epoch + (crc32(feed.encode()) % 1000) / 1000 * \
+            interval
+        newest = time.time()
+        if until is not None:
+            newest = min(newest, until - 1)
+        posts = []
+        k = int((newest - first) // interval)
+        while k >= 0 and len(posts) < limit:
+            epoch = int(first + k * interval)
+            if epoch <= since:
+                break
+            posts.append(self._post(feed, k, epoch))
+            k -= 1
+        return posts
+
+    def answer(self, relative_url, request_headers=None):
+        """ The status, headers and body of the answer to a GET request.
+
+        The body is None when there is none.
+
+        """
+        with self._lock:
+            self.requests += 1
+            throttled = self.throttle_every and \
+                self.requests % self.throttle_every == 0
+            if throttled:
+                self.throttled += 1
+        if self.latency:
+            time.sleep(self.latency)
+        headers = {"Content-Type": "application/json"}
+        if self.app_usage is not None:
+            headers["X-App-Usage"] = json.dumps({
+                "call_count": self.app_usage, "total_time": 0,
+                "total_cputime": 0})
+        if throttled:
+            return 400, headers, THROTTLE_ERROR
+        url = urlparse(relative_url)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        path = [p for p in url.path.split('/') if p]
+        if path and path[0].startswith('v') and '.' in path[0]:
+            path = path[1:]
+        if path == ['oauth', 'access_token']:
+            return 200, headers, {"access_token": "simulated|token",
+                                  "token_type": "bearer",
+                                  "expires_in": 5184000}
+        if path == ['search']:
+            feed = params.get('q', '')
+        elif len(path) == 2:
+            feed = path[0]
+        else:
+            return 400, headers, {"error": {"code": 100, "message": (
+                "Unsupported get request"), "type": "GraphMethodException"}}
+        if feed in self.missing:
+            return 404, headers, MISSING_ERROR
+        until = int(params['until']) if 'until' in params else None
+        posts = self.posts(feed, int(params.get('since', 0)), until,
+                           int(params.get('limit', 25)))
+        body = {"data": posts}
+        if posts:
+            next_params = dict(params, until=str(
+                self._epoch(posts[-1]['created_time'])))
+            body["paging"] = {
+                "previous": self._url(url.path, dict(
+                    params, since=str(self._epoch(posts[0]['created_time'])))),
+                "next": self._url(url.path, next_params),
+            }
+        if self.etags:
+            headers["ETag"] = '"{}"'.format(hashlib.sha1(
+                json.dumps(body).encode()).hexdigest())
+            if (request_headers or {}).get('If-None-Match') == \
+                    headers["ETag"]:
+                with self._lock:
+                    self.not_modified += 1
+                return 304, headers, None
+        return 200, headers, body
+
+    def answer_batch(self, batch):
+        """ The items of the answer to a batch request. """
+        with self._lock:
+            self.batches += 1
+        items = []
+        for request in batch:
+            request_headers = dict(
+                h.split(': ', 1) for h in request.get('headers', []))
+            status, headers, body = self.answer(request['relative_url'],
+                                                request_headers)
+            items.append({
+                "code": status,
+                "headers": [{"name": k, "value": v}
+                            for k, v in headers.items()],
+                "body": None if body is None else json.dumps(body)})
+        return items
+
+    def _post(self, feed, k, epoch):
+        return {
+            "id": "{}_{}".format(feed, k),
+            "from": {"id": feed, "name": feed},
+            "message": "x" * self.payload_size,
+            "type": "status",
+            "created_time": datetime.utcfromtimestamp(epoch).strftime(
+                "%Y-%m-%dT%H:%M:%S+0000"),
+        }
+
+    def _url(self, path, params):
+        return "{}{}?{}".format(self.url, path.lstrip('/'), urlencode(params))
+
+    @staticmethod
+    def _epoch(created_time):
+        return timegm(time.strptime(created_time, "%Y-%m-%dT%H:%M:%S+0000"))
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    simulator = None
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._send(*self.simulator.answer(self.path, self.headers))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = parse_qs(self.rfile.read(length).decode())
+        if 'batch' not in form:
+            self._send(400, {"Content-Type": "application/json"},
+                       {"error": {"code": 100, "message": "Missing batch"}})
+            return
+        items = self.simulator.answer_batch(json.loads(form['batch'][0]))
+        self._send(200, {"Content-Type": "application/json"}, items)
+
+    def _send(self, status, headers, body):
+        body = b'' if body is None else json.dumps(body).encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
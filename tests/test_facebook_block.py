@@ -1,11 +1,20 @@
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import patch, MagicMock
+from urllib.parse import parse_qs, urlparse
 from requests import Response
-from threading import Event
+from threading import Event, Thread
 
+from nio.block.terminals import DEFAULT_TERMINAL
 from nio.testing.block_test_case import NIOBlockTestCase
 from nio.util.discovery import not_discoverable
 
+from .. import token_cache as token_module
 from ..facebook_block import FacebookBlock
+from ..facebook_signal import FacebookSignal
+from ..graph_json import EPOCH_KEY, parse_time
+from ..graph_session import GraphSession
+from ..token_cache import parse_token_response, token_cache
 
 
 @not_discoverable
@@ -19,9 +28,30 @@ class FBTestBlk(FacebookBlock):
         self._event.set()
 
 
+class SearchStub(BaseHTTPRequestHandler):
+
+    """ Answers search requests with no posts, keeping connections alive.
+
+    """
+    protocol_version = "HTTP/1.1"
+    queries = []
+
+    def do_GET(self):
+        self.queries.append(parse_qs(urlparse(self.path).query)['q'][0])
+        body = json.dumps({"data": []}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
 class TestFacebook(NIOBlockTestCase):
 
-    @patch("requests.get")
+    @patch.object(GraphSession, "get")
     @patch("requests.Response.json")
     @patch.object(FacebookBlock, "created_epoch")
     def test_process_responses(self, mock_epoch, mock_json, mock_get):
@@ -58,3 +88,171 @@ class TestFacebook(NIOBlockTestCase):
         self.assert_num_signals_notified(1)
 
         blk.stop()
+
+    def test_session_reused(self):
+        """ Token and polling requests share one keep-alive session """
+        server = ThreadingHTTPServer(('127.0.0.1', 0), SearchStub)
+        server.daemon_threads = True
+        Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        blk = FacebookBlock()
+        blk.GRAPH_URL = "http://127.0.0.1:{}/".format(server.server_port)
+        with patch.object(GraphSession, "get") as mock_get:
+            mock_get.return_value = MagicMock()
+            mock_get.return_value.status_code = 200
+            mock_get.return_value.text = "access_token=foo|bar"
+            self.configure_block(blk, {
+                "queries": ["foobar"],
+                "connection": {"pool_size": 3}
+            })
+            session = blk._graph_session()
+            token_cache.clear()
+            calls = mock_get.call_count
+            blk._authenticate()
+            self.assertIs(session, blk._session)
+            self.assertEqual("foo|bar", blk._access_token)
+            self.assertEqual(calls + 1, mock_get.call_count)
+        self.assertEqual({"connections": 0, "requests": 0, "reused": 0},
+                         blk.connection_stats())
+        # polls go over the same connection
+        blk.poll()
+        blk.poll()
+        self.assertEqual(["foobar"] * 2, SearchStub.queries)
+        self.assertEqual({"connections": 1, "requests": 2, "reused": 1},
+                         blk.connection_stats())
+        blk.stop()
+        self.assertIsNone(blk._session)
+
+    @patch.object(GraphSession, "get")
+    def test_token_shared(self, mock_get):
+        """ Blocks with the same credentials share one access token """
+        mock_get.return_value = MagicMock()
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.text = \
+            '{"access_token": "foo|bar", "token_type": "bearer"}'
+        creds = {"consumer_key": "foo", "app_secret": "bar"}
+        token_cache.clear()
+        blocks = [FacebookBlock(), FacebookBlock()]
+        for blk in blocks:
+            self.configure_block(blk, {"queries": ["foobar"], "creds": creds})
+            blk._authenticate()
+            self.assertEqual("foo|bar", blk._access_token)
+        self.assertEqual(1, mock_get.call_count)
+
+        # failed token requests fall back to the app id and secret
+        token_cache.clear()
+        mock_get.return_value.status_code = 400
+        blocks[0]._authenticate()
+        self.assertEqual("foo|bar", blocks[0]._access_token)
+        self.assertIsNone(token_cache._entries.get(("foo", "bar")))
+
+    @patch.object(token_module, "spawn", side_effect=lambda f: f())
+    @patch.object(FacebookBlock, "_fetch_access_token")
+    @patch.object(GraphSession, "get")
+    def test_token_refreshed(self, mock_get, mock_fetch, mock_spawn):
+        """ Polling picks up tokens refreshed ahead of their expiry """
+        mock_get.return_value = MagicMock()
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.json.return_value = {"data": []}
+        mock_fetch.side_effect = [("old", 60), ("new", 3600)]
+        token_cache.clear()
+        blk = FacebookBlock()
+        self.configure_block(blk, {"queries": ["foobar"]})
+        self.assertEqual("old", blk._access_token)
+        # the expiring token is still used while the new one is fetched
+        blk.poll()
+        self.assertTrue(mock_get.call_args[0][0].endswith("=old"))
+        self.assertEqual(2, mock_fetch.call_count)
+        blk.poll()
+        self.assertTrue(mock_get.call_args[0][0].endswith("=new"))
+        self.assertEqual("new", blk._access_token)
+        self.assertEqual(2, mock_fetch.call_count)
+        token_cache.clear()
+
+    def test_parse_token_response(self):
+        self.assertEqual(("foo|bar", None),
+                         parse_token_response("access_token=foo|bar"))
+        self.assertEqual(("abc", 3600), parse_token_response(
+            "access_token=abc&expires=3600"))
+        self.assertEqual(("abc", 60), parse_token_response(
+            '{"access_token": "abc", "expires_in": 60}'))
+        with self.assertRaises(ValueError):
+            parse_token_response('{"error": {"code": 1}}')
+
+    def test_lazy_signal(self):
+        post = {"id": "1", "message": "hi", "likes": {"data": [{"id": "2"}]}}
+        signal = FacebookSignal(post)
+        self.assertNotIn("likes", signal.__dict__)
+        self.assertEqual({"data": [{"id": "2"}]}, signal.likes)
+        self.assertIn("likes", signal.__dict__)
+        self.assertEqual(post, signal.to_dict())
+        self.assertNotIn("_post", signal.to_dict(include_hidden=True))
+        self.assertFalse(hasattr(signal, "comments"))
+        # fields can be projected
+        signal = FacebookSignal(post, ["id", "message", "story"])
+        self.assertEqual({"id": "1", "message": "hi"}, signal.to_dict())
+        self.assertFalse(hasattr(signal, "likes"))
+
+    @patch.object(FacebookBlock, "_authenticate")
+    def test_fields(self, mock_auth):
+        blk = FacebookBlock()
+        self.configure_block(blk, {
+            "queries": ["foobar"],
+            "fields": ["message", "from{name}"]
+        })
+        blk._freshest = [10]
+        blk._prepare_url()
+        self.assertTrue(blk.url.startswith(blk.URL_FORMAT.format(
+            8, "foobar", 10) + "&fields=message,from{name},id,created_time"))
+
+    @patch.object(FacebookBlock, "_authenticate")
+    def test_api_version(self, mock_auth):
+        """ Requests go to the configured API version """
+        blk = FacebookBlock()
+        self.configure_block(blk, {"queries": ["foobar"]})
+        blk._freshest = [10]
+        blk._prepare_url()
+        self.assertTrue(blk.url.startswith(
+            "https://graph.facebook.com/v1.0/search?since=8&q=foobar"))
+        blk = FacebookBlock()
+        self.configure_block(blk, {"queries": ["foobar"],
+                                   "api_version": "v2.0"})
+        blk._freshest = [10]
+        blk._prepare_url()
+        self.assertTrue(blk.url.startswith(
+            "https://graph.facebook.com/v2.0/search?since=8&q=foobar"))
+
+    def test_created_epoch(self):
+        """ Post timestamps are parsed once and cached on the post """
+        blk = FacebookBlock()
+        post = {"created_time": "2014-10-16T21:05:43+0000"}
+        self.assertEqual(1413493543, blk.created_epoch(post))
+        self.assertEqual(1413493543, post[EPOCH_KEY])
+        post["created_time"] = "garbage"
+        self.assertEqual(1413493543, blk.created_epoch(post))
+        self.assertEqual(1413493543, parse_time("2014-10-16T23:05:43+0200"))
+        self.assertNotIn(EPOCH_KEY, FacebookSignal(post).to_dict())
+        with self.assertRaises(ValueError):
+            parse_time("yesterday")
+
+    @patch.object(FacebookBlock, "_authenticate")
+    def test_emission_batches(self, mock_auth):
+        """ Signals are notified in batches of the emission size """
+        blk = FacebookBlock()
+        self.configure_block(blk, {
+            "emit_size": 3,
+            "emit_latency": {"seconds": 60}
+        })
+        signals = [FacebookSignal({"id": str(i)}) for i in range(5)]
+        blk.notify_signals(signals[:2])
+        self.assert_num_signals_notified(0)
+        blk.notify_signals(signals[2:4])
+        self.assertEqual([signals[:4]],
+                         self.notified_signals[DEFAULT_TERMINAL])
+        blk.notify_signals(signals[4:])
+        self.assert_num_signals_notified(4)
+        # whatever is left is notified when the block stops
+        blk.stop()
+        self.assertEqual([signals[:4], signals[4:]],
+                         self.notified_signals[DEFAULT_TERMINAL])
@@ -1,12 +1,45 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import tempfile
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import skipIf
 from unittest.mock import patch, MagicMock
+from urllib.parse import parse_qs, urlparse
+import requests
 from requests import Response
-from threading import Event
+from threading import Event, Thread
+from time import time
 
+from nio.block.terminals import DEFAULT_TERMINAL
 from nio.testing.block_test_case import NIOBlockTestCase
+from nio.testing.modules.scheduler.scheduler import JumpAheadScheduler
 from nio.util.discovery import not_discoverable
+from nio.signal.base import Signal
 
-from ..facebook_feed_block import FacebookFeed, FeedType
+from .. import backfill, engagement, facebook_feed_block
+from ..async_engine import aiohttp
+from ..backfill import time_slices
+from ..checkpoint import CheckpointStore, checkpoint_store
+from ..coalesce import (RequestCoalescer, coalesce_key, request_coalescer,
+                        window_start, with_limit)
+from ..dedup import PostIndex
+from ..engagement import EngagementTracker, engagement_counts
+from ..adaptive import AdaptiveSchedule
+from ..facebook_feed_block import FacebookFeed, FeedType, PollMode
+from ..graph_batch import GraphResponse
+from ..governor import RateGovernor, parse_usage
+from ..metrics import QueryMetrics
+from ..graph_session import GraphSession
 from ..rest_polling.rest_block import RESTPolling
+from ..sharding import shard_of, shard_queries
+from ..stream_json import iter_response
+from ..token_cache import token_cache
+from ..webhook import feed_posts
+from .graph_simulator import GraphSimulator
 
 
 @not_discoverable
@@ -21,9 +54,55 @@ class FBTestBlk(FacebookFeed):
         self._event.set()
 
 
+class GraphStub(BaseHTTPRequestHandler):
+
+    """ Answers Graph API feed and batch requests from canned feeds.
+
+    Each feed is a list of posts, newest first, with an `epoch` field.
+
+    """
+    feeds = {}
+    batches = []
+
+    def do_GET(self):
+        # requests go to the versioned root, batched ones are relative to it
+        answer = self._answer(self.path.lstrip('/').split('/', 1)[1])
+        self.send_response(answer['code'])
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(answer['body'].encode())
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        form = parse_qs(self.rfile.read(length).decode())
+        batch = json.loads(form['batch'][0])
+        self.batches.append(batch)
+        body = json.dumps([self._answer(r['relative_url']) for r in batch])
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def _answer(self, relative_url):
+        url = urlparse(relative_url)
+        params = parse_qs(url.query)
+        posts = self.feeds.get(url.path.split('/')[0])
+        if posts is None:
+            return {'code': 404, 'headers': [], 'body': json.dumps(
+                {'error': {'code': 803, 'type': 'OAuthException'}})}
+        since = int(params['since'][0])
+        until = int(params.get('until', [2 ** 32])[0])
+        posts = [p for p in posts if since < p['epoch'] < until]
+        body = {'data': posts[:int(params['limit'][0])]}
+        return {'code': 200, 'headers': [], 'body': json.dumps(body)}
+
+    def log_message(self, *args):
+        pass
+
+
 class TestFacebookFeed(NIOBlockTestCase):
 
-    @patch("requests.get")
+    @patch.object(GraphSession, "get")
     @patch("requests.Response.json")
     @patch.object(FacebookFeed, "created_epoch")
     def test_process_responses(self, mock_epoch, mock_json, mock_get):
@@ -88,7 +167,7 @@ class TestFacebookFeed(NIOBlockTestCase):
 
     @patch.object(RESTPolling, "_retry")
     @patch.object(FacebookFeed, "_authenticate")
-    @patch("requests.get")
+    @patch.object(GraphSession, "get")
     def test_bad_username_query(self, mock_get, mock_auth, mock_retry):
         """ username queries get a code 803 from Facebook
 
@@ -119,7 +198,7 @@ class TestFacebookFeed(NIOBlockTestCase):
 
     @patch.object(RESTPolling, "_retry")
     @patch.object(FacebookFeed, "_authenticate")
-    @patch("requests.get")
+    @patch.object(GraphSession, "get")
     def test_bad_queries(self, mock_get, mock_auth, mock_retry):
         """ Some queries give bad responses that should not be retried
 
@@ -150,7 +229,7 @@ class TestFacebookFeed(NIOBlockTestCase):
 
     @patch.object(RESTPolling, "_retry")
     @patch.object(FacebookFeed, "_authenticate")
-    @patch("requests.get")
+    @patch.object(GraphSession, "get")
     def test_unexpected_erros(self, mock_get, mock_auth, mock_retry):
         """ Sometimes unexpected errors occurs and they should be skipped
 
@@ -183,7 +262,7 @@ class TestFacebookFeed(NIOBlockTestCase):
 
     @patch.object(RESTPolling, "_retry")
     @patch.object(FacebookFeed, "_authenticate")
-    @patch("requests.get")
+    @patch.object(GraphSession, "get")
     def test_retry(self, mock_get, mock_auth, mock_retry):
         """ Retry query on bad status codes
 
@@ -205,3 +284,1302 @@ class TestFacebookFeed(NIOBlockTestCase):
         blk.poll()
         # don't skip to next idx because we are retrying.
         self.assertEqual(0, blk._idx)
+
+    @patch.object(FacebookFeed, "created_epoch")
+    @patch.object(FacebookFeed, "_authenticate")
+    @patch.object(GraphSession, "get")
+    def test_concurrent_poll(self, mock_get, mock_auth, mock_epoch):
+        """ Concurrent mode polls every query on each cycle """
+        blk = FacebookFeed()
+        self.configure_block(blk, {
+            "queries": ["page1", "page2", "page3", "broken"],
+            "poll_mode": "concurrent",
+            "max_workers": 2,
+            "include_query": "query"
+        })
+        blk._freshest = [10, 10, 10, 10]
+        mock_epoch.side_effect = lambda post: post['epoch']
+
+        def get(url, headers, **kwargs):
+            resp = MagicMock()
+            resp.status_code = 200
+            if url.startswith(blk.URL_FORMAT.format('page2', 'feed', 8, 10)):
+                resp.json.return_value = {'data': [{'epoch': 11}]}
+            elif url.startswith(blk.URL_FORMAT.format('broken', 'feed', 8,
+                                                      10)):
+                resp.json.return_value = {'error': {}}
+            else:
+                resp.json.return_value = {'data': [{'epoch': 9}]}
+            return resp
+        mock_get.side_effect = get
+        blk.logger = MagicMock()
+        blk.poll()
+        self.assertEqual(4, mock_get.call_count)
+        self.assertEqual(blk._freshest, [10, 11, 10, 10])
+        # the query that failed unexpectedly is logged, not lost
+        self.assertEqual(1, blk.logger.error.call_count)
+        self.assertIn("broken", blk.logger.error.call_args[0][0])
+        self.assertIsInstance(blk.logger.error.call_args[1]['exc_info'],
+                              KeyError)
+        self.assert_num_signals_notified(1)
+        self.assertEqual(
+            'page2', self.last_notified[DEFAULT_TERMINAL][0].query)
+        # round robin bookkeeping is left untouched
+        self.assertEqual(0, blk._idx)
+        blk.stop()
+
+    @patch.object(FacebookFeed, "created_epoch")
+    @patch.object(FacebookFeed, "_authenticate")
+    def test_batch_poll(self, mock_auth, mock_epoch):
+        """ Batch mode polls every query through batch requests """
+        server = HTTPServer(('127.0.0.1', 0), GraphStub)
+        Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+        GraphStub.batches = []
+        GraphStub.feeds = {
+            "page1": [{"epoch": 9}],
+            "page2": [{"epoch": 14}, {"epoch": 13}, {"epoch": 12}],
+        }
+        mock_epoch.side_effect = lambda post: post['epoch']
+
+        blk = FacebookFeed()
+        blk.GRAPH_URL = "http://127.0.0.1:{}/".format(server.server_port)
+        self.configure_block(blk, {
+            "queries": ["page1", "page2", "username"],
+            "poll_mode": "batch",
+            "limit": 2
+        })
+        blk._freshest = [10, 10, 10]
+        blk.poll()
+        # page2 needed a second page, so it went out in a second batch
+        self.assertEqual(2, len(GraphStub.batches))
+        self.assertEqual(3, len(GraphStub.batches[0]))
+        self.assertEqual(["page2/feed?since=8&limit=2&until=13"],
+                         [r['relative_url'] for r in GraphStub.batches[1]])
+        self.assertEqual(blk._freshest, [10, 14, 10])
+        self.assert_num_signals_notified(3)
+        blk.stop()
+
+    @patch.object(facebook_feed_block, "BATCH_LIMIT", 1)
+    @patch.object(FacebookFeed, "created_epoch")
+    @patch.object(FacebookFeed, "_authenticate")
+    def test_batch_chunk_failure(self, mock_auth, mock_epoch):
+        """ A batch that fails unexpectedly leaves the others polling """
+        server = HTTPServer(('127.0.0.1', 0), GraphStub)
+        Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+        GraphStub.batches = []
+        GraphStub.feeds = {
+            "page1": [{"epoch": 12, "broken": True}],
+            "page2": [{"epoch": 14}, {"epoch": 13}, {"epoch": 12}],
+        }
+
+        def epoch(post):
+            if post.get('broken'):
+                raise ValueError("Unparseable post")
+            return post['epoch']
+        mock_epoch.side_effect = epoch
+
+        blk = FacebookFeed()
+        blk.GRAPH_URL = "http://127.0.0.1:{}/".format(server.server_port)
+        self.configure_block(blk, {
+            "queries": ["page1", "page2"],
+            "poll_mode": "batch",
+            "limit": 2
+        })
+        blk._freshest = [10, 10]
+        blk.logger = MagicMock()
+        blk.poll()
+        # page2 still got its second page
+        self.assertEqual(3, len(GraphStub.batches))
+        self.assertEqual(blk._freshest, [10, 14])
+        self.assert_num_signals_notified(3)
+        self.assertIn("page1", blk.logger.error.call_args[0][0])
+        blk.stop()
+
+    @patch.object(FacebookFeed, "created_epoch")
+    @patch.object(FacebookFeed, "_authenticate")
+    @patch.object(GraphSession, "get")
+    def test_concurrent_retries(self, mock_get, mock_auth, mock_epoch):
+        """ Failed concurrent requests are retried up to the retry limit """
+        blk = FacebookFeed()
+        self.configure_block(blk, {
+            "queries": ["page1"],
+            "poll_mode": "concurrent",
+            "retry_limit": 2,
+            "retry_interval": {"seconds": 0}
+        })
+        blk._freshest = [10]
+        mock_epoch.side_effect = lambda post: post['epoch']
+        failure = MagicMock()
+        failure.status_code = 500
+        failure.headers = {}
+        failure.json.return_value = {"error": {"code": 1}}
+        success = MagicMock()
+        success.status_code = 200
+        success.json.return_value = {"data": [{"epoch": 11}]}
+        mock_get.side_effect = [failure, requests.ConnectionError, success]
+        blk.poll()
+        self.assertEqual(3, mock_get.call_count)
+        self.assertEqual([11], blk._freshest)
+        self.assert_num_signals_notified(1)
+
+        # and given up on after that
+        mock_get.reset_mock()
+        mock_get.side_effect = None
+        mock_get.return_value = failure
+        blk.poll()
+        self.assertEqual(3, mock_get.call_count)
+        self.assertEqual([11], blk._freshest)
+        blk.stop()
+
+    @skipIf(aiohttp is None, "aiohttp is not installed")
+    @patch.object(FacebookFeed, "created_epoch")
+    @patch.object(FacebookFeed, "_authenticate")
+    def test_async_poll(self, mock_auth, mock_epoch):
+        """ Async mode polls every query on a single event loop """
+        server = HTTPServer(('127.0.0.1', 0), GraphStub)
+        Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+        GraphStub.feeds = {
+            "page1": [{"epoch": 12}, {"epoch": 11}],
+            "page2": [{"epoch": 9}],
+        }
+        mock_epoch.side_effect = lambda post: post['epoch']
+
+        blk = FacebookFeed()
+        blk.GRAPH_URL = "http://127.0.0.1:{}/".format(server.server_port)
+        self.configure_block(blk, {
+            "queries": ["page1", "page2", "username"],
+            "poll_mode": "async",
+            "limit": 1,
+            "retry_limit": 0
+        })
+        blk._freshest = [10, 10, 10]
+        blk._engine.start()
+        blk._engine.poll().result(5)
+        self.assertEqual(blk._freshest, [12, 10, 10])
+        self.assert_num_signals_notified(2)
+
+        # requests that would wait on the app's pause too long are skipped
+        blk._governor = RateGovernor(rate=2, backoff=60)
+        blk._governor.observe({}, error_code=4)
+        blk._freshest = [10, 10, 10]
+        blk._engine.poll().result(5)
+        self.assertEqual(blk._freshest, [10, 10, 10])
+        self.assert_num_signals_notified(2)
+        blk._engine.stop()
+
+    @skipIf(aiohttp is None, "aiohttp is not installed")
+    @patch.object(FacebookFeed, "created_epoch")
+    @patch.object(FacebookFeed, "_authenticate")
+    def test_async_failures(self, mock_auth, mock_epoch):
+        """ Async queries fail on their own and stopping cancels them """
+        server = HTTPServer(('127.0.0.1', 0), GraphStub)
+        Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+        GraphStub.feeds = {
+            "page1": [{"epoch": 12, "broken": True}],
+            "page2": [{"epoch": 11}],
+        }
+
+        def epoch(post):
+            if post.get('broken'):
+                raise ValueError("Unparseable post")
+            return post['epoch']
+        mock_epoch.side_effect = epoch
+
+        blk = FacebookFeed()
+        blk.GRAPH_URL = "http://127.0.0.1:{}/".format(server.server_port)
+        self.configure_block(blk, {
+            "queries": ["page1", "page2"],
+            "poll_mode": "async"
+        })
+        blk._freshest = [10, 10]
+        blk.logger = MagicMock()
+        blk._engine.start()
+        blk._engine.poll().result(5)
+        self.assertEqual(blk._freshest, [10, 11])
+        self.assert_num_signals_notified(1)
+        self.assertIn("page1", blk.logger.error.call_args[0][0])
+
+        # requests still in flight are cancelled on stop
+        requested = Event()
+
+        async def hang(url, headers):
+            requested.set()
+            await asyncio.sleep(60)
+        blk._engine._get = hang
+        cycle = blk._engine.poll()
+        self.assertTrue(requested.wait(1))
+        blk._engine.stop()
+        self.assertTrue(cycle.cancelled())
+
+    @skipIf(aiohttp is None, "aiohttp is not installed")
+    @patch.object(FacebookFeed, "created_epoch")
+    @patch.object(FacebookFeed, "_authenticate")
+    def test_async_token_retry(self, mock_auth, mock_epoch):
+        """ Async retries carry the token that replaced a rejected one """
+        mock_epoch.side_effect = lambda post: post['epoch']
+        blk = FacebookFeed()
+        self.configure_block(blk, {
+            "queries": ["page1"],
+            "poll_mode": "async",
+            "retry_interval": {"seconds": 0}
+        })
+        blk._freshest = [10]
+        blk._access_token = "rejected"
+
+        def authenticate():
+            blk._access_token = "renewed"
+        mock_auth.side_effect = authenticate
+        urls = []
+
+        async def get(url, headers):
+            urls.append(url)
+            if "access_token=rejected" in url:
+                return GraphResponse(400, {}, json.dumps(
+                    {"error": {"code": 190, "type": "OAuthException"}}))
+            return GraphResponse(200, {}, json.dumps(
+                {"data": [{"epoch": 11}]}))
+        blk._engine.start()
+        blk._engine._get = get
+        blk._engine.poll().result(5)
+        blk._engine.stop()
+        self.assertEqual(2, len(urls))
+        self.assertIn("access_token=renewed", urls[1])
+        self.assertEqual([11], blk._freshest)
+
+    @patch.object(FacebookFeed, "created_epoch")
+    @patch.object(FacebookFeed, "_authenticate")
+    @patch.object(GraphSession, "get")
+    def test_cursor_paging(self, mock_get, mock_auth, mock_epoch):
+        """ Cursor paging follows paging.next until posts get stale """
+        blk = FacebookFeed()
+        self.configure_block(blk, {
+            "queries": ["page1"],
+            "poll_mode": "concurrent",
+            "paging_mode": "cursor",
+            "limit": 2
+        })
+        blk._freshest = [10]
+        mock_epoch.side_effect = lambda post: post['epoch']
+        pages = {
+            "page2": {"data": [{"epoch": 11}, {"epoch": 9}],
+                      "paging": {"next": "page3"}},
+            "page3": {"data": [{"epoch": 8}]}
+        }
+
+        def get(url, headers, **kwargs):
+            resp = MagicMock()
+            resp.status_code = 200
+            resp.json.return_value = pages.get(url, {
+                "data": [{"epoch": 13}, {"epoch": 12}],
+                "paging": {"next": "page2"}})
+            return resp
+        mock_get.side_effect = get
+        blk.poll()
+        self.assertEqual(2, mock_get.call_count)
+        self.assertEqual("page2", mock_get.call_args[0][0])
+        self.assertEqual(blk._freshest, [13])
+        self.assert_num_signals_notified(3)
+
+        # the number of pages per poll can be capped
+        mock_get.reset_mock()
+        blk.max_pages = MagicMock(return_value=1)
+        blk._freshest = [10]
+        blk.poll()
+        self.assertEqual(1, mock_get.call_count)
+        blk.stop()
+
+    @patch.object(FacebookFeed, "created_epoch")
+    @patch.object(FacebookFeed, "_authenticate")
+    @patch.object(GraphSession, "get")
+    def test_cursor_paging_round_robin(self, mock_get, mock_auth,
+                                       mock_epoch):
+        """ Round-robin cursor paging stops at an empty last page """
+        blk = FacebookFeed()
+        self.configure_block(blk, {
+            "queries": ["page1"],
+            "paging_mode": "cursor",
+            "limit": 2
+        })
+        blk._freshest = [10]
+        mock_epoch.side_effect = lambda post: post['epoch']
+        pages = {
+            "page2": [{"data": [], "paging": {"previous": "page1"}}]
+        }
+
+        def get(url, headers, **kwargs):
+            resp = MagicMock()
+            resp.status_code = 200
+            if url in pages:
+                # a page requested again comes back without paging
+                body = pages[url].pop() if pages[url] else {"data": []}
+            else:
+                body = {"data": [{"epoch": 13}, {"epoch": 12}],
+                        "paging": {"next": "page2"}}
+            resp.json.return_value = body
+            return resp
+        mock_get.side_effect = get
+        blk.poll()
+        self.assertEqual(2, mock_get.call_count)
+        self.assertEqual("page2", mock_get.call_args[0][0])
+        self.assert_num_signals_notified(2)
+
+        # the next cycle starts over from the query url
+        mock_get.reset_mock()
+        blk._freshest = [13]
+        blk.poll()
+        self.assertNotEqual("page2", mock_get.call_args_list[0][0][0])
+        blk.stop()
+
+    def test_adaptive_schedule(self):
+        schedule = AdaptiveSchedule(20, 3600)
+        self.assertTrue(schedule.due("page", now=0))
+        # a post every minute
+        schedule.observe("page", [1060, 1000], now=0)
+        self.assertEqual(60, schedule.interval("page"))
+        self.assertFalse(schedule.due("page", now=59))
+        self.assertTrue(schedule.due("page", now=60))
+        # quiet polls back off, up to the maximum interval
+        schedule.observe("page", [], now=60)
+        self.assertEqual(120, schedule.interval("page"))
+        for _ in range(10):
+            schedule.observe("page", [], now=60)
+        self.assertEqual(3600, schedule.interval("page"))
+        # and never go below the minimum interval
+        schedule.observe("busy", [1003, 1002, 1000], now=0)
+        self.assertEqual(20, schedule.interval("busy"))
+
+    @patch.object(FacebookFeed, "created_epoch")
+    @patch.object(FacebookFeed, "_authenticate")
+    @patch.object(GraphSession, "get")
+    def test_adaptive_polling(self, mock_get, mock_auth, mock_epoch):
+        """ Only queries whose own interval elapsed are polled """
+        blk = FacebookFeed()
+        self.configure_block(blk, {
+            "queries": ["busy", "quiet"],
+            "poll_mode": "concurrent",
+            "adaptive_polling": True
+        })
+        mock_epoch.side_effect = lambda post: post['epoch']
+        mock_get.return_value = MagicMock()
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.json.return_value = {"data": []}
+        self.assertEqual([0, 1], blk._due_queries())
+        blk.poll()
+        self.assertEqual(2, mock_get.call_count)
+        # nothing is due until the polling interval has elapsed
+        self.assertEqual([], blk._due_queries())
+        blk.stop()
+
+    @patch.object(facebook_feed_block, "monotonic")
+    @patch.object(FacebookFeed, "created_epoch")
+    @patch.object(FacebookFeed, "_authenticate")
+    @patch.object(GraphSession, "get")
+    def test_adaptive_polling_ticks(self, mock_get, mock_auth, mock_epoch,
+                                    mock_monotonic):
+        """ A busy query is polled on every tick, however long polls take
+        """
+        blk = FacebookFeed()
+        self.configure_block(blk, {
+            "queries": ["busy", "quiet"],
+            "poll_mode": "concurrent",
+            "polling_interval": {"seconds": 20},
+            "adaptive_polling": True
+        })
+        mock_epoch.side_effect = lambda post: post['epoch']
+        clock = [0]
+        mock_monotonic.side_effect = lambda: clock[0]
+        now = int(time())
+        polled = []
+
+        def get(url, headers, **kwargs):
+            # responses come in a while after the tick
+            clock[0] += 0.5
+            query = "busy" if "busy" in url else "quiet"
+            polled.append((tick, query))
+            resp = MagicMock()
+            resp.status_code = 200
+            # a post every second
+            newest = now + 10 + tick
+            resp.json.return_value = {"data": [
+                {"epoch": newest - i} for i in range(3)
+            ] if query == "busy" else []}
+            return resp
+        mock_get.side_effect = get
+        for tick in range(0, 100, 20):
+            clock[0] = tick
+            blk.poll()
+        self.assertEqual([0, 20, 40, 60, 80],
+                         [t for t, query in polled if query == "busy"])
+        # quiet queries back off
+        self.assertEqual([0, 40],
+                         [t for t, query in polled if query == "quiet"])
+        blk.stop()
+
+    def test_rate_governor(self):
+        self.assertEqual(80, parse_usage({
+            "X-App-Usage": '{"call_count": 80, "total_time": 20}',
+            "x-page-usage": '{"call_count": 10}'}))
+        self.assertIsNone(parse_usage({"Content-Type": "application/json"}))
+
+        governor = RateGovernor(rate=2, backoff=10)
+        self.assertEqual(0, governor.reserve())
+        self.assertEqual(0, governor.reserve())
+        self.assertAlmostEqual(0.5, governor.reserve(), places=1)
+        # high usage slows requests down
+        governor.observe({"X-App-Usage": '{"call_count": 95}'})
+        self.assertGreater(governor.reserve(), 2)
+        # hitting the limit pauses them
+        governor = RateGovernor(rate=2, backoff=10)
+        governor.observe({"X-App-Usage": '{"call_count": 100}'})
+        self.assertAlmostEqual(10, governor.reserve(), places=0)
+        # and throttling errors back off exponentially
+        governor = RateGovernor(rate=2, backoff=10)
+        governor.observe({}, error_code=4)
+        self.assertTrue(5 <= governor.reserve() <= 10)
+        governor.observe({}, error_code=4)
+        self.assertTrue(10 <= governor.reserve() <= 20)
+        # requests that would wait too long are not taken
+        self.assertIsNone(governor.reserve(max_wait=1))
+        self.assertFalse(governor.acquire(max_wait=1))
+        # no rate limit, but throttling still pauses requests
+        governor = RateGovernor(rate=0, backoff=10)
+        self.assertEqual(0, governor.reserve(100))
+        self.assertTrue(governor.acquire())
+        governor.observe({}, error_code=4)
+        self.assertTrue(5 <= governor.reserve() <= 10)
+
+    @patch.object(FacebookFeed, "_authenticate")
+    @patch.object(GraphSession, "get")
+    def test_throttled_query(self, mock_get, mock_auth):
+        """ Throttling errors pause every block of the app """
+        blocks = [FacebookFeed(), FacebookFeed()]
+        for blk in blocks:
+            self.configure_block(blk, {
+                "queries": ["page"],
+                "poll_mode": "concurrent",
+                "polling_interval": {"seconds": 1},
+                "creds": {"consumer_key": "throttled", "app_secret": "s"}
+            })
+        self.assertIs(blocks[0]._governor, blocks[1]._governor)
+        resp = MagicMock()
+        resp.status_code = 400
+        resp.headers = {}
+        resp.json.return_value = {"error": {"code": 613}}
+        self.assertFalse(blocks[0]._failed("page", resp, "url"))
+        self.assertGreater(blocks[1]._governor.reserve(), 1)
+        # polls are skipped for as long as they would have to wait
+        blocks[1].poll()
+        self.assertEqual(0, mock_get.call_count)
+        blocks[1].poll_mode = PollMode.ROUND_ROBIN
+        blocks[1].poll()
+        self.assertEqual(0, mock_get.call_count)
+        self.assertEqual(0, blocks[1]._idx)
+        blocks[1].stop()
+
+    @patch.object(FacebookFeed, "created_epoch")
+    @patch.object(FacebookFeed, "_authenticate")
+    @patch.object(GraphSession, "get")
+    def test_checkpoints(self, mock_get, mock_auth, mock_epoch):
+        """ Freshness and seen posts are restored from checkpoints """
+        path = os.path.join(tempfile.mkdtemp(), "checkpoints")
+        config = {
+            "queries": ["page1", "page2"],
+            "poll_mode": "concurrent",
+            "checkpoint_file": path,
+            "lookback": {"days": 1},
+            "dedup_size": 0
+        }
+        mock_epoch.side_effect = lambda post: post['epoch']
+        mock_get.return_value = MagicMock()
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.json.return_value = {"data": [
+            {"id": "b", "epoch": 2 ** 31 - 1}, {"id": "a", "epoch": 1}]}
+        blk = FacebookFeed()
+        self.configure_block(blk, config)
+        blk.poll()
+        self.assert_num_signals_notified(2)
+        blk.stop()
+
+        # checkpoints are written to the file
+        store = CheckpointStore(path)
+        self.assertEqual({"freshest": 2 ** 31 - 1, "seen": ["b"]},
+                         store.get("page1", "feed"))
+
+        # and restored when the block is configured again
+        blk = FacebookFeed()
+        self.configure_block(blk, config)
+        self.assertEqual([2 ** 31 - 1] * 2, blk._freshest)
+        mock_get.return_value.json.return_value = {"data": [
+            {"id": "c", "epoch": 2 ** 31}, {"id": "b", "epoch": 2 ** 31}]}
+        blk.poll()
+        self.assert_num_signals_notified(4)
+        self.assertEqual(["b", "c"], list(blk._seen["page1"]))
+        blk.stop()
+
+    def test_checkpoint_compaction(self):
+        """ The checkpoint file is compacted as it is flushed """
+        path = os.path.join(tempfile.mkdtemp(), "checkpoints")
+        store = CheckpointStore(path)
+        for freshest in range(10):
+            for query in ("page1", "page2"):
+                store.update(query, "feed", {"freshest": freshest})
+            store.flush()
+            with open(path) as f:
+                self.assertLessEqual(len(f.readlines()), 4)
+        self.assertEqual({"freshest": 9},
+                         CheckpointStore(path).get("page2", "feed"))
+        # records appended by another process survive compaction
+        other = CheckpointStore(path)
+        other.update("page3", "feed", {"freshest": 1})
+        other.flush()
+        for freshest in range(10, 20):
+            store.update("page1", "feed", {"freshest": freshest})
+            store.flush()
+        store = CheckpointStore(path)
+        self.assertEqual({"freshest": 1}, store.get("page3", "feed"))
+        self.assertEqual({"freshest": 19}, store.get("page1", "feed"))
+
+    def test_post_index(self):
+        index = PostIndex(max_size=2, ttl=3600)
+        self.assertFalse(index.seen("a"))
+        self.assertTrue(index.seen("a"))
+        self.assertFalse(index.seen("b"))
+        self.assertFalse(index.seen("c"))
+        # the least recently seen id was evicted to stay within max_size
+        self.assertEqual({"size": 2, "hits": 1, "misses": 3, "evictions": 1},
+                         index.stats())
+        self.assertFalse(index.seen("a"))
+        # ids expire after the ttl
+        index = PostIndex(max_size=2, ttl=0)
+        self.assertFalse(index.seen("a"))
+        self.assertFalse(index.seen("a"))
+
+    @patch.object(FacebookFeed, "created_epoch")
+    @patch.object(FacebookFeed, "_authenticate")
+    @patch.object(GraphSession, "get")
+    def test_dedup(self, mock_get, mock_auth, mock_epoch):
+        """ Posts shared across queries are only notified once """
+        blk = FacebookFeed()
+        self.configure_block(blk, {
+            "queries": ["page1", "page2"],
+            "poll_mode": "concurrent"
+        })
+        blk._freshest = [10, 10]
+        mock_epoch.side_effect = lambda post: post['epoch']
+        mock_get.return_value = MagicMock()
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.json.return_value = {"data": [
+            {"id": "shared", "epoch": 11}]}
+        blk.poll()
+        self.assert_num_signals_notified(1)
+        self.assertEqual(1, blk.dedup_stats()["hits"])
+        blk.stop()
+
+    @patch.object(FacebookFeed, "_authenticate")
+    def test_fields(self, mock_auth):
+        """ Requested fields are added to the polling urls """
+        blk = FacebookFeed()
+        self.configure_block(blk, {
+            "queries": ["page"],
+            "fields": ["message", "from{name}"],
+            "summary_edges": ["likes"]
+        })
+        blk._freshest = [10]
+        blk._prepare_url()
+        self.assertIn(
+            "&limit=10&fields=message,from{name},"
+            "likes.summary(true).limit(0),id,created_time&access_token=",
+            blk.url)
+        self.assertTrue(blk._relative_url("page", 10).endswith(
+            "&fields=message,from{name},"
+            "likes.summary(true).limit(0),id,created_time"))
+
+    def test_iter_response(self):
+        """ Response bodies are decoded item by item, in any chunking """
+        body = json.dumps({
+            "data": [{"id": "1", "message": "café"}, {"id": "2"}],
+            "paging": {"next": "url"}
+        }).encode()
+        for size in (1, 3, len(body)):
+            chunks = [body[i:i + size] for i in range(0, len(body), size)]
+            self.assertEqual(list(iter_response(chunks)), [
+                ('data', {"id": "1", "message": "café"}),
+                ('data', {"id": "2"}),
+                ('paging', {"next": "url"}),
+            ])
+        with self.assertRaises(ValueError):
+            list(iter_response([b'{"data": [{"id": 1}']))
+
+    @patch.object(FacebookFeed, "created_epoch")
+    @patch.object(FacebookFeed, "_authenticate")
+    @patch.object(GraphSession, "get")
+    def test_stream_decode(self, mock_get, mock_auth, mock_epoch):
+        """ Streamed responses are only read up to the first stale post """
+        blk = FacebookFeed()
+        self.configure_block(blk, {
+            "queries": ["page"],
+            "poll_mode": "concurrent",
+            "stream_decode": True
+        })
+        blk._freshest = [10]
+        mock_epoch.side_effect = lambda post: post['epoch']
+        body = json.dumps({"data": [{"epoch": 12}, {"epoch": 11},
+                                    {"epoch": 9}, {"epoch": 8}]}).encode()
+        chunks = []
+
+        def iter_content(chunk_size):
+            for i in range(0, len(body), 8):
+                chunks.append(body[i:i + 8])
+                yield chunks[-1]
+        resp = mock_get.return_value
+        resp.status_code = 200
+        resp.iter_content.side_effect = iter_content
+        blk.poll()
+        self.assertTrue(mock_get.call_args[1]['stream'])
+        self.assertFalse(resp.json.called)
+        self.assertTrue(resp.close.called)
+        self.assertLess(len(b''.join(chunks)), len(body))
+        self.assertEqual(blk._freshest, [12])
+        self.assert_num_signals_notified(2)
+        blk.stop()
+
+    def test_shard_queries(self):
+        """ Queries are split over shards, and move little when they grow """
+        queries = ["page{}".format(i) for i in range(300)]
+        shards = [shard_queries(queries, i, 3) for i in range(3)]
+        self.assertEqual(sorted(queries), sorted(sum(shards, [])))
+        for shard in shards:
+            self.assertGreater(len(shard), 50)
+        # adding a fourth shard only moves queries to that shard
+        for query in queries:
+            if shard_of(query, 4) != 3:
+                self.assertEqual(shard_of(query, 3), shard_of(query, 4))
+        self.assertEqual(queries, shard_queries(queries, 0, 1))
+        with self.assertRaises(ValueError):
+            shard_queries(queries, 3, 3)
+
+    @patch.object(FacebookFeed, "created_epoch")
+    @patch.object(FacebookFeed, "_authenticate")
+    @patch.object(GraphSession, "get")
+    def test_sharding(self, mock_get, mock_auth, mock_epoch):
+        """ A shard only polls its queries and resumes them from checkpoints
+        written by other shards """
+        path = os.path.join(tempfile.mkdtemp(), "checkpoints")
+        queries = ["page{}".format(i) for i in range(10)]
+        owned = shard_queries(queries, 1, 2)
+        checkpoint_store(path)
+        # the previous owner of the shard, in another process, checkpointed
+        # each feed of a query after the file was opened here
+        other = CheckpointStore(path)
+        other.update(owned[0], "feed", {"freshest": 2 ** 31})
+        other.update(owned[0], "posts", {"freshest": 2 ** 30})
+        other.flush()
+        mock_epoch.side_effect = lambda post: post['epoch']
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.json.return_value = {"data": []}
+        blk = FacebookFeed()
+        self.configure_block(blk, {
+            "queries": queries,
+            "poll_mode": "concurrent",
+            "shard_index": 1,
+            "shard_count": 2,
+            "checkpoint_file": path
+        })
+        self.assertEqual(len(owned), blk._n_queries)
+        self.assertEqual(2 ** 31, blk._freshest[0])
+        blk.poll()
+        polled = {url.split('/')[-2] for (url,), _ in
+                  mock_get.call_args_list}
+        self.assertEqual(set(owned), polled)
+        self.assertEqual(owned[0], blk.current_query)
+        blk.stop()
+        blk = FacebookFeed()
+        self.configure_block(blk, {
+            "queries": queries,
+            "feed_type": "posts",
+            "shard_index": 1,
+            "shard_count": 2,
+            "checkpoint_file": path
+        })
+        self.assertEqual(2 ** 30, blk._freshest[0])
+
+    @patch.object(FacebookFeed, "created_epoch")
+    @patch.object(FacebookFeed, "_authenticate")
+    @patch.object(GraphSession, "get")
+    def test_emission_latency(self, mock_get, mock_auth, mock_epoch):
+        """ Buffered signals of every query are flushed after the latency """
+        blk = FacebookFeed()
+        self.configure_block(blk, {
+            "queries": ["page1", "page2", "page3"],
+            "poll_mode": "concurrent",
+            "emit_size": 100,
+            "emit_latency": {"seconds": 60}
+        })
+        blk._freshest = [10, 10, 10]
+        mock_epoch.side_effect = lambda post: post['epoch']
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.json.return_value = {
+            'data': [{'epoch': 12}, {'epoch': 11}]}
+        blk.poll()
+        self.assert_num_signals_notified(0)
+        JumpAheadScheduler.jump_ahead(60)
+        self.assert_num_signals_notified(6)
+        self.assertEqual(1, len(self.notified_signals[DEFAULT_TERMINAL]))
+        # posts of each query keep their order
+        epochs = [s.epoch for s in self.notified_signals[DEFAULT_TERMINAL][0]]
+        self.assertEqual([12, 11] * 3, epochs)
+        blk.stop()
+
+    def test_query_metrics(self):
+        metrics = QueryMetrics()
+        metrics.request("page", 0.03)
+        metrics.request("page", 0.3)
+        metrics.request("page", 30)
+        metrics.response("page", 100, 4, 1, 2, 0.5)
+        metrics.response("page", 100, 4, 3, 1, 0.5)
+        metrics.error("page", skipped=True)
+        metrics.retry("page")
+        stats = metrics.snapshot()["page"]
+        self.assertEqual(3, stats["requests"])
+        self.assertEqual(1, stats["latency_ms"]["50"])
+        self.assertEqual(1, stats["latency_ms"]["500"])
+        self.assertEqual(1, stats["latency_ms"]["inf"])
+        self.assertEqual(200, stats["bytes"])
+        self.assertEqual(1, stats["decode_time"])
+        self.assertEqual(4, stats["posts_per_response"])
+        self.assertEqual(0.5, stats["fresh_ratio"])
+        self.assertEqual(2, stats["max_paging_depth"])
+        self.assertEqual((1, 1, 1), (stats["errors"], stats["skipped"],
+                                     stats["retries"]))
+
+    @patch.object(FacebookFeed, "created_epoch")
+    @patch.object(FacebookFeed, "_authenticate")
+    @patch.object(GraphSession, "get")
+    def test_metrics(self, mock_get, mock_auth, mock_epoch):
+        """ Each query's requests are measured and reported as signals """
+        blk = FacebookFeed()
+        self.configure_block(blk, {
+            "queries": ["page1", "page2"],
+            "poll_mode": "concurrent",
+            "collect_metrics": True
+        })
+        self.assertEqual({}, blk.stats())
+        blk._freshest = [10, 10]
+        mock_epoch.side_effect = lambda post: post['epoch']
+
+        def get(url, headers, **kwargs):
+            resp = MagicMock()
+            if '/page1/' in url:
+                resp.status_code = 200
+                resp.content = b'{"data": [{"epoch": 11}, {"epoch": 9}]}'
+                resp.json.return_value = json.loads(resp.content)
+            else:
+                resp.status_code = 404
+                resp.json.return_value = {'error': {'code': 803}}
+            return resp
+        mock_get.side_effect = get
+        blk.poll()
+        stats = blk.stats()
+        self.assertEqual(1, stats["page1"]["requests"])
+        self.assertEqual(0, stats["page1"]["errors"])
+        self.assertEqual(39, stats["page1"]["bytes"])
+        self.assertEqual(0.5, stats["page1"]["fresh_ratio"])
+        self.assertEqual(1, stats["page2"]["requests"])
+        self.assertEqual(1, stats["page2"]["errors"])
+        self.assertEqual(1, stats["page2"]["skipped"])
+        blk._notify_stats()
+        self.assert_num_signals_notified(1, blk)
+        self.assert_num_signals_notified(2, blk, output_id='stats')
+        self.assertEqual({"page1", "page2"}, {
+            s.query for s in self.notified_signals['stats'][0]})
+        blk.stop()
+
+    def test_graph_simulator(self):
+        """ Polling the simulated Graph API end to end """
+        sim = GraphSimulator(post_rate=0.1, missing=["gone"]).start()
+        self.addCleanup(sim.stop)
+        token_cache.clear()
+        blk = FacebookFeed()
+        blk.GRAPH_URL = sim.url
+        blk.TOKEN_URL_FORMAT = sim.url + "oauth/access_token?client_id={0}" \
+            "&client_secret={1}&grant_type=client_credentials"
+        self.configure_block(blk, {
+            "queries": ["page1", "page2", "gone"],
+            "poll_mode": "concurrent",
+            "lookback": {"minutes": 2},
+            "limit": 5,
+            "creds": {"consumer_key": "simulated", "app_secret": "s"}
+        })
+        self.assertEqual("simulated|token", blk._access_token)
+        since = blk._freshest[0]
+        expected = [sim.posts(feed, since, limit=100)
+                    for feed in ("page1", "page2")]
+        blk.poll()
+        # 12 posts per feed, in pages of 5, and one request for "gone"
+        self.assertEqual(2 * 3 + 1 + 1, sim.requests)
+        self.assert_num_signals_notified(sum(len(e) for e in expected))
+        self.assertEqual(
+            [blk.created_epoch(e[0]) for e in expected] + [since],
+            blk._freshest)
+        blk.stop()
+
+        sim.throttle_every = 2
+        self.assertEqual(200, sim.answer("/v2.2/page1/feed?since=0")[0])
+        status, _, body = sim.answer("/v2.2/page1/feed?since=0")
+        self.assertEqual((400, 4), (status, body["error"]["code"]))
+
+    def test_conditional_requests(self):
+        """ Idle feeds are answered with 304 and not processed again """
+        sim = GraphSimulator(post_rate=1 / 3600, etags=True).start()
+        self.addCleanup(sim.stop)
+        for mode in ("concurrent", "batch"):
+            sim.not_modified = 0
+            blk = FacebookFeed()
+            blk.GRAPH_URL = sim.url
+            blk.TOKEN_URL_FORMAT = sim.url + "oauth/access_token"
+            self.configure_block(blk, {
+                "queries": ["page1", "page2"],
+                "poll_mode": mode,
+                "conditional_requests": True,
+                "collect_metrics": True,
+                "creds": {"consumer_key": "conditional", "app_secret": "s"}
+            })
+            for _ in range(3):
+                blk.poll()
+            self.assertEqual(4, sim.not_modified)
+            self.assertEqual(2, blk.stats()["page1"]["unchanged"])
+            blk.stop()
+        self.assert_num_signals_notified(0)
+
+    @patch.object(FacebookFeed, "_authenticate")
+    @patch.object(GraphSession, "get")
+    def test_unchanged_digest(self, mock_get, mock_auth):
+        """ Without ETags, responses are compared by digest """
+        blk = FacebookFeed()
+        self.configure_block(blk, {
+            "queries": ["page"],
+            "poll_mode": "concurrent",
+            "conditional_requests": True
+        })
+        resp = mock_get.return_value
+        resp.status_code = 200
+        resp.headers = {}
+        resp.content = b'{"data": []}'
+        resp.json.return_value = {"data": []}
+        blk.poll()
+        blk.poll()
+        self.assertEqual(1, resp.json.call_count)
+        self.assertNotIn("If-None-Match", mock_get.call_args[1]["headers"])
+        # a different body is processed again
+        resp.content = b'{"data": [], "paging": {}}'
+        blk.poll()
+        self.assertEqual(2, resp.json.call_count)
+        blk.stop()
+
+    @patch.object(FacebookFeed, "_authenticate")
+    def test_webhook(self, mock_auth):
+        """ Webhook notifications are verified and notified as posts """
+        blk = FacebookFeed()
+        self.configure_block(blk, {
+            "queries": ["1234"],
+            "polling_interval": {"seconds": 0},
+            "include_query": "query",
+            "creds": {"consumer_key": "app", "app_secret": "secret"},
+            "webhook": {"enabled": True, "port": 0,
+                        "verify_token": "token"}
+        })
+        blk.start()
+        self.addCleanup(blk.stop)
+        url = "http://127.0.0.1:{}/facebook".format(blk._webhook.port)
+
+        # subscription handshake
+        resp = requests.get(url, params={
+            "hub.mode": "subscribe", "hub.verify_token": "token",
+            "hub.challenge": "1158201444"})
+        self.assertEqual((200, "1158201444"), (resp.status_code, resp.text))
+        resp = requests.get(url, params={
+            "hub.mode": "subscribe", "hub.verify_token": "wrong",
+            "hub.challenge": "1158201444"})
+        self.assertEqual(403, resp.status_code)
+
+        body = json.dumps({"object": "page", "entry": [{
+            "id": "1234", "time": 1413493543, "changes": [
+                {"field": "feed", "value": {
+                    "item": "status", "verb": "add", "post_id": "1234_1",
+                    "message": "hi", "created_time": 1413493543}},
+                {"field": "feed", "value": {
+                    "item": "comment", "verb": "add", "post_id": "1234_1",
+                    "comment_id": "1"}},
+            ]}]}).encode()
+        signature = "sha1=" + hmac.new(b"secret", body,
+                                       hashlib.sha1).hexdigest()
+        resp = requests.post(url, data=body,
+                             headers={"X-Hub-Signature": "sha1=bad"})
+        self.assertEqual(403, resp.status_code)
+        self.assert_num_signals_notified(0)
+        resp = requests.post(url, data=body,
+                             headers={"X-Hub-Signature": signature})
+        self.assertEqual(200, resp.status_code)
+        self.assert_num_signals_notified(1)
+        signal = self.last_notified[DEFAULT_TERMINAL][0]
+        self.assertEqual(("1234_1", "hi", "2014-10-16T21:05:43+0000", "1234"),
+                         (signal.id, signal.message, signal.created_time,
+                          signal.query))
+        # a repeated notification, or a sweep finding the post, is dropped
+        requests.post(url, data=body, headers={"X-Hub-Signature": signature})
+        self.assert_num_signals_notified(1)
+        self.assertEqual([], feed_posts({"object": "user", "entry": []}))
+        # and so are posts of pages the block doesn't poll
+        body = body.replace(b"1234", b"5678")
+        signature = "sha1=" + hmac.new(b"secret", body,
+                                       hashlib.sha1).hexdigest()
+        resp = requests.post(url, data=body,
+                             headers={"X-Hub-Signature": signature})
+        self.assertEqual(200, resp.status_code)
+        self.assert_num_signals_notified(1)
+        # malformed notifications are rejected
+        for body in (b"[]", b"{\"object\": \"page\", \"entry\": [1]}"):
+            signature = "sha1=" + hmac.new(b"secret", body,
+                                           hashlib.sha1).hexdigest()
+            resp = requests.post(url, data=body,
+                                 headers={"X-Hub-Signature": signature})
+            self.assertEqual(400, resp.status_code)
+        conn = HTTPConnection("127.0.0.1", blk._webhook.port)
+        conn.putrequest("POST", "/facebook")
+        conn.putheader("Content-Length", "x")
+        conn.endheaders()
+        self.assertEqual(400, conn.getresponse().status)
+        conn.close()
+
+    @patch.object(FacebookFeed, "_authenticate")
+    @patch.object(GraphSession, "get")
+    def test_query_control(self, mock_get, mock_auth):
+        """ Signals add and remove queries between polling cycles """
+        blk = FacebookFeed()
+        self.configure_block(blk, {
+            "queries": ["page1", "page2"],
+            "poll_mode": "concurrent",
+            "query_control": {"enabled": True}
+        })
+        blk._freshest = [20, 30]
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.json.return_value = {"data": []}
+        blk.logger = MagicMock()
+        blk.process_signals([
+            Signal({"add_queries": ["page3", "page2"]}),
+            Signal({"remove_queries": "page1"}),
+            Signal({"other": 1}),
+        ])
+        # signals without queries to add or remove are not a problem
+        self.assertEqual(0, blk.logger.warning.call_count)
+        # nothing changes, and nothing is polled, until the next cycle
+        self.assertEqual(["page1", "page2"], blk._queries)
+        self.assertEqual(0, mock_get.call_count)
+        blk.poll()
+        self.assertEqual(["page2", "page3"], blk._queries)
+        self.assertEqual(2, blk._n_queries)
+        self.assertEqual(30, blk._freshest[0])
+        # added queries start from the lookback window
+        self.assertAlmostEqual(time(), blk._freshest[1], delta=5)
+        self.assertEqual({"page2", "page3"}, {
+            url.split('/')[-2] for (url,), _ in mock_get.call_args_list})
+        blk.stop()
+
+    def test_time_slices(self):
+        self.assertEqual([(0, 10), (10, 20), (20, 25)],
+                         time_slices(0, 25, 10))
+        self.assertEqual([], time_slices(25, 25, 10))
+
+    def test_backfill(self):
+        """ The lookback window is fetched in slices and notified in order """
+        sim = GraphSimulator(post_rate=1 / 60).start()
+        self.addCleanup(sim.stop)
+        blk = FacebookFeed()
+        blk.GRAPH_URL = sim.url
+        blk.TOKEN_URL_FORMAT = sim.url + "oauth/access_token"
+        self.configure_block(blk, {
+            "queries": ["page1", "page2", "page3"],
+            "lookback": {"hours": 2},
+            "limit": 5,
+            "polling_interval": {"seconds": 0},
+            "include_query": "query",
+            "rate_limit": 100000,
+            "backfill": {"enabled": True, "slice_size": {"minutes": 20},
+                         "max_workers": 3},
+            "creds": {"consumer_key": "backfill", "app_secret": "s"}
+        })
+        since, until = blk._backfill._windows["page1"]
+        # live polling carries on from now
+        self.assertEqual([until] * 3, blk._freshest)
+        blk.start()
+        self.assertTrue(blk._backfill.join(10))
+        blk.stop()
+        expected = {p["id"] for q in ("page1", "page2", "page3")
+                    for p in sim.posts(q, since, until + 1, limit=1000)}
+        signals = self.last_notified[DEFAULT_TERMINAL]
+        self.assertEqual(expected, {s.id for s in signals})
+        self.assertEqual(len(expected), len(signals))
+        epochs = [blk.created_epoch(s.to_dict()) for s in signals]
+        self.assertEqual(sorted(epochs), epochs)
+        self.assertEqual({"page1", "page2", "page3"},
+                         {s.query for s in signals})
+
+    def test_backfill_failures(self):
+        """ Unreadable responses are retried and a failed slice is skipped
+        """
+        sim = GraphSimulator(post_rate=1 / 60).start()
+        self.addCleanup(sim.stop)
+        blk = FacebookFeed()
+        blk.GRAPH_URL = sim.url
+        blk.TOKEN_URL_FORMAT = sim.url + "oauth/access_token"
+        self.configure_block(blk, {
+            "queries": ["page1", "page2"],
+            "lookback": {"hours": 1},
+            "limit": 5,
+            "polling_interval": {"seconds": 0},
+            "retry_interval": {"seconds": 0},
+            "rate_limit": 100000,
+            "backfill": {"enabled": True, "slice_size": {"minutes": 20},
+                         "max_workers": 1},
+            "creds": {"consumer_key": "backfill", "app_secret": "s"}
+        })
+        since, until = blk._backfill._windows["page1"]
+        decode = backfill.decode
+        decoded = []
+
+        def unreadable_once(resp):
+            decoded.append(resp)
+            if len(decoded) == 1:
+                raise ValueError("Unreadable body")
+            return decode(resp)
+        fetch = blk._backfill._fetch
+
+        def fail_first_slice(query, slice_since, slice_until):
+            if query == "page2" and slice_since == since:
+                raise RuntimeError("Backfill failure")
+            return fetch(query, slice_since, slice_until)
+        blk._backfill._fetch = fail_first_slice
+        with patch.object(backfill, "decode", side_effect=unreadable_once):
+            blk.start()
+            self.assertTrue(blk._backfill.join(10))
+        blk.stop()
+        expected = {p["id"] for p in sim.posts("page1", since, until + 1,
+                                               limit=1000)}
+        expected.update(p["id"] for p in sim.posts(
+            "page2", since + 1200, until + 1, limit=1000))
+        signals = self.last_notified[DEFAULT_TERMINAL]
+        self.assertEqual(expected, {s.id for s in signals})
+        # the failed slice doesn't hold the checkpoint back
+        self.assertEqual({}, blk._backfilling)
+
+    def test_backfill_restart(self):
+        """ A block restarted mid-backfill resumes it from its checkpoint """
+        sim = GraphSimulator(post_rate=1 / 60).start()
+        self.addCleanup(sim.stop)
+        config = {
+            "queries": ["page1"],
+            "lookback": {"hours": 2},
+            "limit": 5,
+            "polling_interval": {"seconds": 0},
+            "rate_limit": 100000,
+            "backfill": {"enabled": True, "slice_size": {"minutes": 20},
+                         "max_workers": 1},
+            "checkpoint_file": os.path.join(tempfile.mkdtemp(), "cp"),
+            "creds": {"consumer_key": "backfill", "app_secret": "s"}
+        }
+        blk = FacebookFeed()
+        blk.GRAPH_URL = sim.url
+        blk.TOKEN_URL_FORMAT = sim.url + "oauth/access_token"
+        self.configure_block(blk, config)
+        since, until = blk._backfill._windows["page1"]
+        backfilled = blk._backfilled
+
+        def stop_after_first_slice(query, slice_until):
+            backfilled(query, slice_until)
+            blk._backfill.stop()
+        blk._backfilled = stop_after_first_slice
+        blk.start()
+        self.assertTrue(blk._backfill.join(10))
+        # live polling doesn't move the checkpoint past the backfill
+        blk.poll()
+        self.assertEqual([until], blk._freshest)
+        blk.stop()
+        self.assertEqual(since + 1200, CheckpointStore(
+            config["checkpoint_file"]).get("page1", "feed")["freshest"])
+
+        blk = FacebookFeed()
+        blk.GRAPH_URL = sim.url
+        blk.TOKEN_URL_FORMAT = sim.url + "oauth/access_token"
+        self.configure_block(blk, config)
+        resumed_since, resumed_until = blk._backfill._windows["page1"]
+        self.assertEqual(since + 1200, resumed_since)
+        blk.start()
+        self.assertTrue(blk._backfill.join(10))
+        blk.stop()
+        expected = {p["id"] for p in sim.posts(
+            "page1", since, resumed_until + 1, limit=1000)}
+        self.assertEqual(expected, {
+            s.id for s in self.last_notified[DEFAULT_TERMINAL]})
+        # once complete, the checkpoint follows live polling again
+        self.assertGreaterEqual(CheckpointStore(
+            config["checkpoint_file"]).get("page1", "feed")["freshest"],
+            resumed_until)
+
+    def test_request_coalescer(self):
+        coalescer = RequestCoalescer()
+        release = Event()
+        fetches = []
+
+        def fetch():
+            fetches.append(1)
+            release.wait(5)
+            return MagicMock(status_code=200)
+        results = []
+        threads = [Thread(target=lambda: results.append(
+            coalescer.get("key", fetch, ttl=60))) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        # the first request is in flight, the others wait for it
+        while coalescer.shared < 2:
+            release.wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(fetches))
+        self.assertEqual(1, len({id(resp) for resp, _ in results}))
+        self.assertEqual([False, True, True],
+                         sorted(shared for _, shared in results))
+        # and then it is cached
+        self.assertTrue(coalescer.get("key", fetch, ttl=60)[1])
+        # errors are not cached
+        errors = MagicMock(side_effect=ValueError)
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                coalescer.get("other", errors, ttl=60)
+        self.assertEqual(2, errors.call_count)
+        self.assertEqual(("a", "https://g/page/feed?since=1"),
+                         coalesce_key("https://g/page/feed?since=1"
+                                      "&access_token=a|b", "a"))
+        self.assertEqual("https://g/page/feed?since=1&limit=25&until=2",
+                         with_limit("https://g/page/feed?since=1&limit=5"
+                                    "&until=2", 25))
+        self.assertEqual(25, coalescer.limit("page", 25))
+        self.assertEqual(25, coalescer.limit("page", 5))
+        self.assertEqual(120, window_start(150, 60))
+
+    def test_coalescing(self):
+        """ Blocks polling the same feed share requests """
+        sim = GraphSimulator(post_rate=1 / 60).start()
+        self.addCleanup(sim.stop)
+        request_coalescer.clear()
+        base = window_start(int(time()) - 600, 60)
+        blocks = []
+        for since, limit in ((base + 5, 25), (base + 30, 20), (base + 5, 3)):
+            blk = FacebookFeed()
+            blk.GRAPH_URL = sim.url
+            blk.TOKEN_URL_FORMAT = sim.url + "oauth/access_token"
+            self.configure_block(blk, {
+                "queries": ["page1"],
+                "poll_mode": "concurrent",
+                "coalescing": {"enabled": True},
+                "limit": limit,
+                "collect_metrics": True,
+                "creds": {"consumer_key": "coalescing", "app_secret": "s"}
+            })
+            blk._freshest = [since]
+            blocks.append(blk)
+        requests_made = sim.requests
+        for blk in blocks[:2]:
+            blk.poll()
+        # a smaller limit doesn't keep the request from being shared
+        self.assertEqual(1, sim.requests - requests_made)
+        self.assertEqual(1, blocks[1].stats()["page1"]["coalesced"])
+        # and the posts past it are left to the block's paging requests
+        blocks[2].poll()
+        self.assertEqual(1, blocks[2].stats()["page1"]["coalesced"])
+        self.assertGreater(blocks[2].stats()["page1"]["max_paging_depth"], 1)
+        # each block keeps its own freshness
+        posts = sim.posts("page1", base)
+        for blk, since in zip(blocks, (base + 5, base + 30, base + 5)):
+            fresh = [p for p in posts if blk.created_epoch(p) > since]
+            self.assert_num_signals_notified(len(fresh), blk)
+            self.assertEqual(blk.created_epoch(posts[0]), blk._freshest[0])
+            blk.stop()
+
+    def test_engagement_tracker(self):
+        tracker = EngagementTracker(2, 10, 40, 1000)
+        tracker.track("old", "page", 0, {"likes": 1}, now=1000)
+        tracker.track("a", "page", 900, {"likes": 1}, now=1000)
+        tracker.track("b", "page", 900, None, now=1000)
+        self.assertEqual([], tracker.due(now=1005))
+        self.assertEqual(["a", "b"], tracker.due(now=1010))
+        self.assertEqual(("page", {"likes": 2}),
+                         tracker.update("a", {"likes": 3}, now=1010))
+        # unknown counts are only recorded
+        self.assertEqual(("page", {}),
+                         tracker.update("b", {"likes": 3}, now=1010))
+        self.assertEqual(10, tracker._posts["a"].interval)
+        # the interval of posts that don't change decays
+        self.assertEqual(20, tracker._posts["b"].interval)
+        for now, interval in ((1030, 40), (1070, 40)):
+            self.assertIn("b", tracker.due(now=now))
+            tracker.update("b", {"likes": 3}, now=now)
+            self.assertEqual(interval, tracker._posts["b"].interval)
+        # posts are dropped once they are too old to track
+        self.assertEqual(["a", "b"], tracker.due(now=1899))
+        self.assertEqual([], tracker.due(now=1900))
+        self.assertEqual(0, len(tracker))
+        self.assertEqual({"likes": 2, "comments": 0, "shares": 5},
+                         engagement_counts({
+                             "likes": {"summary": {"total_count": 2}},
+                             "comments": {"summary": {"total_count": 0}},
+                             "shares": {"count": 5}},
+                             ["likes", "comments"]))
+        self.assertIsNone(engagement_counts({"shares": {"count": 5}},
+                                            ["likes"]))
+
+    @patch.object(FacebookFeed, "_authenticate")
+    @patch.object(GraphSession, "get")
+    def test_engagement(self, mock_get, mock_auth):
+        """ Changes of the counts of notified posts are notified """
+        config = {
+            "queries": ["page"],
+            "poll_mode": "concurrent",
+            "summary_edges": ["likes"],
+            "include_query": "query",
+            "engagement": {"enabled": True, "edges": ["likes"],
+                           "min_interval": {"seconds": 0}}
+        }
+        with self.assertRaises(ValueError):
+            self.configure_block(FacebookFeed(), config)
+        config["engagement"]["min_interval"] = {"seconds": 1}
+        blk = FacebookFeed()
+        self.configure_block(blk, config)
+        blk._freshest = [0]
+        post = {"id": "page_1", "created_time": "2030-01-01T00:00:00+0000",
+                "likes": {"summary": {"total_count": 1}}}
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.json.return_value = {"data": [post]}
+        blk.poll()
+        self.assert_num_signals_notified(1, blk)
+        mock_get.return_value.json.return_value = {"page_1": dict(
+            post, likes={"summary": {"total_count": 4}},
+            shares={"count": 1})}
+        with patch.object(engagement, "time", return_value=time() + 10):
+            blk._refresh_engagement()
+        self.assertIn("?ids=page_1&fields=shares,likes.summary",
+                      mock_get.call_args[0][0])
+        signal = self.last_notified["engagement"][0]
+        self.assertEqual({"likes": 4, "shares": 1}, signal.counts)
+        self.assertEqual({"likes": 3, "shares": 1}, signal.deltas)
+        self.assertEqual("page", signal.query)
+        # nothing is notified when nothing changed
+        with patch.object(engagement, "time", return_value=time() + 100):
+            blk._refresh_engagement()
+        self.assertEqual(3, mock_get.call_count)
+        self.assert_num_signals_notified(1, blk, "engagement")
+        blk.stop()
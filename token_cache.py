@@ -0,0 +1,150 @@
+""" A process wide cache of Graph API app access tokens.
+
+Every block configured with the same credentials shares a single cached
+token, so only one token request is made for them on startup and after
+retries. Tokens that come with an expiry are refreshed in the background
+shortly before they expire.
+
+"""
+import json
+from collections import namedtuple
+from threading import Lock
+from time import monotonic
+from urllib.parse import parse_qs
+
+from nio.util.threading import spawn
+
+# Tokens are refreshed in the background once they are this many seconds
+# away from expiring.
+REFRESH_MARGIN = 300
+
+_Entry = namedtuple('_Entry', ['token', 'expires_at'])
+
+
+def parse_token_response(text):
+    """ Parse the body of an access token response.
+
+    Newer Graph API versions answer with a JSON object while older ones
+    answer with a form-encoded string, e.g. `access_token=...&expires=...`.
+
+    Args:
+        text (str): The body of the response.
+
+    Returns:
+        token (str): The access token.
+        expires_in (int): Seconds until the token expires, or None if it
+            does not expire.
+
+    Raises:
+        ValueError: If the body does not contain an access token.
+
+    """
+    try:
+        body = json.loads(text)
+    except ValueError:
+        body = {k: v[0] for k, v in parse_qs(text).items()}
+    if not isinstance(body, dict) or not body.get('access_token'):
+        raise ValueError("No access token in response: {}".format(text))
+    expires_in = body.get('expires_in', body.get('expires'))
+    return body['access_token'], int(expires_in) if expires_in else None
+
+
+class TokenCache(object):
+
+    """ Caches access tokens keyed on the credentials they belong to.
+
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._entries = {}
+        self._fetch_locks = {}
+        self._refreshing = set()
+
+    def get(self, key, fetch):
+        """ Return the cached token for `key`, fetching one if necessary.
+
+        Concurrent callers for the same key wait on a single fetch.
+
+        Args:
+            key (hashable): Identifies the credentials, e.g. (app id, secret).
+            fetch (callable): Requests a new token. Returns a tuple of
+                (token, expires_in), or None if the request failed.
+
+        Returns:
+            token (str): The access token, or None if it could not be
+                fetched.
+
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            fetch_lock = self._fetch_locks.setdefault(key, Lock())
+        if self._valid(entry):
+            if self._expiring(entry):
+                self._refresh(key, fetch)
+            return entry.token
+        with fetch_lock:
+            entry = self._entries.get(key)
+            if self._valid(entry):
+                return entry.token
+            return self._fetch(key, fetch)
+
+    def invalidate(self, key, token=None):
+        """ Drop the cached token for `key`.
+
+        Args:
+            key (hashable): Identifies the credentials.
+            token (str): If given, the token is only dropped if it is still
+                the cached one, so that callers holding a stale token don't
+                throw away a token that was refreshed in the meantime.
+
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and token in (None, entry.token):
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _fetch(self, key, fetch):
+        result = fetch()
+        if result is None:
+            return None
+        token, expires_in = result
+        expires_at = None
+        if expires_in is not None:
+            expires_at = monotonic() + expires_in
+        with self._lock:
+            self._entries[key] = _Entry(token, expires_at)
+        return token
+
+    def _refresh(self, key, fetch):
+        """ Fetch a new token for `key` in the background, once. """
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                with self._fetch_locks[key]:
+                    self._fetch(key, fetch)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+        spawn(refresh)
+
+    @staticmethod
+    def _valid(entry):
+        return entry is not None and (
+            entry.expires_at is None or entry.expires_at > monotonic())
+
+    @staticmethod
+    def _expiring(entry):
+        return entry.expires_at is not None and \
+            entry.expires_at - monotonic() < REFRESH_MARGIN
+
+
+token_cache = TokenCache()
@@ -0,0 +1,199 @@
+""" Receiver of Facebook webhook (push) notifications.
+
+Facebook verifies a webhook endpoint with a `hub.challenge` handshake, then
+POSTs change notifications to it, signed with the app secret in the
+`X-Hub-Signature` headers. See
+https://developers.facebook.com/docs/graph-api/webhooks
+
+"""
+import hashlib
+import hmac
+import json
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from urllib.parse import parse_qs, urlparse
+
+from nio.properties import (PropertyHolder, BoolProperty, StringProperty,
+                            IntProperty)
+
+# Items of page feed changes that are posts
+POST_ITEMS = ('post', 'status', 'photo', 'video', 'share')
+
+
+class Webhook(PropertyHolder):
+    """ Property holder for the webhook receiver.
+
+    """
+    enabled = BoolProperty(title='Enabled', default=False)
+    host = StringProperty(title='Host', default='0.0.0.0')
+    port = IntProperty(title='Port', default=8181)
+    path = StringProperty(title='Path', default='/facebook')
+    verify_token = StringProperty(title='Verify Token',
+                                  default='[[FACEBOOK_VERIFY_TOKEN]]')
+
+
+def valid_signature(body, headers, app_secret):
+    """ Whether a notification was signed with the app secret.
+
+    The SHA-256 signature is checked when it is present, the SHA-1 one
+    otherwise.
+
+    Args:
+        body (bytes): The raw body of the notification.
+        headers (Message): Its http headers.
+        app_secret (str): The secret of the app the webhook belongs to.
+
+    """
+    for header, digest in (('X-Hub-Signature-256', hashlib.sha256),
+                           ('X-Hub-Signature', hashlib.sha1)):
+        signature = headers.get(header)
+        if signature is None:
+            continue
+        expected = "{}={}".format(digest().name, hmac.new(
+            app_secret.encode(), body, digest).hexdigest())
+        return hmac.compare_digest(expected, signature)
+    return False
+
+
+def feed_posts(payload):
+    """ The posts added to page feeds in a change notification.
+
+    Edits and removals are left out, since the blocks only notify new posts.
+
+    Args:
+        payload (dict): The decoded notification.
+
+    Returns:
+        posts (list(tuple)): (page_id, post) of each new post, where the
+            post has the same shape as in Graph API feed responses.
+
+    """
+    posts = []
+    if payload.get('object') != 'page':
+        return posts
+    for entry in payload.get('entry', []):
+        for change in entry.get('changes', []):
+            value = change.get('value') or {}
+            if change.get('field') != 'feed' or \
+                    value.get('item') not in POST_ITEMS or \
+                    value.get('verb') != 'add' or 'post_id' not in value:
+                continue
+            post = {k: v for k, v in value.items()
+                    if k not in ('item', 'verb', 'post_id', 'created_time')}
+            post['id'] = value['post_id']
+            post['type'] = value['item']
+            created = value.get('created_time', entry.get('time'))
+            if isinstance(created, (int, float)):
+                created = datetime.utcfromtimestamp(created).strftime(
+                    "%Y-%m-%dT%H:%M:%S+0000")
+            post['created_time'] = created
+            posts.append((str(entry.get('id')), post))
+    return posts
+
+
+class WebhookServer(object):
+
+    """ An http server receiving the webhook notifications of an app.
+
+    Params:
+        host (str): Interface to listen on.
+        port (int): Port to listen on, 0 picks a free one.
+        path (str): Path of the webhook endpoint.
+        verify_token (str): Token expected in verification requests.
+        app_secret (str): Secret that notifications are signed with.
+        on_posts (callable): Called with the (page_id, post) list of each
+            notification that adds posts.
+        logger (Logger): Where rejected requests are reported.
+
+    """
+
+    def __init__(self, host, port, path, verify_token, app_secret, on_posts,
+                 logger):
+        self.path = path
+        self.verify_token = verify_token
+        self.app_secret = app_secret
+        self.on_posts = on_posts
+        self.logger = logger
+        handler = type('Handler', (_Handler,), {'receiver': self})
+        self._server = ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_port
+
+    def start(self):
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread = None
+        self._server.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    receiver = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path != self.receiver.path or \
+                params.get('hub.mode') != 'subscribe' or \
+                params.get('hub.verify_token') != self.receiver.verify_token:
+            self.receiver.logger.warning(
+                "Rejected webhook verification request {}".format(url.path))
+            self._reply(403)
+            return
+        self._reply(200, params.get('hub.challenge', ''))
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self._reply(400)
+            return
+        body = self.rfile.read(length)
+        if urlparse(self.path).path != self.receiver.path:
+            self._reply(404)
+            return
+        if not valid_signature(body, self.headers, self.receiver.app_secret):
+            self.receiver.logger.warning(
+                "Rejected webhook notification with an invalid signature")
+            self._reply(403)
+            return
+        try:
+            payload = json.loads(body.decode())
+            if not isinstance(payload, dict):
+                raise ValueError("Notification is not an object")
+            posts = feed_posts(payload)
+        except (ValueError, AttributeError, TypeError):
+            # not JSON, or not shaped like a change notification
+            self._reply(400)
+            return
+        if posts:
+            try:
+                self.receiver.on_posts(posts)
+            except Exception:
+                self.receiver.logger.exception(
+                    "Unable to handle webhook notification")
+                self._reply(500)
+                return
+        self._reply(200)
+
+    def _reply(self, status, body=''):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass